@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+#
+# Compare html_to_text() with the previous lxml Cleaner + str.replace() path
+# on the descriptions of real feeds:
+#
+#     ./benchmark-html-to-text.py https://abpe.org/@gslin.rss saved-feed.rss ...
+#
+# Without arguments, feed_url in config.ini is used.  The rendering of the
+# descriptions in CASES, markup as found in real feeds, is checked first, and
+# the script exits with status 1 if any of them differ.
+
+import argparse
+import configparser
+import feedparser
+import html
+import os
+import sys
+import time
+
+from feed2threads import html_to_text
+
+# (description, expected text), with the whitespace between the tags that
+# pretty printed feeds (WordPress, Mastodon, ...) have.
+CASES = [
+    ('<p>Line1</p>\n<p>Line2</p>', 'Line1\n\nLine2'),
+    ('<p>a</p>\n\n<p>b</p>', 'a\n\nb'),
+    ('<ul>\n  <li>one</li>\n  <li>two</li>\n</ul>\n<p>after</p>', 'one\ntwo\n\nafter'),
+    ('<p>\n  indented\n</p>\n<p>next</p>', 'indented\n\nnext'),
+    ('<div>\n  <p>a</p>\n</div>\n<div>b</div>', 'a\n\nb'),
+    ('a<br><br><br><br>b', 'a\n\nb'),
+    ('<p>first<br>\nsecond</p>', 'first\nsecond'),
+    ('<p>x <b>y</b> <i>z</i></p>', 'x y z'),
+    ('<p>Hello <a href="https://example.org/tags/x" class="mention hashtag" rel="tag">#<span>x</span></a></p>\n<p>bye</p>', 'Hello #x\n\nbye'),
+]
+
+def check():
+    failed = 0
+    for body, expected in CASES:
+        text = html_to_text(body)
+        if text != expected:
+            print('* {!r}: got {!r}, expected {!r}'.format(body, text, expected))
+            failed += 1
+    print('* {} of {} cases rendered as expected'.format(len(CASES) - failed, len(CASES)))
+    return failed == 0
+
+def old_html_to_text(cl, body, limit):
+    if not body or not body.strip():
+        return ''
+
+    body = cl.clean_html(body)
+    body = body.replace('<div>', '').replace('</div>', '')
+    body = body.replace('<p>', '\n').replace('</p>', '\n')
+    body = body.strip()
+    body = html.unescape(body)
+    return body[0:limit]
+
+def bench(name, func, bodies, rounds):
+    t = time.perf_counter()
+    for _ in range(rounds):
+        for body in bodies:
+            func(body)
+    elapsed = time.perf_counter() - t
+
+    n = rounds * len(bodies)
+    print('{:<24} {:>10.3f} s {:>10.1f} us/description'.format(name, elapsed, elapsed / n * 1e6))
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark html_to_text() against the lxml Cleaner path')
+    parser.add_argument('--limit', type=int, default=280,
+                        help='Length limit of the rendered text (default: 280)')
+    parser.add_argument('--rounds', type=int, default=100,
+                        help='Rounds over the whole corpus (default: 100)')
+    parser.add_argument('feeds', nargs='*',
+                        help='Feed URLs or files (default: feed_url in config.ini)')
+    args = parser.parse_args()
+
+    if not check():
+        sys.exit(1)
+
+    feeds = args.feeds
+    if not feeds:
+        config = configparser.ConfigParser()
+        config.read('{}/.config/feed2social/config.ini'.format(os.environ['HOME']))
+        feeds = [config['default']['feed_url']]
+
+    bodies = []
+    for feed in feeds:
+        bodies += [item.get('description', '') for item in feedparser.parse(feed).entries]
+    print('* {} descriptions from {} feeds, {} rounds, limit = {}'.format(len(bodies), len(feeds), args.rounds, args.limit))
+
+    if not bodies:
+        return
+
+    bench('html_to_text', lambda body: html_to_text(body, args.limit), bodies, args.rounds)
+
+    try:
+        from lxml.html.clean import Cleaner
+    except ImportError:
+        print('* lxml_html_clean is not installed, skipping the old path')
+        return
+
+    cl = Cleaner(allow_tags=['p'])
+    bench('lxml Cleaner', lambda body: old_html_to_text(cl, body, args.limit), bodies, args.rounds)
+
+    # <br> and lists are expected to differ, as the old path drops them.
+    diff = sum(1 for body in bodies if html_to_text(body, args.limit) != old_html_to_text(cl, body, args.limit))
+    print('* {} of {} descriptions rendered differently'.format(diff, len(bodies)))
+
+if '__main__' == __name__:
+    main()
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+#
+# Measure the import time of every script with "python -X importtime", which
+# is most of a run with nothing new in the feed:
+#
+#     ./benchmark-startup.py
+#     ./benchmark-startup.py --max-ms 300 feed2bluesky feed2twitter
+#
+# Every script is imported in a fresh interpreter --rounds times and the median
+# is reported, along with the heaviest top-level imports.  With --max-ms, exit
+# with status 1 if any script takes longer, to catch regressions.
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+SCRIPTS = [
+    'feed2bluesky',
+    'feed2facebook',
+    'feed2plurk',
+    'feed2social',
+    'feed2threads',
+    'feed2twitter',
+]
+
+def import_times(module):
+    """Import module in a fresh interpreter and return {package: cumulative
+    microseconds} of the top-level imports, plus module itself.
+    """
+    res = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import {}'.format(module)],
+        capture_output=True, text=True, check=True,
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+    )
+
+    # "import time: self [us] | cumulative | imported package", indented by
+    # two spaces per level, children printed before their parent.
+    children = {}
+    for line in res.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        level = (len(name) - len(name.lstrip()) - 1) // 2
+
+        if level == 1:
+            children[name.strip()] = int(cumulative)
+        elif level == 0:
+            if name.strip() == module:
+                children[module] = int(cumulative)
+                return children
+            children = {}
+    raise RuntimeError('{} not found in the output of -X importtime'.format(module))
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the import time of the scripts')
+    parser.add_argument('--max-ms', type=float,
+                        help='Exit with status 1 if a script takes longer than this to import')
+    parser.add_argument('--rounds', type=int, default=5,
+                        help='Imports of each script, the median is reported (default: 5)')
+    parser.add_argument('--top', type=int, default=5,
+                        help='Heaviest top-level imports to list (default: 5)')
+    parser.add_argument('scripts', nargs='*',
+                        help='Scripts to measure (default: all)')
+    args = parser.parse_args()
+
+    slow = False
+    for module in args.scripts or SCRIPTS:
+        module = module[:-3] if module.endswith('.py') else module
+        rounds = [import_times(module) for _ in range(args.rounds)]
+
+        total = statistics.median(r[module] for r in rounds) / 1000
+        print('{:<16} {:>8.1f} ms'.format(module, total))
+
+        names = set().union(*rounds) - {module}
+        heaviest = sorted(((statistics.median(r.get(name, 0) for r in rounds) / 1000, name) for name in names), reverse=True)
+        for ms, name in heaviest[:args.top]:
+            print('    {:<24} {:>8.1f} ms'.format(name, ms))
+
+        if args.max_ms is not None and total > args.max_ms:
+            print('* {} takes more than {} ms to import'.format(module, args.max_ms))
+            slow = True
+
+    if slow:
+        sys.exit(1)
+
+if '__main__' == __name__:
+    main()
@@ -1,90 +1,1101 @@
 #!/usr/bin/env python3
 
 import argparse
+import codecs
 import configparser
 import datetime
-import feedparser
+import hashlib
 import html
+import html.parser
 import httpx
+import io
+import json
 import os
 import re
 import sqlite3
+import tempfile
+import threading
 import time
-
-import lxml.html
-
-from atproto import Client, client_utils, models
-from lxml.html.clean import Cleaner
+import urllib.parse
 
 def tprint(*args, **kwargs):
     timestamp = datetime.datetime.now(datetime.timezone.utc).strftime('[%Y-%m-%dT%H:%M:%SZ]')
-    print(timestamp, *args, **kwargs)
 
+    # Platforms run concurrently by feed2social.py, tell their lines apart.
+    name = threading.current_thread().name
+    if name != 'MainThread':
+        timestamp += ' [{}]'.format(name)
 
-def fetch_og_metadata(url):
-    """Fetch Open Graph metadata from a URL.
-    Returns dict with keys: title, description, image_url (any can be None).
+    # One write per line, so lines of other threads do not end up inside.
+    sep = kwargs.pop('sep', ' ')
+    end = kwargs.pop('end', '\n')
+    print(sep.join(str(arg) for arg in (timestamp, ) + args) + end, end='', **kwargs)
+
+
+# Schema migrations of the sqlite3 state, applied in order by open_db().  The
+# current version is kept in "PRAGMA user_version".
+MIGRATIONS = [
+    # 1: entry table with unique entry_id, replacing the hand-created table
+    # without any index (duplicated rows are dropped first).
+    [
+        'CREATE TABLE IF NOT EXISTS entry (entry_id VARCHAR, created_at INT);',
+        'DELETE FROM entry WHERE rowid NOT IN (SELECT MIN(rowid) FROM entry GROUP BY entry_id);',
+        'CREATE UNIQUE INDEX IF NOT EXISTS entry_entry_id ON entry (entry_id);',
+    ],
+    # 2: feed validators for conditional GET.
+    [
+        'CREATE TABLE IF NOT EXISTS feed (feed_url VARCHAR PRIMARY KEY, etag VARCHAR, modified VARCHAR, digest VARCHAR, updated_at INT);',
+    ],
+    # 3: key everything by platform, so one database can be shared by all
+    # platforms.  Existing rows belong to the platform opening the file.
+    [
+        'CREATE TABLE entry_new (platform VARCHAR NOT NULL, entry_id VARCHAR NOT NULL, created_at INT, PRIMARY KEY (platform, entry_id));',
+        'INSERT OR IGNORE INTO entry_new (platform, entry_id, created_at) SELECT :platform, entry_id, created_at FROM entry;',
+        'DROP TABLE entry;',
+        'ALTER TABLE entry_new RENAME TO entry;',
+        'CREATE TABLE feed_new (platform VARCHAR NOT NULL, feed_url VARCHAR NOT NULL, etag VARCHAR, modified VARCHAR, digest VARCHAR, updated_at INT, PRIMARY KEY (platform, feed_url));',
+        'INSERT INTO feed_new (platform, feed_url, etag, modified, digest, updated_at) SELECT :platform, feed_url, etag, modified, digest, updated_at FROM feed;',
+        'DROP TABLE feed;',
+        'ALTER TABLE feed_new RENAME TO feed;',
+    ],
+    # 4: rate limit windows reported by the platforms.
+    [
+        'CREATE TABLE rate_limit (platform VARCHAR NOT NULL, endpoint VARCHAR NOT NULL, rate_limit INT, remaining INT, reset_at INT, updated_at INT, PRIMARY KEY (platform, endpoint));',
+    ],
+    # 5: token buckets pacing the posts of the platforms.
+    [
+        'CREATE TABLE token_bucket (platform VARCHAR PRIMARY KEY, tokens REAL, updated_at REAL, blocked_until REAL);',
+    ],
+    # 6: Open Graph metadata of links, by normalized URL.
+    [
+        'CREATE TABLE og (url VARCHAR PRIMARY KEY, title VARCHAR, description VARCHAR, image_url VARCHAR, thumb VARCHAR, thumb_owner VARCHAR, etag VARCHAR, modified VARCHAR, ok INT, fetched_at INT, expires_at INT);',
+    ],
+    # 7: outbox of the posts and their "Sync from" replies.
+    [
+        'CREATE TABLE outbox (id INTEGER PRIMARY KEY AUTOINCREMENT, platform VARCHAR NOT NULL, entry_id VARCHAR NOT NULL, kind VARCHAR NOT NULL, payload VARCHAR, state VARCHAR NOT NULL, attempts INT, next_at REAL, error VARCHAR, created_at INT, updated_at INT, UNIQUE (platform, entry_id, kind));',
+        'CREATE INDEX outbox_due ON outbox (platform, kind, state, next_at);',
+    ],
+    # 8: last maintenance of the platforms.
+    [
+        'CREATE TABLE maintenance (platform VARCHAR PRIMARY KEY, done_at INT);',
+    ],
+]
+
+
+def hash_entry_id(entry_id):
+    """Fixed-width (16 bytes) key of entry_id, stored in the entry table
+    instead of the id itself with "hash_entry_ids = true".
+    """
+    return hashlib.sha256(entry_id.encode('utf-8')).digest()[:16]
+
+
+def entry_key(config, entry_id):
+    """Key of entry_id to store in the entry table.  Lookups match both
+    forms, so the setting can be changed at any time.
+    """
+    if config['default'].getboolean('hash_entry_ids', False):
+        return hash_entry_id(entry_id)
+    return entry_id
+
+
+def open_db(f_db, platform):
+    s = sqlite3.connect(f_db, timeout=30.0)
+    s.create_function('hash_entry_id', 1, hash_entry_id, deterministic=True)
+
+    # WAL lets platforms running at the same time read and write without
+    # blocking each other.
+    s.execute('PRAGMA journal_mode = WAL;')
+    s.execute('PRAGMA synchronous = NORMAL;')
+
+    version = s.execute('PRAGMA user_version;').fetchone()[0]
+    if version < len(MIGRATIONS):
+        s.execute('BEGIN IMMEDIATE;')
+
+        # Another process may have migrated it in the meantime.
+        version = s.execute('PRAGMA user_version;').fetchone()[0]
+        for i in range(version, len(MIGRATIONS)):
+            tprint('* Migrating {} to version {}'.format(f_db, i + 1))
+            for sql in MIGRATIONS[i]:
+                s.execute(sql, {'platform': platform})
+            s.execute('PRAGMA user_version = {};'.format(i + 1))
+
+        s.commit()
+
+    return s
+
+
+def open_state(config, platform, f_db):
+    """Open the state of platform, which is f_db, or the database shared by all
+    platforms if "state_db" is set in config.ini.  When switching to the shared
+    database, the entries, feed validators, outbox and rate budgets in f_db
+    are imported.
+
+    The entries of files from before accounts belong to the platform itself
+    ("bluesky" for "bluesky:acme"), so they are migrated and imported under
+    that key, and a new account starts without any synced entries.
+    """
+    owner = platform.partition(':')[0]
+
+    f_shared = config['default'].get('state_db')
+    if not f_shared:
+        return open_db(f_db, owner)
+
+    f_shared = os.path.expanduser(f_shared)
+    s = open_db(f_shared, owner)
+
+    if os.path.exists(f_db) and not os.path.samefile(f_db, f_shared) and s.execute('SELECT 1 FROM entry WHERE platform = ? LIMIT 1;', (owner, )).fetchone() is None:
+        tprint('* Importing {} into {}'.format(f_db, f_shared))
+
+        # Bring the old file to the current schema first.
+        open_db(f_db, owner).close()
+
+        s.execute('ATTACH DATABASE ? AS old;', (f_db, ))
+        s.execute('INSERT OR IGNORE INTO entry (platform, entry_id, created_at) SELECT platform, entry_id, created_at FROM old.entry;')
+        s.execute('INSERT OR IGNORE INTO feed (platform, feed_url, etag, modified, digest, updated_at) SELECT platform, feed_url, etag, modified, digest, updated_at FROM old.feed;')
+        s.execute('INSERT OR IGNORE INTO rate_limit (platform, endpoint, rate_limit, remaining, reset_at, updated_at) SELECT platform, endpoint, rate_limit, remaining, reset_at, updated_at FROM old.rate_limit;')
+        s.execute('INSERT OR IGNORE INTO token_bucket (platform, tokens, updated_at, blocked_until) SELECT platform, tokens, updated_at, blocked_until FROM old.token_bucket;')
+        # The ids are given anew, the jobs are told apart by (platform,
+        # entry_id, kind).
+        s.execute('INSERT OR IGNORE INTO outbox (platform, entry_id, kind, payload, state, attempts, next_at, error, created_at, updated_at) SELECT platform, entry_id, kind, payload, state, attempts, next_at, error, created_at, updated_at FROM old.outbox;')
+        s.commit()
+        s.execute('DETACH DATABASE old;')
+
+    return s
+
+
+def select_seen(s, platform, entry_ids):
+    """Return the set of entry_ids already in the entry table of platform,
+    stored as they are or hashed.
+    """
+    keys = {}
+    for entry_id in entry_ids:
+        keys[entry_id] = entry_id
+        keys[hash_entry_id(entry_id)] = entry_id
+    keys_list = list(keys)
+    seen = set()
+
+    c = s.cursor()
+
+    # Keep under SQLite's limit of host parameters per statement.
+    for i in range(0, len(keys_list), 500):
+        chunk = keys_list[i:i + 500]
+        c.execute('SELECT entry_id FROM entry WHERE platform = ? AND entry_id IN ({});'.format(','.join('?' * len(chunk))), [platform] + chunk)
+        seen.update(keys[row[0]] for row in c.fetchall())
+
+    return seen
+
+
+def entries_unseen(s, platform, items):
+    """Yield the entries not in the entry table of platform yet, oldest first."""
+    items = list(reversed(items))
+    seen = select_seen(s, platform, [item['id'] for item in items])
+
+    for item in items:
+        if item['id'] in seen:
+            continue
+        seen.add(item['id'])
+        yield item
+
+
+def maintenance_due(s, config, platform):
+    """Whether maintain() has not run for platform in "maintenance_interval"
+    hours (24 by default, 0 to only run it by hand).
+    """
+    interval = config['default'].getfloat('maintenance_interval', 24.0)
+    if interval <= 0:
+        return False
+
+    row = s.execute('SELECT done_at FROM maintenance WHERE platform = ?;', (platform, )).fetchone()
+    return row is None or row[0] + interval * 3600 <= time.time()
+
+
+def maintain(s, config, windows):
+    """Keep the state small for long-lived installs.  windows maps platforms
+    to the entry ids in their feeds (None if unknown).  Entries older than
+    "retention_days" (365 by default, 0 to keep them forever) and not in the
+    feeds any more are pruned, along with the outbox jobs finished a week ago
+    and the Open Graph metadata older than the horizon.  With
+    "hash_entry_ids = true", the stored entry ids are replaced by their
+    hashes.  The freed pages are then given back to the file system.
+    """
+    c = config['default']
+    now = int(time.time())
+    retention = c.getfloat('retention_days', 365.0)
+    horizon = now - retention * 86400
+
+    for platform, entry_ids in windows.items():
+        # Without the feed, an old entry still in it would be posted again.
+        if retention > 0 and entry_ids:
+            res = s.execute('DELETE FROM entry WHERE platform = :platform AND created_at < :horizon AND entry_id NOT IN (SELECT value FROM json_each(:ids) UNION ALL SELECT hash_entry_id(value) FROM json_each(:ids));', {'platform': platform, 'horizon': horizon, 'ids': json.dumps(entry_ids)})
+            tprint('* Maintenance of {}: {} entries pruned'.format(platform, res.rowcount))
+
+        s.execute("DELETE FROM outbox WHERE platform = ? AND state IN ('done', 'failed') AND updated_at < ?;", (platform, now - 7 * 86400))
+
+        if c.getboolean('hash_entry_ids', False):
+            s.execute("UPDATE OR IGNORE entry SET entry_id = hash_entry_id(entry_id) WHERE platform = ? AND typeof(entry_id) = 'text';", (platform, ))
+            # Left are the ids stored in both forms.
+            s.execute("DELETE FROM entry WHERE platform = ? AND typeof(entry_id) = 'text';", (platform, ))
+
+        s.execute('INSERT OR REPLACE INTO maintenance (platform, done_at) VALUES (?, ?);', (platform, now))
+
+    if retention > 0:
+        s.execute('DELETE FROM og WHERE fetched_at < ?;', (horizon, ))
+    s.commit()
+
+    # Incremental vacuum needs one full VACUUM to be turned on.  It needs the
+    # file to itself, so with another run in the middle of a write it is left
+    # to the next maintenance, the pruning above is kept anyway.
+    try:
+        if s.execute('PRAGMA auto_vacuum;').fetchone()[0] != 2:
+            tprint('* Maintenance: turning on incremental vacuum')
+            s.execute('PRAGMA auto_vacuum = INCREMENTAL;')
+            s.execute('VACUUM;')
+        s.execute('PRAGMA incremental_vacuum;').fetchall()
+        s.execute('ANALYZE;')
+        s.execute('PRAGMA optimize;')
+        s.execute('PRAGMA wal_checkpoint(TRUNCATE);').fetchall()
+    except sqlite3.OperationalError as e:
+        tprint('* Maintenance: skipping VACUUM until the next time: {}'.format(e))
+
+
+def entries_not_opted_out(items, tag):
+    """Skip the entries with the opt-out tag (e.g. "#nobluesky") by scanning the
+    raw description.  Mastodon marks up hashtags as "#<span>tag</span>", so
+    tags between "#" and the name are allowed.
+    """
+    pattern = re.compile('#(?:<[^>]*>)*' + re.escape(tag.lstrip('#')))
+
+    for item in items:
+        if pattern.search(item.get('description', '')):
+            tprint('* Skipping {}: {}'.format(item['id'], tag))
+            continue
+        yield item
+
+
+class TextRenderer(html.parser.HTMLParser):
+    """Render HTML into plain text in a single pass.  Paragraphs are separated
+    by an empty line, <br> and list items start a new line, and all other tags
+    are dropped with their text kept.  Rendering stops as soon as limit chars
+    have been emitted.
+    """
+    PARAGRAPH_TAGS = {'blockquote', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'ol', 'p', 'pre', 'ul'}
+    LINE_TAGS = {'div', 'li', 'tr'}
+    SKIP_TAGS = {'script', 'style', 'template'}
+
+    class Full(Exception):
+        pass
+
+    def __init__(self, limit=None):
+        super().__init__(convert_charrefs=True)
+        self.limit = limit
+        self.parts = []
+        self.length = 0
+        self.newlines = 0
+        self.skip = 0
+
+    def break_line(self, n):
+        self.newlines = max(self.newlines, n)
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.SKIP_TAGS:
+            self.skip += 1
+        elif tag == 'br':
+            self.newlines += 1
+        elif tag in self.PARAGRAPH_TAGS:
+            self.break_line(2)
+        elif tag in self.LINE_TAGS:
+            self.break_line(1)
+
+    def handle_endtag(self, tag):
+        if tag in self.SKIP_TAGS:
+            self.skip = max(self.skip - 1, 0)
+        elif tag in self.PARAGRAPH_TAGS:
+            self.break_line(2)
+        elif tag in self.LINE_TAGS:
+            self.break_line(1)
+
+    def handle_data(self, data):
+        if self.skip:
+            return
+
+        if self.length == 0 or self.newlines:
+            # Nothing emitted yet or at the start of a block, so the
+            # whitespace indenting the markup is trimmed, and runs of breaks
+            # are kept to one empty line.
+            data = data.lstrip()
+            if not data:
+                return
+            if self.length:
+                last = self.parts[-1].rstrip()
+                self.length -= len(self.parts[-1]) - len(last)
+                self.parts[-1] = last
+                data = '\n' * min(self.newlines, 2) + data
+        self.newlines = 0
+
+        self.parts.append(data)
+        self.length += len(data)
+        if self.limit is not None and self.length >= self.limit:
+            raise self.Full()
+
+    def text(self):
+        return ''.join(self.parts)[:self.limit].rstrip()
+
+
+def html_to_text(body, limit=None):
+    """Render HTML body into plain text of at most limit chars."""
+    r = TextRenderer(limit)
+    try:
+        r.feed(body)
+        r.close()
+    except TextRenderer.Full:
+        pass
+    return r.text()
+
+
+IMAGE_SIGNATURES = [
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'GIF87a', 'image/gif'),
+    (b'GIF89a', 'image/gif'),
+]
+
+
+def detect_image_type(data):
+    """Return the content type of image data from its magic bytes, as servers
+    often send the wrong one, or None if unknown."""
+    for signature, content_type in IMAGE_SIGNATURES:
+        if data.startswith(signature):
+            return content_type
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'image/webp'
+    return None
+
+
+def encode_image(img, fmt, **kwargs):
+    out = io.BytesIO()
+    img.save(out, fmt, **kwargs)
+    return out.getvalue()
+
+
+def transform_image(data, max_dimension, max_bytes):
+    """Downscale image data to fit in max_dimension x max_dimension pixels and
+    re-encode it under max_bytes, with the highest JPEG quality that fits and
+    without metadata (EXIF, XMP).  Images within the limits and without
+    metadata, animations, and anything Pillow (if installed at all) cannot
+    open are returned as they are.  Returns (data, content_type).
     """
+    content_type = detect_image_type(data)
+    try:
+        from PIL import Image, ImageOps
+    except ImportError:
+        return data, content_type
+
     try:
-        res = httpx.get(url, timeout=15.0, follow_redirects=True)
-        res.raise_for_status()
-        doc = lxml.html.fromstring(res.text)
+        img = Image.open(io.BytesIO(data))
+        if getattr(img, 'is_animated', False):
+            return data, content_type
+
+        has_metadata = bool(img.getexif()) or 'xmp' in img.info or 'XML:com.adobe.xmp' in img.info
+        if max(img.size) <= max_dimension and len(data) <= max_bytes and not has_metadata:
+            return data, content_type
+
+        # Apply the EXIF orientation before it is dropped.
+        img = ImageOps.exif_transpose(img)
+        icc_profile = img.info.get('icc_profile')
+        img.thumbnail((max_dimension, max_dimension), Image.LANCZOS)
+
+        if img.mode in ('RGBA', 'LA', 'P') and content_type == 'image/png':
+            # Keep transparency if it fits.
+            out = encode_image(img, 'PNG', optimize=True, icc_profile=icc_profile)
+            if len(out) <= max_bytes:
+                return out, 'image/png'
+
+        if img.mode != 'RGB':
+            background = Image.new('RGB', img.size, (255, 255, 255))
+            img = img.convert('RGBA')
+            background.paste(img, mask=img.getchannel('A'))
+            img = background
+
+        while True:
+            # Binary search for the highest quality under max_bytes.
+            best = None
+            lo, hi = 40, 90
+            while lo <= hi:
+                quality = (lo + hi) // 2
+                out = encode_image(img, 'JPEG', quality=quality, optimize=True, progressive=True, icc_profile=icc_profile)
+                if len(out) <= max_bytes:
+                    best = out
+                    lo = quality + 1
+                else:
+                    hi = quality - 1
+
+            if best is not None:
+                tprint('* Image transformed: {} -> {} bytes, {}x{}'.format(len(data), len(best), img.width, img.height))
+                return best, 'image/jpeg'
+
+            # Still too large at the lowest quality.
+            img = img.resize((max(img.width * 3 // 4, 1), max(img.height * 3 // 4, 1)), Image.LANCZOS)
+    except Exception as e:
+        tprint('* Exception transforming image: {}'.format(e))
+        return data, content_type
+
+
+class MediaCache(object):
+    """Content-addressed cache of downloaded media, shared by all platforms
+    (and by concurrent runs).  For every URL, "<sha256 of url>.json" keeps the
+    validators and the sha256 of the content, which is stored in
+    "<sha256 of content>.blob".  Files are written to a temporary file and
+    renamed into place, and the least recently used ones are evicted when the
+    cache grows over max_size bytes or gets older than max_age seconds.
+    Downloads larger than max_download bytes are refused.
+    """
+
+    def __init__(self, http, path, max_size=256 * 1024 * 1024, max_age=7 * 86400, max_download=64 * 1024 * 1024):
+        self.http = http
+        self.path = path
+        self.max_size = max_size
+        self.max_age = max_age
+        self.max_download = max_download
+        os.makedirs(path, exist_ok=True)
+
+    @classmethod
+    def from_config(cls, config, http):
+        cache_home = os.environ.get('XDG_CACHE_HOME') or '{}/.cache'.format(os.environ['HOME'])
+        c = config['default']
+        return cls(
+            http,
+            os.path.expanduser(c.get('media_cache_dir', '{}/feed2social/media'.format(cache_home))),
+            max_size=int(c.get('media_cache_max_size', 256)) * 1024 * 1024,
+            max_age=int(c.get('media_cache_max_age', 7)) * 86400,
+            max_download=int(c.get('media_max_download', 64)) * 1024 * 1024,
+        )
+
+    def write(self, f, data):
+        fd, tmp_path = tempfile.mkstemp(dir=self.path, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as tmp_file:
+                tmp_file.write(data)
+            os.replace(tmp_path, f)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def read(self, f):
+        with open(f, 'rb') as fh:
+            data = fh.read()
+        # Keep mtime as the last access time for LRU eviction.
+        os.utime(f)
+        return data
+
+    def get(self, url, timeout=30.0):
+        """Return (content, content_type) of url, downloading it if needed."""
+        f_blob, content_type = self.get_file(url, timeout=timeout)
+        return self.read(f_blob), content_type
+
+    def get_file(self, url, timeout=30.0):
+        """Return (path, content_type) of the cached content of url,
+        downloading it if needed.  The download is streamed to disk, and
+        aborted once it gets larger than max_download bytes.
+        """
+        f_meta = os.path.join(self.path, hashlib.sha256(url.encode()).hexdigest() + '.json')
+
+        meta = None
+        try:
+            with open(f_meta) as fh:
+                meta = json.load(fh)
+        except (OSError, ValueError):
+            pass
+
+        headers = {}
+        if meta:
+            f_blob = os.path.join(self.path, meta['digest'] + '.blob')
+            if not os.path.exists(f_blob):
+                # Evicted by another run.
+                meta = None
+            elif time.time() - meta['fetched_at'] < self.max_age:
+                tprint('* Media cache hit: {}'.format(url))
+                os.utime(f_blob)
+                return f_blob, meta['content_type']
+            else:
+                if meta.get('etag'):
+                    headers['If-None-Match'] = meta['etag']
+                if meta.get('modified'):
+                    headers['If-Modified-Since'] = meta['modified']
+
+        with self.http.stream('GET', url, headers=headers, timeout=timeout, follow_redirects=True) as res:
+            if meta and res.status_code == 304:
+                meta['fetched_at'] = int(time.time())
+                self.write(f_meta, json.dumps(meta).encode())
+                tprint('* Media cache revalidated: {}'.format(url))
+                os.utime(f_blob)
+                return f_blob, meta['content_type']
+            res.raise_for_status()
 
-        og_title = None
-        og_description = None
-        og_image = None
+            if int(res.headers.get('Content-Length') or 0) > self.max_download:
+                raise ValueError('{} is larger than {} bytes'.format(url, self.max_download))
 
-        el = doc.xpath('//meta[@property="og:title"]/@content')
-        if el:
-            og_title = el[0]
+            h = hashlib.sha256()
+            size = 0
+            fd, tmp_path = tempfile.mkstemp(dir=self.path, prefix='.tmp-')
+            try:
+                with os.fdopen(fd, 'wb') as tmp_file:
+                    for chunk in res.iter_bytes():
+                        size += len(chunk)
+                        if size > self.max_download:
+                            raise ValueError('{} is larger than {} bytes'.format(url, self.max_download))
+                        h.update(chunk)
+                        tmp_file.write(chunk)
+
+                f_blob = os.path.join(self.path, h.hexdigest() + '.blob')
+                os.replace(tmp_path, f_blob)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+
+        meta = {
+            'url': url,
+            'etag': res.headers.get('ETag'),
+            'modified': res.headers.get('Last-Modified'),
+            'content_type': res.headers.get('Content-Type', '').split(';')[0].strip(),
+            'digest': h.hexdigest(),
+            'fetched_at': int(time.time()),
+        }
+        self.write(f_meta, json.dumps(meta).encode())
+
+        self.evict(keep=f_blob)
+        return f_blob, meta['content_type']
+
+    def get_image(self, url, max_dimension, max_bytes, timeout=30.0):
+        """Return (content, content_type) of the image at url, transformed by
+        transform_image() to the given limits.  Variants are cached next to
+        the original, so every platform transforms an image only once.
+        """
+        data, content_type = self.get(url, timeout=timeout)
+
+        f_variant = os.path.join(self.path, '{}-{}-{}.variant'.format(hashlib.sha256(data).hexdigest(), max_dimension, max_bytes))
+        try:
+            variant = self.read(f_variant)
+            tprint('* Media cache hit: {} ({}px, {} bytes)'.format(url, max_dimension, max_bytes))
+            return variant, detect_image_type(variant)
+        except FileNotFoundError:
+            pass
+
+        variant, variant_type = transform_image(data, max_dimension, max_bytes)
+        if variant is data:
+            return data, variant_type or content_type
+
+        self.write(f_variant, variant)
+        return variant, variant_type
 
-        el = doc.xpath('//meta[@property="og:description"]/@content')
-        if el:
-            og_description = el[0]
+    def evict(self, keep=None):
+        """Evict the least recently used files, but never keep (the file just
+        downloaded) or the downloads of other runs in progress.  Temporary
+        files left by crashed runs are removed after an hour.
+        """
+        now = time.time()
+        files = []
+        for entry in os.scandir(self.path):
+            if entry.name.startswith('.tmp-'):
+                # Downloads in progress are written to at least every read
+                # timeout (30 seconds), so an hour old one is abandoned.
+                try:
+                    if now - entry.stat().st_mtime > 3600:
+                        os.unlink(entry.path)
+                except FileNotFoundError:
+                    pass
+                continue
+            try:
+                st = entry.stat()
+            except FileNotFoundError:
+                continue
+            files.append((st.st_mtime, st.st_size, entry.path))
+
+        # Oldest first, drop until both limits are met.
+        files.sort()
+        total = sum(size for _, size, _ in files)
+        for mtime, size, f in files:
+            if total <= self.max_size and now - mtime <= self.max_age:
+                break
+            if f == keep:
+                continue
+            try:
+                os.unlink(f)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+
+def new_http_client(config):
+    """Create the long-lived httpx.Client of a platform, shared by the feed,
+    media, upload, post and reply requests so connections are kept alive.
+    HTTP/2 is enabled by "http2 = true" in config.ini.
+    """
+    return httpx.Client(
+        http2=config['default'].getboolean('http2', False),
+        timeout=httpx.Timeout(30.0, connect=10.0, pool=10.0),
+        limits=httpx.Limits(max_connections=10, max_keepalive_connections=5, keepalive_expiry=60.0),
+    )
 
-        el = doc.xpath('//meta[@property="og:image"]/@content')
-        if el:
-            og_image = el[0]
 
-        # Fallback to <title> and <meta name="description">
-        if not og_title:
-            el = doc.xpath('//title/text()')
-            if el:
-                og_title = el[0]
+def fetch_feed(http, s, platform, feed_url):
+    """Fetch and parse the feed with conditional GET.
+    Returns (feed, state), feed is None if the feed has not been changed since
+    the state saved by save_feed_state().
+    """
+    c = s.cursor()
+    c.execute('SELECT etag, modified, digest FROM feed WHERE platform = ? AND feed_url = ?;', (platform, feed_url))
+    row = c.fetchone()
+    etag, modified, digest = row if row else (None, None, None)
+
+    headers = {}
+    if etag:
+        headers['If-None-Match'] = etag
+    if modified:
+        headers['If-Modified-Since'] = modified
+
+    # httpx asks for gzip (and brotli when available) by itself.
+    res = http.get(feed_url, headers=headers, timeout=30.0, follow_redirects=True)
+    tprint('* Fetch feed: res = {}'.format(res))
+    if res.status_code == 304:
+        return None, None
+    res.raise_for_status()
+
+    state = (res.headers.get('ETag'), res.headers.get('Last-Modified'), hashlib.sha256(res.content).hexdigest())
+    if state[2] == digest:
+        # Same content, only keep the latest validators.
+        save_feed_state(s, platform, feed_url, state)
+        return None, state
+
+    # feedparser is only needed (and imported) when the feed has changed.
+    import feedparser
+    return feedparser.parse(res.content, response_headers=dict(res.headers)), state
+
+
+def save_feed_state(s, platform, feed_url, state):
+    etag, modified, digest = state
+    s.execute('INSERT OR REPLACE INTO feed (platform, feed_url, etag, modified, digest, updated_at) VALUES (?, ?, ?, ?, ?, ?);', (platform, feed_url, etag, modified, digest, int(time.time())))
+    s.commit()
+
+
+class RateLimited(Exception):
+    """Raised by the senders of Outbox.drain() to stop posting for this run,
+    leaving the job for a later run without counting it as a failure.
+    """
+
+
+class Outbox(object):
+    """Durable queue of the posts of a platform, kept in the outbox table.
+    Jobs are "pending" until done, retried with exponential backoff when they
+    fail, and "failed" after max_attempts.  A claimed job is "running" for
+    lease seconds, after which it is picked up again, so a crash in the
+    middle of a post does not lose it (but may post it twice).
+    """
+
+    def __init__(self, platform, max_attempts=8, backoff=60.0, max_backoff=6 * 3600.0, lease=600.0):
+        self.platform = platform
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.lease = lease
+
+    @classmethod
+    def from_config(cls, config, platform):
+        c = config['default']
+        return cls(
+            platform,
+            max_attempts=c.getint('outbox_max_attempts', 8),
+            backoff=c.getfloat('outbox_backoff', 60.0),
+            max_backoff=c.getfloat('outbox_max_backoff', 6 * 3600.0),
+        )
+
+    def add(self, s, entry_id, kind, payload):
+        """Queue a job, in the transaction of the caller (committed along with
+        the entry, so an entry is either queued or not seen at all).
+        """
+        now = time.time()
+        s.execute('INSERT OR IGNORE INTO outbox (platform, entry_id, kind, payload, state, attempts, next_at, created_at, updated_at) VALUES (?, ?, ?, ?, ?, 0, ?, ?, ?);', (self.platform, entry_id, kind, json.dumps(payload), 'pending', now, int(now), int(now)))
 
-        if not og_description:
-            el = doc.xpath('//meta[@name="description"]/@content')
-            if el:
-                og_description = el[0]
+    def claim(self, s, kind):
+        """Take the oldest due job of kind, or None.  Returns the payload with
+        "id", "entry_id" and "attempts" of the job added.
+        """
+        s.execute('BEGIN IMMEDIATE;')
+        now = time.time()
+        row = s.execute("SELECT id, entry_id, payload, attempts FROM outbox WHERE platform = ? AND kind = ? AND state IN ('pending', 'running') AND next_at <= ? ORDER BY id LIMIT 1;", (self.platform, kind, now)).fetchone()
+        if row is None:
+            s.commit()
+            return None
 
+        s.execute("UPDATE outbox SET state = 'running', next_at = ?, updated_at = ? WHERE id = ?;", (now + self.lease, int(now), row[0]))
+        s.commit()
+
+        job = json.loads(row[2])
+        job.update({'id': row[0], 'entry_id': row[1], 'attempts': row[3]})
+        return job
+
+    def done(self, s, job, reply=None):
+        """Mark job done, and queue reply (the payload of its "Sync from"
+        reply) in the same transaction.
+        """
+        s.execute("UPDATE outbox SET state = 'done', error = NULL, updated_at = ? WHERE id = ?;", (int(time.time()), job['id']))
+        if reply is not None:
+            self.add(s, job['entry_id'], 'reply', reply)
+        s.commit()
+
+    def retry(self, s, job, error):
+        """Count a failed attempt of job, and retry it later or give up."""
+        attempts = job['attempts'] + 1
+        now = time.time()
+        if attempts >= self.max_attempts:
+            tprint('* Giving up {} of {} after {} attempts: {}'.format(job['id'], job['entry_id'], attempts, error))
+            s.execute("UPDATE outbox SET state = 'failed', attempts = ?, error = ?, updated_at = ? WHERE id = ?;", (attempts, error, int(now), job['id']))
+        else:
+            delay = min(self.backoff * 2 ** (attempts - 1), self.max_backoff)
+            tprint('* Retrying {} of {} in {:.0f} seconds: {}'.format(job['id'], job['entry_id'], delay, error))
+            s.execute("UPDATE outbox SET state = 'pending', attempts = ?, next_at = ?, error = ?, updated_at = ? WHERE id = ?;", (attempts, now + delay, error, int(now), job['id']))
+        s.commit()
+
+    def release(self, s, job):
+        """Put job back as it was, e.g. when rate limited."""
+        now = time.time()
+        s.execute("UPDATE outbox SET state = 'pending', next_at = ?, updated_at = ? WHERE id = ?;", (now, int(now), job['id']))
+        s.commit()
+
+    def drain(self, s, senders):
+        """Run the due jobs with senders, a list of (kind, send) in priority
+        order, so every main post goes out before the replies.  send(s, job)
+        returns the payload of the reply to queue (a dict) or True when done,
+        None when failed.  Returns False if stopped by RateLimited.
+        """
+        for kind, send in senders:
+            while True:
+                job = self.claim(s, kind)
+                if job is None:
+                    break
+
+                tprint('* Outbox: {} of {} (attempt {})'.format(kind, job['entry_id'], job['attempts'] + 1))
+                try:
+                    res = send(s, job)
+                except RateLimited:
+                    self.release(s, job)
+                    return False
+                except Exception as e:
+                    s.rollback()
+                    self.retry(s, job, repr(e))
+                    continue
+
+                if res is None:
+                    self.retry(s, job, 'failed')
+                else:
+                    self.done(s, job, res if isinstance(res, dict) else None)
+        return True
+
+
+class TokenBucket(object):
+    """Token bucket pacing the posts of a platform: up to burst posts at once,
+    refilled at rate posts per minute.  The bucket is kept in the token_bucket
+    table, so the pace carries over from one run to the next, and a server
+    asking to back off (Retry-After) holds every run until then.
+    """
+
+    def __init__(self, platform, rate, burst, max_wait=60.0):
+        self.platform = platform
+        self.rate = rate
+        self.burst = burst
+        self.max_wait = max_wait
+
+    @classmethod
+    def from_config(cls, config, platform, rate, burst, name=None):
+        # Accounts share the settings of the platform (overridden in their own
+        # section), but each one has its own bucket, kept under name.
+        c = config['default']
+        return cls(
+            name or platform,
+            c.getfloat('{}_rate'.format(platform), rate),
+            c.getfloat('{}_burst'.format(platform), burst),
+            max_wait=c.getfloat('{}_max_wait'.format(platform), 60.0),
+        )
+
+    def acquire(self, s):
+        """Take a token, sleeping for it if it comes within max_wait seconds.
+        Returns False if it does not, so the post is left for a later run.
+        """
+        while True:
+            s.execute('BEGIN IMMEDIATE;')
+            now = time.time()
+            row = s.execute('SELECT tokens, updated_at, blocked_until FROM token_bucket WHERE platform = ?;', (self.platform, )).fetchone()
+            if row is None:
+                tokens, blocked_until = self.burst, 0.0
+            else:
+                tokens = min(self.burst, row[0] + max(now - row[1], 0.0) * self.rate / 60.0)
+                blocked_until = row[2] or 0.0
+
+            if blocked_until > now:
+                wait = blocked_until - now
+            elif tokens >= 1:
+                s.execute('INSERT OR REPLACE INTO token_bucket (platform, tokens, updated_at, blocked_until) VALUES (?, ?, ?, ?);', (self.platform, tokens - 1, now, blocked_until))
+                s.commit()
+                return True
+            else:
+                wait = (1 - tokens) * 60.0 / self.rate
+            s.rollback()
+
+            if wait > self.max_wait:
+                tprint('* Rate limit of {}: next post at {} (local time)'.format(self.platform, datetime.datetime.fromtimestamp(now + wait)))
+                return False
+
+            tprint('* Rate limit of {}: waiting {:.1f} seconds'.format(self.platform, wait))
+            time.sleep(wait)
+
+    def defer(self, s, seconds):
+        """Hold all posts for seconds, and restart with an empty bucket."""
+        tprint('* Rate limited by {}, holding posts for {:.0f} seconds'.format(self.platform, seconds))
+        now = time.time()
+        s.execute('INSERT OR REPLACE INTO token_bucket (platform, tokens, updated_at, blocked_until) VALUES (?, 0, ?, ?);', (self.platform, now, now + seconds))
+        s.commit()
+
+
+def retry_after(headers, default=300.0):
+    """Seconds to back off from the Retry-After (seconds or HTTP date) or
+    RateLimit-Reset (epoch seconds) header, or default without them.
+    """
+    headers = {k.lower(): v for k, v in (headers or {}).items()}
+
+    value = headers.get('retry-after')
+    if value:
+        try:
+            return max(float(value), 0.0)
+        except ValueError:
+            import email.utils
+            try:
+                return max(email.utils.parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+            except (TypeError, ValueError):
+                pass
+
+    value = headers.get('ratelimit-reset')
+    if value:
+        try:
+            return max(float(value) - time.time(), 0.0)
+        except ValueError:
+            pass
+
+    return default
+
+
+class MetaParser(html.parser.HTMLParser):
+    """Collect the Open Graph metadata of a page, with <title> and
+    <meta name="description"> as fallback.  Fed incrementally, and raises Done
+    at the end of <head>, as the metadata never comes after it.
+    """
+    META = {
+        'og:title': 'title',
+        'og:description': 'description',
+        'og:image': 'image_url',
+        'description': 'fallback_description',
+    }
+
+    class Done(Exception):
+        pass
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.meta = {}
+        self.title = None
+        self.in_title = False
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'meta':
+            attrs = dict(attrs)
+            key = self.META.get(attrs.get('property') or attrs.get('name'))
+            if key and attrs.get('content') is not None:
+                self.meta.setdefault(key, attrs['content'])
+        elif tag == 'title':
+            self.in_title = self.title is None
+        elif tag == 'body':
+            raise self.Done()
+
+    def handle_endtag(self, tag):
+        if tag == 'title':
+            self.in_title = False
+        elif tag == 'head':
+            raise self.Done()
+
+    def handle_data(self, data):
+        if self.in_title:
+            self.title = (self.title or '') + data
+
+    def og_metadata(self):
         return {
-            'title': og_title,
-            'description': og_description,
-            'image_url': og_image,
+            'title': self.meta.get('title') or self.title,
+            'description': self.meta.get('description') or self.meta.get('fallback_description'),
+            'image_url': self.meta.get('image_url'),
         }
+
+
+def fetch_og_metadata(http, url, etag=None, modified=None, max_bytes=512 * 1024):
+    """Fetch Open Graph metadata from a URL.
+    Returns dict with keys: title, description, image_url (any can be None),
+    plus etag and modified for revalidation, {} on failure, or None if not
+    modified since etag/modified.  Only <head> is read, streamed up to
+    max_bytes, and non-HTML is skipped.
+    """
+    headers = {}
+    if etag:
+        headers['If-None-Match'] = etag
+    if modified:
+        headers['If-Modified-Since'] = modified
+
+    try:
+        with http.stream('GET', url, headers=headers, timeout=15.0, follow_redirects=True) as res:
+            if res.status_code == 304:
+                return None
+            res.raise_for_status()
+
+            content_type = res.headers.get('Content-Type', '').split(';')[0].strip().lower()
+            if content_type not in ('text/html', 'application/xhtml+xml'):
+                tprint('* Skipping OG metadata of {}: {}'.format(url, content_type or 'no content type'))
+                return {}
+
+            try:
+                decoder = codecs.getincrementaldecoder(res.charset_encoding or 'utf-8')(errors='replace')
+            except LookupError:
+                decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+
+            p = MetaParser()
+            size = 0
+            try:
+                for chunk in res.iter_bytes():
+                    size += len(chunk)
+                    p.feed(decoder.decode(chunk))
+                    if size >= max_bytes:
+                        tprint('* No end of <head> in the first {} bytes of {}'.format(size, url))
+                        break
+                p.feed(decoder.decode(b'', final=True))
+                p.close()
+            except MetaParser.Done:
+                pass
+            tprint('* OG metadata: {} bytes read'.format(size))
+
+        og_data = p.og_metadata()
+        og_data['etag'] = res.headers.get('ETag')
+        og_data['modified'] = res.headers.get('Last-Modified')
+        return og_data
     except Exception as e:
         tprint('* Exception fetching OG metadata: {}'.format(e))
         return {}
 
 
-def create_external_embed(client, url, og_data, feed_title):
+def normalize_url(url):
+    """Normalize url for use as a cache key: lowercase scheme and host,
+    without default port, fragment and tracking parameters.
+    """
+    u = urllib.parse.urlsplit(url)
+    scheme = u.scheme.lower()
+    netloc = u.hostname or ''
+    if u.port and (scheme, u.port) not in (('http', 80), ('https', 443)):
+        netloc = '{}:{}'.format(netloc, u.port)
+    query = urllib.parse.urlencode([(k, v) for k, v in urllib.parse.parse_qsl(u.query, keep_blank_values=True) if not k.startswith('utm_') and k not in ('fbclid', 'gclid')])
+    return urllib.parse.urlunsplit((scheme, netloc, u.path or '/', query, ''))
+
+
+class OGCache(object):
+    """Open Graph metadata of links, kept in the og table of the state
+    database by normalized URL.  Entries are fresh for ttl seconds, and then
+    revalidated with ETag/Last-Modified.  Failures are cached for
+    negative_ttl seconds, so a dead site does not time out on every post, but
+    never replace the metadata fetched before.
+    The thumb uploaded for a link is kept too, along with the account owning
+    it.
+    """
+
+    def __init__(self, http, ttl=86400, negative_ttl=3600):
+        self.http = http
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+
+    @classmethod
+    def from_config(cls, config, http):
+        c = config['default']
+        return cls(
+            http,
+            ttl=c.getfloat('og_cache_ttl', 24) * 3600,
+            negative_ttl=c.getfloat('og_cache_negative_ttl', 1) * 3600,
+        )
+
+    def get(self, s, url, owner):
+        """Return the OG metadata of url as fetch_og_metadata() does, with
+        "thumb" (JSON of the blob) if one has been uploaded by owner.
+        """
+        key = normalize_url(url)
+        now = time.time()
+
+        row = s.execute('SELECT title, description, image_url, thumb, thumb_owner, etag, modified, ok, expires_at FROM og WHERE url = ?;', (key, )).fetchone()
+        etag = modified = None
+        if row is not None:
+            title, description, image_url, thumb, thumb_owner, etag, modified, ok, expires_at = row
+            og_data = {
+                'title': title,
+                'description': description,
+                'image_url': image_url,
+                'thumb': thumb if thumb_owner == owner else None,
+            } if ok else {}
+
+            if expires_at > now:
+                tprint('* OG metadata of {} from cache'.format(url))
+                return og_data
+
+        new_data = fetch_og_metadata(self.http, url, etag, modified)
+        if new_data is None:
+            tprint('* OG metadata of {} not modified'.format(url))
+            s.execute('UPDATE og SET expires_at = ? WHERE url = ?;', (int(now + self.ttl), key))
+            s.commit()
+            return og_data
+
+        if new_data:
+            # Keep the thumb as long as the image stays the same.
+            thumb, thumb_owner = (row[3], row[4]) if row is not None and row[2] == new_data['image_url'] else (None, None)
+            s.execute('INSERT OR REPLACE INTO og (url, title, description, image_url, thumb, thumb_owner, etag, modified, ok, fetched_at, expires_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, 1, ?, ?);', (key, new_data['title'], new_data['description'], new_data['image_url'], thumb, thumb_owner, new_data['etag'], new_data['modified'], int(now), int(now + self.ttl)))
+            new_data['thumb'] = thumb if thumb_owner == owner else None
+        elif row is not None and row[7]:
+            # Most failures are transient, so the metadata fetched before is
+            # kept, and tried again after negative_ttl.
+            tprint('* OG metadata of {} not fetched, keeping the cached one'.format(url))
+            s.execute('UPDATE og SET expires_at = ? WHERE url = ?;', (int(now + self.negative_ttl), key))
+            new_data = og_data
+        else:
+            s.execute('INSERT OR REPLACE INTO og (url, ok, fetched_at, expires_at) VALUES (?, 0, ?, ?);', (key, int(now), int(now + self.negative_ttl)))
+            new_data = {}
+        s.commit()
+        return new_data
+
+    def save_thumb(self, s, url, owner, thumb):
+        """Remember thumb (JSON of the blob) uploaded by owner for url."""
+        s.execute('UPDATE og SET thumb = ?, thumb_owner = ? WHERE url = ?;', (thumb, owner, normalize_url(url)))
+        s.commit()
+
+
+def create_external_embed(client, media_cache, url, og_data, feed_title, image_limits):
     """Create an AppBskyEmbedExternal embed for the link card.
     Returns embed object, or None if creation fails.
     """
+    from atproto import models
+
     try:
         title = og_data.get('title') or feed_title or url
         description = og_data.get('description') or ''
 
         thumb = None
         image_url = og_data.get('image_url')
-        if image_url:
+        if og_data.get('thumb'):
+            # Uploaded for an earlier post of the same link.
+            thumb = models.blob_ref.BlobRef.model_validate_json(og_data['thumb'])
+        elif image_url:
             try:
                 tprint('* Downloading OG image: {}'.format(image_url))
-                img_res = httpx.get(image_url, timeout=15.0, follow_redirects=True)
-                img_res.raise_for_status()
-                upload = client.upload_blob(img_res.content)
+                image_data, _ = media_cache.get_image(image_url, *image_limits, timeout=15.0)
+                upload = client.upload_blob(image_data)
                 thumb = upload.blob
-                tprint('* OG image uploaded: {} bytes'.format(len(img_res.content)))
+                tprint('* OG image uploaded: {} bytes'.format(len(image_data)))
             except Exception as e:
                 tprint('* Exception downloading/uploading OG image: {}'.format(e))
 
@@ -102,21 +1113,95 @@ def create_external_embed(client, url, og_data, feed_title):
         return None
 
 class Feed2Bluesky(object):
+    _bucket = None
     _client = None
     _config = None
+    _http = None
+    _media_cache = None
+    _og_cache = None
+    _outbox = None
+    account = None
+    platform = 'bluesky'
 
-    def __init__(self):
-        pass
+    # Largest dimension (in pixels) and size of uploaded images.
+    IMAGE_LIMITS = (2000, 1000000)
+
+    def __init__(self, account=None):
+        self.account = account
+
+    @property
+    def bucket(self):
+        if self._bucket is None:
+            self._bucket = TokenBucket.from_config(self.config, self.platform, 30, 10, name=self.name)
+        return self._bucket
 
     @property
     def client(self):
         if self._client is None:
+            from atproto import Client
+            from atproto.exceptions import BadRequestError, InvalidTokenError, LoginRequiredError, UnauthorizedError
+
             bsky_username = self.config['default']['bluesky_username']
             bsky_password = self.config['default']['bluesky_password']
-            self._client = Client()
-            profile = self._client.login(bsky_username, bsky_password)
+            client = Client()
+            client.on_session_change(lambda event, session: self.save_session(client.export_session_string()))
+
+            # Resume the saved session (refreshed by the client when the access
+            # token expires), and only log in with the password without one.
+            # createSession is heavily rate limited per account.
+            session_string = self.load_session()
+            resumed = False
+            if session_string:
+                # login() returns None when it does not fetch the profile, so
+                # only an exception tells that the session is not good.
+                try:
+                    client.login(session_string=session_string)
+                    resumed = True
+                    tprint('* Resumed Bluesky session')
+                except (BadRequestError, InvalidTokenError, LoginRequiredError, UnauthorizedError, ValueError) as e:
+                    # Broken file, or both tokens expired.  Network errors are
+                    # raised, the session is still good for the next run.
+                    tprint('* Exception resuming Bluesky session: {!r}'.format(e))
+
+            if not resumed:
+                client.login(bsky_username, bsky_password)
+
+            # Only keep a logged in client, the next use tries again.
+            self._client = client
         return self._client
 
+    @property
+    def media_cache(self):
+        if self._media_cache is None:
+            self._media_cache = MediaCache.from_config(self.config, self.http)
+        return self._media_cache
+
+    @property
+    def og_cache(self):
+        if self._og_cache is None:
+            self._og_cache = OGCache.from_config(self.config, self.http)
+        return self._og_cache
+
+    @property
+    def outbox(self):
+        if self._outbox is None:
+            self._outbox = Outbox.from_config(self.config, self.name)
+        return self._outbox
+
+    @property
+    def http(self):
+        if self._http is None:
+            self._http = new_http_client(self.config)
+        return self._http
+
+    @property
+    def name(self):
+        # State key of the account: the entries, feed state and rate budget of
+        # every account are kept apart.
+        if self.account is None:
+            return self.platform
+        return '{}:{}'.format(self.platform, self.account)
+
     @property
     def config(self):
         if self._config is None:
@@ -125,9 +1210,149 @@ class Feed2Bluesky(object):
 
             self._config = configparser.ConfigParser()
             self._config.read(f_conf)
+
+            # Settings in the section of the account ([<platform>:<account>])
+            # override the ones in [default].
+            if self.account is not None:
+                for key, value in self._config.items(self.name, raw=True):
+                    self._config.set('default', key, value)
         return self._config
 
-    def main(self, sync_only=False):
+    @property
+    def session_file(self):
+        home = os.environ['HOME']
+        if self.account is None:
+            return os.path.expanduser(self.config['default'].get('bluesky_session_file', '{}/.config/feed2social/feed2bluesky.session'.format(home)))
+
+        # Never fall back to the session of [default].
+        return os.path.expanduser(self.config[self.name].get('bluesky_session_file', '{}/.config/feed2social/feed2bluesky-{}.session'.format(home, self.account)))
+
+    def load_session(self):
+        try:
+            with open(self.session_file) as f:
+                return f.read().strip()
+        except FileNotFoundError:
+            return None
+
+    def save_session(self, session_string):
+        # The session is as good as the password, keep it readable by the
+        # owner only (mkstemp creates the file with mode 0600).
+        f_session = self.session_file
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(f_session), prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'w') as tmp_file:
+                tmp_file.write(session_string)
+            os.replace(tmp_path, f_session)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def send_post(self, s, job):
+        """Post the entry of job, returns the payload of its reply."""
+        content = job['content']
+        image_url = job['image_url']
+        url = job['url']
+
+        # Download image if present
+        image_data = None
+        if image_url:
+            try:
+                tprint('* Downloading image: {}'.format(image_url))
+                image_data, _ = self.media_cache.get_image(image_url, *self.IMAGE_LIMITS)
+                tprint('* Image downloaded: {} bytes'.format(len(image_data)))
+            except Exception as e:
+                tprint('* Exception downloading image: {}'.format(e))
+
+        if not self.bucket.acquire(s):
+            raise RateLimited()
+
+        # atproto takes long to import, so only once there is something to
+        # post.
+        from atproto import client_utils
+        from atproto.exceptions import RequestException
+
+        # Post to Bluesky
+        try:
+            if image_data:
+                # Post with image using send_image
+                tb = client_utils.TextBuilder()
+
+                # Handle links
+                http_pattern = re.compile(r'^https?://[^\s]+')
+                for w in re.split(r'(https?://[^\s]+)', content):
+                    if len(w) == 0:
+                        continue
+
+                    if http_pattern.match(w):
+                        tb.link(w, w)
+                    else:
+                        tb.text(w)
+
+                post = self.client.send_image(text=tb, image=image_data, image_alt='')
+            else:
+                # Post text only with link card embed
+                tb = client_utils.TextBuilder()
+
+                # Handle links
+                http_pattern = re.compile(r'^https?://[^\s]+')
+                for w in re.split(r'(https?://[^\s]+)', content):
+                    if len(w) == 0:
+                        continue
+
+                    if http_pattern.match(w):
+                        tb.link(w, w)
+                    else:
+                        tb.text(w)
+
+                # Fetch OG metadata and create link card embed
+                og_data = self.og_cache.get(s, url, self.config['default']['bluesky_username'])
+                embed = create_external_embed(self.client, self.media_cache, url, og_data, job['title'], self.IMAGE_LIMITS)
+
+                post = self.client.send_post(tb, embed=embed)
+
+                # Once a post refers to the thumb, later posts can too.
+                if post.cid and embed is not None and embed.external.thumb and not og_data.get('thumb'):
+                    self.og_cache.save_thumb(s, url, self.config['default']['bluesky_username'], embed.external.thumb.model_dump_json(by_alias=True))
+        except RequestException as e:
+            if e.response is None or e.response.status_code != 429:
+                raise
+            self.bucket.defer(s, retry_after(e.response.headers))
+            raise RateLimited()
+
+        tprint('* type(post) = {}'.format(type(post)))
+        tprint('* post = {}'.format(post))
+
+        # Without a cid there is nothing to reply to.
+        if post is None or not post.cid:
+            return None
+        return {'url': url, 'uri': post.uri, 'cid': post.cid}
+
+    def send_reply(self, s, job):
+        """Post the "Sync from" reply of job."""
+        if not self.bucket.acquire(s):
+            raise RateLimited()
+
+        from atproto import client_utils, models
+        from atproto.exceptions import RequestException
+
+        tb2 = client_utils.TextBuilder()
+        tb2.text('Sync from: ')
+        tb2.link(job['url'], job['url'])
+
+        post_ref = models.ComAtprotoRepoStrongRef.Main(uri=job['uri'], cid=job['cid'])
+        try:
+            reply = self.client.send_post(tb2, reply_to=models.AppBskyFeedPost.ReplyRef(parent=post_ref, root=post_ref))
+        except RequestException as e:
+            if e.response is None or e.response.status_code != 429:
+                raise
+            self.bucket.defer(s, retry_after(e.response.headers))
+            raise RateLimited()
+        tprint('* type(reply) = {}'.format(type(reply)))
+        tprint('* reply = {}'.format(reply))
+
+        return True if reply is not None and reply.cid else None
+
+    def main(self, sync_only=False, feed=None):
         tprint('* Started.')
 
         if sync_only:
@@ -136,19 +1361,27 @@ class Feed2Bluesky(object):
         home = os.environ['HOME']
         f_db = '{}/.config/feed2social/feed2bluesky.sqlite3'.format(home)
 
-        feed_url = self.config['default']['feed_url']
-        feed = feedparser.parse(feed_url)
-        items = feed.entries
-
-        s = sqlite3.connect(f_db)
+        s = open_state(self.config, self.name, f_db)
 
-        sql_insert = 'INSERT INTO entry (entry_id, created_at) VALUES (?, ?);'
-        sql_select = 'SELECT COUNT(*) FROM entry WHERE entry_id = ?;'
+        state = None
+        if feed is None:
+            feed_url = self.config['default']['feed_url']
+            try:
+                feed, state = fetch_feed(self.http, s, self.name, feed_url)
+                if feed is None:
+                    # Nothing new, but jobs in the outbox may be due.
+                    tprint('* Feed not changed.')
+            except Exception as e:
+                # The jobs in the outbox are still drained below, so retries
+                # do not wait for the feed to be back.
+                tprint('* Exception fetching {}: {!r}'.format(feed_url, e))
+        items = feed.entries if feed is not None else []
 
-        # Workaround: cannot use allow_tags=[]:
-        cl = Cleaner(allow_tags=['p'])
+        sql_insert = 'INSERT INTO entry (platform, entry_id, created_at) VALUES (?, ?, ?);'
 
-        for item in reversed(items):
+        # Cheap checks first, so already synced and opted out entries never
+        # reach the HTML cleaning and media scanning below.
+        for item in entries_not_opted_out(entries_unseen(s, self.name, items), '#nobluesky'):
             body = item['description']
 
             # Print out item's id.
@@ -167,32 +1400,8 @@ class Feed2Bluesky(object):
                 tprint('* Skipping: empty body and no image')
                 continue
 
-            # Craft "body".
-            #
-            # First to remove all tags except "a" and root's "div".
-            if body and body.strip():
-                body = cl.clean_html(body)
-
-                # Skip if there is '#nobluesky' tag.
-                if '#nobluesky' in body:
-                    continue
-
-                # Remove root's "div".
-                body = body.replace('<div>', '').replace('</div>', '')
-
-                # <p> and </p>
-                body = body.replace('<p>', '\n').replace('</p>', '\n')
-
-                # trim
-                body = body.strip()
-
-                # unescape
-                body = html.unescape(body)
-
-                # Limit to 200 chars.
-                body = body[0:200]
-            else:
-                body = ''
+            # Render "body" as plain text, limited to 200 chars.
+            body = html_to_text(body or '', 200)
 
             # Generate parameters.
             id_str = item['id']
@@ -200,92 +1409,41 @@ class Feed2Bluesky(object):
 
             c = s.cursor()
 
-            c.execute(sql_select, (id_str, ))
-            if 0 == c.fetchone()[0]:
-                content = body
-                tprint('* content = {}'.format(content))
+            content = body
+            tprint('* content = {}'.format(content))
 
-                if sync_only:
-                    tprint('* sync_only: skipping post to Bluesky')
-                    c.execute(sql_insert, (id_str, int(time.time())))
-                    s.commit()
-                    continue
+            if sync_only:
+                tprint('* sync_only: skipping post to Bluesky')
+                c.execute(sql_insert, (self.name, entry_key(self.config, id_str), int(time.time())))
+                s.commit()
+                continue
 
-                # Download image if present
-                image_data = None
-                if image_url:
-                    try:
-                        tprint('* Downloading image: {}'.format(image_url))
-                        img_res = httpx.get(image_url, timeout=30.0)
-                        if img_res.status_code == 200:
-                            image_data = img_res.content
-                            tprint('* Image downloaded: {} bytes'.format(len(image_data)))
-                        else:
-                            tprint('* Failed to download image: {}'.format(img_res.status_code))
-                    except Exception as e:
-                        tprint('* Exception downloading image: {}'.format(e))
-
-                # Post to Bluesky
-                if image_data:
-                    # Post with image using send_image
-                    tb = client_utils.TextBuilder()
-
-                    # Handle links
-                    http_pattern = re.compile(r'^https?://[^\s]+')
-                    for w in re.split(r'(https?://[^\s]+)', content):
-                        if len(w) == 0:
-                            continue
-
-                        if http_pattern.match(w):
-                            tb.link(w, w)
-                        else:
-                            tb.text(w)
-
-                    post = self.client.send_image(text=tb, image=image_data, image_alt='')
-                else:
-                    # Post text only with link card embed
-                    tb = client_utils.TextBuilder()
-
-                    # Handle links
-                    http_pattern = re.compile(r'^https?://[^\s]+')
-                    for w in re.split(r'(https?://[^\s]+)', content):
-                        if len(w) == 0:
-                            continue
-
-                        if http_pattern.match(w):
-                            tb.link(w, w)
-                        else:
-                            tb.text(w)
-
-                    # Fetch OG metadata and create link card embed
-                    og_data = fetch_og_metadata(url)
-                    feed_title = html.unescape(item.get('title', ''))
-                    embed = create_external_embed(self.client, url, og_data, feed_title)
-
-                    post = self.client.send_post(tb, embed=embed)
-
-                tprint('* type(post) = {}'.format(type(post)))
-                tprint('* post = {}'.format(post))
-                if isinstance(post, object) and post.cid:
-                    c.execute(sql_insert, (id_str, int(time.time())))
-                    s.commit()
-                else:
-                    s.rollback()
+            # Queue the post along with the entry, it is sent (and retried)
+            # from the outbox below.
+            self.outbox.add(s, id_str, 'post', {'content': content, 'image_url': image_url, 'url': url, 'title': html.unescape(item.get('title', ''))})
+            c.execute(sql_insert, (self.name, entry_key(self.config, id_str), int(time.time())))
+            s.commit()
+
+        if state is not None:
+            save_feed_state(s, self.name, feed_url, state)
+
+        if not sync_only:
+            self.outbox.drain(s, [('post', self.send_post), ('reply', self.send_reply)])
 
-                tb2 = client_utils.TextBuilder()
-                tb2.text('Sync from: ')
-                tb2.link(url, url)
+        # The whole feed is only at hand when fetched here, the runner takes
+        # care of it by itself.
+        if state is not None and items and maintenance_due(s, self.config, self.name):
+            maintain(s, self.config, {self.name: [item['id'] for item in items]})
 
-                post_ref = models.create_strong_ref(post)
-                reply = self.client.send_post(tb2, reply_to=models.AppBskyFeedPost.ReplyRef(parent=post_ref, root=post_ref))
-                tprint('* type(reply) = {}'.format(type(reply)))
-                tprint('* reply = {}'.format(reply))
+        return True
 
 if '__main__' == __name__:
     parser = argparse.ArgumentParser(description='Sync feed to Bluesky')
+    parser.add_argument('--account',
+                        help='Post with the account in the [bluesky:<account>] section of config.ini instead of [default]')
     parser.add_argument('--sync-only', action='store_true',
                         help='Only sync feed to database without posting to Bluesky')
     args = parser.parse_args()
 
-    t = Feed2Bluesky()
+    t = Feed2Bluesky(account=args.account)
     t.main(sync_only=args.sync_only)
@@ -4,27 +4,529 @@
 import argparse
 import configparser
 import datetime
-import feedparser
-import html
+import hashlib
+import html.parser
+import httpx
+import json
 import os
 import re
-import selenium
-import selenium.webdriver.firefox.options
-import sentry_sdk
 import sqlite3
+import threading
 import time
 
-from lxml.html.clean import Cleaner
-from selenium.webdriver.common.by import By
-from selenium.webdriver.firefox.service import Service
-
 def tprint(*args, **kwargs):
     timestamp = datetime.datetime.now(datetime.timezone.utc).strftime('[%Y-%m-%dT%H:%M:%SZ]')
-    print(timestamp, *args, **kwargs)
+
+    # Platforms run concurrently by feed2social.py, tell their lines apart.
+    name = threading.current_thread().name
+    if name != 'MainThread':
+        timestamp += ' [{}]'.format(name)
+
+    # One write per line, so lines of other threads do not end up inside.
+    sep = kwargs.pop('sep', ' ')
+    end = kwargs.pop('end', '\n')
+    print(sep.join(str(arg) for arg in (timestamp, ) + args) + end, end='', **kwargs)
+
+# Schema migrations of the sqlite3 state, applied in order by open_db().  The
+# current version is kept in "PRAGMA user_version".
+MIGRATIONS = [
+    # 1: entry table with unique entry_id, replacing the hand-created table
+    # without any index (duplicated rows are dropped first).
+    [
+        'CREATE TABLE IF NOT EXISTS entry (entry_id VARCHAR, created_at INT);',
+        'DELETE FROM entry WHERE rowid NOT IN (SELECT MIN(rowid) FROM entry GROUP BY entry_id);',
+        'CREATE UNIQUE INDEX IF NOT EXISTS entry_entry_id ON entry (entry_id);',
+    ],
+    # 2: feed validators for conditional GET.
+    [
+        'CREATE TABLE IF NOT EXISTS feed (feed_url VARCHAR PRIMARY KEY, etag VARCHAR, modified VARCHAR, digest VARCHAR, updated_at INT);',
+    ],
+    # 3: key everything by platform, so one database can be shared by all
+    # platforms.  Existing rows belong to the platform opening the file.
+    [
+        'CREATE TABLE entry_new (platform VARCHAR NOT NULL, entry_id VARCHAR NOT NULL, created_at INT, PRIMARY KEY (platform, entry_id));',
+        'INSERT OR IGNORE INTO entry_new (platform, entry_id, created_at) SELECT :platform, entry_id, created_at FROM entry;',
+        'DROP TABLE entry;',
+        'ALTER TABLE entry_new RENAME TO entry;',
+        'CREATE TABLE feed_new (platform VARCHAR NOT NULL, feed_url VARCHAR NOT NULL, etag VARCHAR, modified VARCHAR, digest VARCHAR, updated_at INT, PRIMARY KEY (platform, feed_url));',
+        'INSERT INTO feed_new (platform, feed_url, etag, modified, digest, updated_at) SELECT :platform, feed_url, etag, modified, digest, updated_at FROM feed;',
+        'DROP TABLE feed;',
+        'ALTER TABLE feed_new RENAME TO feed;',
+    ],
+    # 4: rate limit windows reported by the platforms.
+    [
+        'CREATE TABLE rate_limit (platform VARCHAR NOT NULL, endpoint VARCHAR NOT NULL, rate_limit INT, remaining INT, reset_at INT, updated_at INT, PRIMARY KEY (platform, endpoint));',
+    ],
+    # 5: token buckets pacing the posts of the platforms.
+    [
+        'CREATE TABLE token_bucket (platform VARCHAR PRIMARY KEY, tokens REAL, updated_at REAL, blocked_until REAL);',
+    ],
+    # 6: Open Graph metadata of links, by normalized URL.
+    [
+        'CREATE TABLE og (url VARCHAR PRIMARY KEY, title VARCHAR, description VARCHAR, image_url VARCHAR, thumb VARCHAR, thumb_owner VARCHAR, etag VARCHAR, modified VARCHAR, ok INT, fetched_at INT, expires_at INT);',
+    ],
+    # 7: outbox of the posts and their "Sync from" replies.
+    [
+        'CREATE TABLE outbox (id INTEGER PRIMARY KEY AUTOINCREMENT, platform VARCHAR NOT NULL, entry_id VARCHAR NOT NULL, kind VARCHAR NOT NULL, payload VARCHAR, state VARCHAR NOT NULL, attempts INT, next_at REAL, error VARCHAR, created_at INT, updated_at INT, UNIQUE (platform, entry_id, kind));',
+        'CREATE INDEX outbox_due ON outbox (platform, kind, state, next_at);',
+    ],
+    # 8: last maintenance of the platforms.
+    [
+        'CREATE TABLE maintenance (platform VARCHAR PRIMARY KEY, done_at INT);',
+    ],
+]
+
+def hash_entry_id(entry_id):
+    """Fixed-width (16 bytes) key of entry_id, stored in the entry table
+    instead of the id itself with "hash_entry_ids = true".
+    """
+    return hashlib.sha256(entry_id.encode('utf-8')).digest()[:16]
+
+def entry_key(config, entry_id):
+    """Key of entry_id to store in the entry table.  Lookups match both
+    forms, so the setting can be changed at any time.
+    """
+    if config['default'].getboolean('hash_entry_ids', False):
+        return hash_entry_id(entry_id)
+    return entry_id
+
+def open_db(f_db, platform):
+    s = sqlite3.connect(f_db, timeout=30.0)
+    s.create_function('hash_entry_id', 1, hash_entry_id, deterministic=True)
+
+    # WAL lets platforms running at the same time read and write without
+    # blocking each other.
+    s.execute('PRAGMA journal_mode = WAL;')
+    s.execute('PRAGMA synchronous = NORMAL;')
+
+    version = s.execute('PRAGMA user_version;').fetchone()[0]
+    if version < len(MIGRATIONS):
+        s.execute('BEGIN IMMEDIATE;')
+
+        # Another process may have migrated it in the meantime.
+        version = s.execute('PRAGMA user_version;').fetchone()[0]
+        for i in range(version, len(MIGRATIONS)):
+            tprint('* Migrating {} to version {}'.format(f_db, i + 1))
+            for sql in MIGRATIONS[i]:
+                s.execute(sql, {'platform': platform})
+            s.execute('PRAGMA user_version = {};'.format(i + 1))
+
+        s.commit()
+
+    return s
+
+def open_state(config, platform, f_db):
+    """Open the state of platform, which is f_db, or the database shared by all
+    platforms if "state_db" is set in config.ini.  When switching to the shared
+    database, the entries, feed validators, outbox and rate budgets in f_db
+    are imported.
+
+    The entries of files from before accounts belong to the platform itself
+    ("bluesky" for "bluesky:acme"), so they are migrated and imported under
+    that key, and a new account starts without any synced entries.
+    """
+    owner = platform.partition(':')[0]
+
+    f_shared = config['default'].get('state_db')
+    if not f_shared:
+        return open_db(f_db, owner)
+
+    f_shared = os.path.expanduser(f_shared)
+    s = open_db(f_shared, owner)
+
+    if os.path.exists(f_db) and not os.path.samefile(f_db, f_shared) and s.execute('SELECT 1 FROM entry WHERE platform = ? LIMIT 1;', (owner, )).fetchone() is None:
+        tprint('* Importing {} into {}'.format(f_db, f_shared))
+
+        # Bring the old file to the current schema first.
+        open_db(f_db, owner).close()
+
+        s.execute('ATTACH DATABASE ? AS old;', (f_db, ))
+        s.execute('INSERT OR IGNORE INTO entry (platform, entry_id, created_at) SELECT platform, entry_id, created_at FROM old.entry;')
+        s.execute('INSERT OR IGNORE INTO feed (platform, feed_url, etag, modified, digest, updated_at) SELECT platform, feed_url, etag, modified, digest, updated_at FROM old.feed;')
+        s.execute('INSERT OR IGNORE INTO rate_limit (platform, endpoint, rate_limit, remaining, reset_at, updated_at) SELECT platform, endpoint, rate_limit, remaining, reset_at, updated_at FROM old.rate_limit;')
+        s.execute('INSERT OR IGNORE INTO token_bucket (platform, tokens, updated_at, blocked_until) SELECT platform, tokens, updated_at, blocked_until FROM old.token_bucket;')
+        # The ids are given anew, the jobs are told apart by (platform,
+        # entry_id, kind).
+        s.execute('INSERT OR IGNORE INTO outbox (platform, entry_id, kind, payload, state, attempts, next_at, error, created_at, updated_at) SELECT platform, entry_id, kind, payload, state, attempts, next_at, error, created_at, updated_at FROM old.outbox;')
+        s.commit()
+        s.execute('DETACH DATABASE old;')
+
+    return s
+
+def select_seen(s, platform, entry_ids):
+    """Return the set of entry_ids already in the entry table of platform,
+    stored as they are or hashed.
+    """
+    keys = {}
+    for entry_id in entry_ids:
+        keys[entry_id] = entry_id
+        keys[hash_entry_id(entry_id)] = entry_id
+    keys_list = list(keys)
+    seen = set()
+
+    c = s.cursor()
+
+    # Keep under SQLite's limit of host parameters per statement.
+    for i in range(0, len(keys_list), 500):
+        chunk = keys_list[i:i + 500]
+        c.execute('SELECT entry_id FROM entry WHERE platform = ? AND entry_id IN ({});'.format(','.join('?' * len(chunk))), [platform] + chunk)
+        seen.update(keys[row[0]] for row in c.fetchall())
+
+    return seen
+
+def entries_unseen(s, platform, items):
+    """Yield the entries not in the entry table of platform yet, oldest first."""
+    items = list(reversed(items))
+    seen = select_seen(s, platform, [item['id'] for item in items])
+
+    for item in items:
+        if item['id'] in seen:
+            continue
+        seen.add(item['id'])
+        yield item
+
+def maintenance_due(s, config, platform):
+    """Whether maintain() has not run for platform in "maintenance_interval"
+    hours (24 by default, 0 to only run it by hand).
+    """
+    interval = config['default'].getfloat('maintenance_interval', 24.0)
+    if interval <= 0:
+        return False
+
+    row = s.execute('SELECT done_at FROM maintenance WHERE platform = ?;', (platform, )).fetchone()
+    return row is None or row[0] + interval * 3600 <= time.time()
+
+def maintain(s, config, windows):
+    """Keep the state small for long-lived installs.  windows maps platforms
+    to the entry ids in their feeds (None if unknown).  Entries older than
+    "retention_days" (365 by default, 0 to keep them forever) and not in the
+    feeds any more are pruned, along with the outbox jobs finished a week ago
+    and the Open Graph metadata older than the horizon.  With
+    "hash_entry_ids = true", the stored entry ids are replaced by their
+    hashes.  The freed pages are then given back to the file system.
+    """
+    c = config['default']
+    now = int(time.time())
+    retention = c.getfloat('retention_days', 365.0)
+    horizon = now - retention * 86400
+
+    for platform, entry_ids in windows.items():
+        # Without the feed, an old entry still in it would be posted again.
+        if retention > 0 and entry_ids:
+            res = s.execute('DELETE FROM entry WHERE platform = :platform AND created_at < :horizon AND entry_id NOT IN (SELECT value FROM json_each(:ids) UNION ALL SELECT hash_entry_id(value) FROM json_each(:ids));', {'platform': platform, 'horizon': horizon, 'ids': json.dumps(entry_ids)})
+            tprint('* Maintenance of {}: {} entries pruned'.format(platform, res.rowcount))
+
+        s.execute("DELETE FROM outbox WHERE platform = ? AND state IN ('done', 'failed') AND updated_at < ?;", (platform, now - 7 * 86400))
+
+        if c.getboolean('hash_entry_ids', False):
+            s.execute("UPDATE OR IGNORE entry SET entry_id = hash_entry_id(entry_id) WHERE platform = ? AND typeof(entry_id) = 'text';", (platform, ))
+            # Left are the ids stored in both forms.
+            s.execute("DELETE FROM entry WHERE platform = ? AND typeof(entry_id) = 'text';", (platform, ))
+
+        s.execute('INSERT OR REPLACE INTO maintenance (platform, done_at) VALUES (?, ?);', (platform, now))
+
+    if retention > 0:
+        s.execute('DELETE FROM og WHERE fetched_at < ?;', (horizon, ))
+    s.commit()
+
+    # Incremental vacuum needs one full VACUUM to be turned on.  It needs the
+    # file to itself, so with another run in the middle of a write it is left
+    # to the next maintenance, the pruning above is kept anyway.
+    try:
+        if s.execute('PRAGMA auto_vacuum;').fetchone()[0] != 2:
+            tprint('* Maintenance: turning on incremental vacuum')
+            s.execute('PRAGMA auto_vacuum = INCREMENTAL;')
+            s.execute('VACUUM;')
+        s.execute('PRAGMA incremental_vacuum;').fetchall()
+        s.execute('ANALYZE;')
+        s.execute('PRAGMA optimize;')
+        s.execute('PRAGMA wal_checkpoint(TRUNCATE);').fetchall()
+    except sqlite3.OperationalError as e:
+        tprint('* Maintenance: skipping VACUUM until the next time: {}'.format(e))
+
+def entries_not_opted_out(items, tag):
+    """Skip the entries with the opt-out tag (e.g. "#nobluesky") by scanning the
+    raw description.  Mastodon marks up hashtags as "#<span>tag</span>", so
+    tags between "#" and the name are allowed.
+    """
+    pattern = re.compile('#(?:<[^>]*>)*' + re.escape(tag.lstrip('#')))
+
+    for item in items:
+        if pattern.search(item.get('description', '')):
+            tprint('* Skipping {}: {}'.format(item['id'], tag))
+            continue
+        yield item
+
+class TextRenderer(html.parser.HTMLParser):
+    """Render HTML into plain text in a single pass.  Paragraphs are separated
+    by an empty line, <br> and list items start a new line, and all other tags
+    are dropped with their text kept.  Rendering stops as soon as limit chars
+    have been emitted.
+    """
+    PARAGRAPH_TAGS = {'blockquote', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'ol', 'p', 'pre', 'ul'}
+    LINE_TAGS = {'div', 'li', 'tr'}
+    SKIP_TAGS = {'script', 'style', 'template'}
+
+    class Full(Exception):
+        pass
+
+    def __init__(self, limit=None):
+        super().__init__(convert_charrefs=True)
+        self.limit = limit
+        self.parts = []
+        self.length = 0
+        self.newlines = 0
+        self.skip = 0
+
+    def break_line(self, n):
+        self.newlines = max(self.newlines, n)
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.SKIP_TAGS:
+            self.skip += 1
+        elif tag == 'br':
+            self.newlines += 1
+        elif tag in self.PARAGRAPH_TAGS:
+            self.break_line(2)
+        elif tag in self.LINE_TAGS:
+            self.break_line(1)
+
+    def handle_endtag(self, tag):
+        if tag in self.SKIP_TAGS:
+            self.skip = max(self.skip - 1, 0)
+        elif tag in self.PARAGRAPH_TAGS:
+            self.break_line(2)
+        elif tag in self.LINE_TAGS:
+            self.break_line(1)
+
+    def handle_data(self, data):
+        if self.skip:
+            return
+
+        if self.length == 0 or self.newlines:
+            # Nothing emitted yet or at the start of a block, so the
+            # whitespace indenting the markup is trimmed, and runs of breaks
+            # are kept to one empty line.
+            data = data.lstrip()
+            if not data:
+                return
+            if self.length:
+                last = self.parts[-1].rstrip()
+                self.length -= len(self.parts[-1]) - len(last)
+                self.parts[-1] = last
+                data = '\n' * min(self.newlines, 2) + data
+        self.newlines = 0
+
+        self.parts.append(data)
+        self.length += len(data)
+        if self.limit is not None and self.length >= self.limit:
+            raise self.Full()
+
+    def text(self):
+        return ''.join(self.parts)[:self.limit].rstrip()
+
+def html_to_text(body, limit=None):
+    """Render HTML body into plain text of at most limit chars."""
+    r = TextRenderer(limit)
+    try:
+        r.feed(body)
+        r.close()
+    except TextRenderer.Full:
+        pass
+    return r.text()
+
+def new_http_client(config):
+    """Create the long-lived httpx.Client of a platform, shared by the feed,
+    media, upload, post and reply requests so connections are kept alive.
+    HTTP/2 is enabled by "http2 = true" in config.ini.
+    """
+    return httpx.Client(
+        http2=config['default'].getboolean('http2', False),
+        timeout=httpx.Timeout(30.0, connect=10.0, pool=10.0),
+        limits=httpx.Limits(max_connections=10, max_keepalive_connections=5, keepalive_expiry=60.0),
+    )
+
+def fetch_feed(http, s, platform, feed_url):
+    """Fetch and parse the feed with conditional GET.
+    Returns (feed, state), feed is None if the feed has not been changed since
+    the state saved by save_feed_state().
+    """
+    c = s.cursor()
+    c.execute('SELECT etag, modified, digest FROM feed WHERE platform = ? AND feed_url = ?;', (platform, feed_url))
+    row = c.fetchone()
+    etag, modified, digest = row if row else (None, None, None)
+
+    headers = {}
+    if etag:
+        headers['If-None-Match'] = etag
+    if modified:
+        headers['If-Modified-Since'] = modified
+
+    # httpx asks for gzip (and brotli when available) by itself.
+    res = http.get(feed_url, headers=headers, timeout=30.0, follow_redirects=True)
+    tprint('* Fetch feed: res = {}'.format(res))
+    if res.status_code == 304:
+        return None, None
+    res.raise_for_status()
+
+    state = (res.headers.get('ETag'), res.headers.get('Last-Modified'), hashlib.sha256(res.content).hexdigest())
+    if state[2] == digest:
+        # Same content, only keep the latest validators.
+        save_feed_state(s, platform, feed_url, state)
+        return None, state
+
+    # feedparser is only needed (and imported) when the feed has changed.
+    import feedparser
+    return feedparser.parse(res.content, response_headers=dict(res.headers)), state
+
+def save_feed_state(s, platform, feed_url, state):
+    etag, modified, digest = state
+    s.execute('INSERT OR REPLACE INTO feed (platform, feed_url, etag, modified, digest, updated_at) VALUES (?, ?, ?, ?, ?, ?);', (platform, feed_url, etag, modified, digest, int(time.time())))
+    s.commit()
+
+class RateLimited(Exception):
+    """Raised by the senders of Outbox.drain() to stop posting for this run,
+    leaving the job for a later run without counting it as a failure.
+    """
+
+class Outbox(object):
+    """Durable queue of the posts of a platform, kept in the outbox table.
+    Jobs are "pending" until done, retried with exponential backoff when they
+    fail, and "failed" after max_attempts.  A claimed job is "running" for
+    lease seconds, after which it is picked up again, so a crash in the
+    middle of a post does not lose it (but may post it twice).
+    """
+
+    def __init__(self, platform, max_attempts=8, backoff=60.0, max_backoff=6 * 3600.0, lease=600.0):
+        self.platform = platform
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.lease = lease
+
+    @classmethod
+    def from_config(cls, config, platform):
+        c = config['default']
+        return cls(
+            platform,
+            max_attempts=c.getint('outbox_max_attempts', 8),
+            backoff=c.getfloat('outbox_backoff', 60.0),
+            max_backoff=c.getfloat('outbox_max_backoff', 6 * 3600.0),
+        )
+
+    def add(self, s, entry_id, kind, payload):
+        """Queue a job, in the transaction of the caller (committed along with
+        the entry, so an entry is either queued or not seen at all).
+        """
+        now = time.time()
+        s.execute('INSERT OR IGNORE INTO outbox (platform, entry_id, kind, payload, state, attempts, next_at, created_at, updated_at) VALUES (?, ?, ?, ?, ?, 0, ?, ?, ?);', (self.platform, entry_id, kind, json.dumps(payload), 'pending', now, int(now), int(now)))
+
+    def claim(self, s, kind):
+        """Take the oldest due job of kind, or None.  Returns the payload with
+        "id", "entry_id" and "attempts" of the job added.
+        """
+        s.execute('BEGIN IMMEDIATE;')
+        now = time.time()
+        row = s.execute("SELECT id, entry_id, payload, attempts FROM outbox WHERE platform = ? AND kind = ? AND state IN ('pending', 'running') AND next_at <= ? ORDER BY id LIMIT 1;", (self.platform, kind, now)).fetchone()
+        if row is None:
+            s.commit()
+            return None
+
+        s.execute("UPDATE outbox SET state = 'running', next_at = ?, updated_at = ? WHERE id = ?;", (now + self.lease, int(now), row[0]))
+        s.commit()
+
+        job = json.loads(row[2])
+        job.update({'id': row[0], 'entry_id': row[1], 'attempts': row[3]})
+        return job
+
+    def done(self, s, job, reply=None):
+        """Mark job done, and queue reply (the payload of its "Sync from"
+        reply) in the same transaction.
+        """
+        s.execute("UPDATE outbox SET state = 'done', error = NULL, updated_at = ? WHERE id = ?;", (int(time.time()), job['id']))
+        if reply is not None:
+            self.add(s, job['entry_id'], 'reply', reply)
+        s.commit()
+
+    def retry(self, s, job, error):
+        """Count a failed attempt of job, and retry it later or give up."""
+        attempts = job['attempts'] + 1
+        now = time.time()
+        if attempts >= self.max_attempts:
+            tprint('* Giving up {} of {} after {} attempts: {}'.format(job['id'], job['entry_id'], attempts, error))
+            s.execute("UPDATE outbox SET state = 'failed', attempts = ?, error = ?, updated_at = ? WHERE id = ?;", (attempts, error, int(now), job['id']))
+        else:
+            delay = min(self.backoff * 2 ** (attempts - 1), self.max_backoff)
+            tprint('* Retrying {} of {} in {:.0f} seconds: {}'.format(job['id'], job['entry_id'], delay, error))
+            s.execute("UPDATE outbox SET state = 'pending', attempts = ?, next_at = ?, error = ?, updated_at = ? WHERE id = ?;", (attempts, now + delay, error, int(now), job['id']))
+        s.commit()
+
+    def release(self, s, job):
+        """Put job back as it was, e.g. when rate limited."""
+        now = time.time()
+        s.execute("UPDATE outbox SET state = 'pending', next_at = ?, updated_at = ? WHERE id = ?;", (now, int(now), job['id']))
+        s.commit()
+
+    def drain(self, s, senders):
+        """Run the due jobs with senders, a list of (kind, send) in priority
+        order, so every main post goes out before the replies.  send(s, job)
+        returns the payload of the reply to queue (a dict) or True when done,
+        None when failed.  Returns False if stopped by RateLimited.
+        """
+        for kind, send in senders:
+            while True:
+                job = self.claim(s, kind)
+                if job is None:
+                    break
+
+                tprint('* Outbox: {} of {} (attempt {})'.format(kind, job['entry_id'], job['attempts'] + 1))
+                try:
+                    res = send(s, job)
+                except RateLimited:
+                    self.release(s, job)
+                    return False
+                except Exception as e:
+                    s.rollback()
+                    self.retry(s, job, repr(e))
+                    continue
+
+                if res is None:
+                    self.retry(s, job, 'failed')
+                else:
+                    self.done(s, job, res if isinstance(res, dict) else None)
+        return True
 
 class Feed2Facebook(object):
     _config = None
+    _http = None
+    _outbox = None
+    account = None
     b = None
+    keep_browser = False
+    platform = 'facebook'
+
+    def __init__(self, account=None):
+        self.account = account
+
+    @property
+    def outbox(self):
+        if self._outbox is None:
+            self._outbox = Outbox.from_config(self.config, self.name)
+        return self._outbox
+
+    @property
+    def http(self):
+        if self._http is None:
+            self._http = new_http_client(self.config)
+        return self._http
+
+    @property
+    def name(self):
+        # State key of the account: the entries, feed state and rate budget of
+        # every account are kept apart.
+        if self.account is None:
+            return self.platform
+        return '{}:{}'.format(self.platform, self.account)
 
     @property
     def config(self):
@@ -34,6 +536,12 @@ class Feed2Facebook(object):
 
             self._config = configparser.ConfigParser()
             self._config.read(f_conf)
+
+            # Settings in the section of the account ([<platform>:<account>])
+            # override the ones in [default].
+            if self.account is not None:
+                for key, value in self._config.items(self.name, raw=True):
+                    self._config.set('default', key, value)
         return self._config
 
     @property
@@ -44,6 +552,10 @@ class Feed2Facebook(object):
         if self.b is not None:
             return
 
+        # selenium is only needed (and imported) to post.
+        import selenium.webdriver
+        from selenium.webdriver.firefox.service import Service
+
         home = os.environ['HOME']
 
         service = Service('/usr/bin/geckodriver')
@@ -54,44 +566,82 @@ class Feed2Facebook(object):
 
         # Workaround to specify profile.
         # via: https://github.com/SeleniumHQ/selenium/issues/11028
+        # Every account is logged in its own profile.
+        profile = home + '/.mozilla/firefox-esr/selenium'
+        if self.account is not None:
+            profile += '-' + self.account
         options.add_argument('-profile')
-        options.add_argument(home + '/.mozilla/firefox-esr/selenium')
+        options.add_argument(profile)
 
         self.b = selenium.webdriver.Firefox(service=service, options=options)
 
     def post(self, text):
+        """Post text from the profile page, waiting for each step of the
+        dialog instead of sleeping.  The browser is kept for the next posts.
+        Returns False if posting failed before "Post" was clicked, anything
+        failing after it is taken as posted, as posting again could duplicate.
+        """
+        from selenium.common.exceptions import WebDriverException
+        from selenium.webdriver.common.by import By
+        from selenium.webdriver.support import expected_conditions as EC
+        from selenium.webdriver.support.ui import WebDriverWait
+
         self.init_browser()
 
         b = self.b
         url = 'https://www.facebook.com/{}'.format(self.facebook_username)
-
-        b.get(url)
-        time.sleep(1)
-
-        # click to popup
-        t = b.find_element(by=By.CSS_SELECTOR, value='a[aria-label] + div[role="button"][tabindex="0"]')
-        t.click()
-        time.sleep(2)
-
-        # input
-        t = b.find_element(by=By.CSS_SELECTOR, value='div[role="dialog"] div[role="textbox"]')
-        t.click()
-        time.sleep(1)
-        for c in text:
-            t.send_keys(c)
-        time.sleep(1)
-
-        # click "Next"
-        btn = b.find_element(by=By.CSS_SELECTOR, value='div[role="dialog"] div[aria-label="Next"]')
-        btn.click()
-        time.sleep(1)
-
-        # click "Post"
-        btn = b.find_element(by=By.CSS_SELECTOR, value='div[role="dialog"] div[aria-label="Post"]')
-        btn.click()
-        time.sleep(1)
-
-    def main(self, sync_only=False):
+        wait = WebDriverWait(b, self.config['default'].getfloat('facebook_timeout', 20.0))
+
+        clicked = False
+        try:
+            # Still on the profile page after the previous post.
+            if b.current_url.rstrip('/') != url:
+                b.get(url)
+
+            # click to popup
+            t = wait.until(EC.element_to_be_clickable((By.CSS_SELECTOR, 'a[aria-label] + div[role="button"][tabindex="0"]')))
+            t.click()
+
+            # input, inserted at once as if pasted instead of typed key by key
+            t = wait.until(EC.element_to_be_clickable((By.CSS_SELECTOR, 'div[role="dialog"] div[role="textbox"]')))
+            t.click()
+            b.execute_script('arguments[0].focus(); document.execCommand("insertText", false, arguments[1]);', t, text)
+            if not t.text.strip():
+                # The editor ignored it, fall back to typing.
+                t.send_keys(text)
+
+            # click "Next"
+            btn = wait.until(EC.element_to_be_clickable((By.CSS_SELECTOR, 'div[role="dialog"] div[aria-label="Next"]')))
+            btn.click()
+
+            # click "Post"
+            btn = wait.until(EC.element_to_be_clickable((By.CSS_SELECTOR, 'div[role="dialog"] div[aria-label="Post"]')))
+            clicked = True
+            btn.click()
+
+            # The dialog closes once the post is submitted.
+            wait.until(EC.invisibility_of_element_located((By.CSS_SELECTOR, 'div[role="dialog"] div[aria-label="Post"]')))
+            return True
+        except WebDriverException as e:
+            tprint('* Exception posting to Facebook: {!r}'.format(e))
+
+            # Start over from the profile page next time.
+            try:
+                b.get(url)
+            except WebDriverException:
+                self.quit_browser()
+
+            if clicked:
+                tprint('* "Post" was clicked, taking it as posted')
+                return True
+            return False
+
+    def send_post(self, s, job):
+        """Post the entry of job, there is no reply on Facebook."""
+        tprint(job['content'])
+        return True if self.post(job['content']) else None
+
+    def main(self, sync_only=False, feed=None):
         tprint('* Started.')
 
         if sync_only:
@@ -102,47 +652,39 @@ class Feed2Facebook(object):
 
         c = self.config
         if 'sentry_sdk_url' in c['default'] and '' != c['default']['sentry_sdk_url']:
+            import sentry_sdk
+
             sentry_sdk_url = c['default']['sentry_sdk_url']
             sentry_sdk.init(sentry_sdk_url)
 
-        feed_url = c['default']['feed_url']
-        feed = feedparser.parse(feed_url)
-        items = feed.entries
-
-        s = sqlite3.connect(f_db)
-
-        sql_insert = 'INSERT INTO entry (entry_id, created_at) VALUES (?, ?);'
-        sql_select = 'SELECT COUNT(*) FROM entry WHERE entry_id = ?;'
-
-        # Workaround: cannot use allow_tags=[]:
-        cl = Cleaner(allow_tags=['p'])
-
-        for item in reversed(items):
+        s = open_state(self.config, self.name, f_db)
+
+        state = None
+        if feed is None:
+            feed_url = c['default']['feed_url']
+            try:
+                feed, state = fetch_feed(self.http, s, self.name, feed_url)
+                if feed is None:
+                    # Nothing new, but jobs in the outbox may be due.
+                    tprint('* Feed not changed.')
+            except Exception as e:
+                # The jobs in the outbox are still drained below, so retries
+                # do not wait for the feed to be back.
+                tprint('* Exception fetching {}: {!r}'.format(feed_url, e))
+        items = feed.entries if feed is not None else []
+
+        sql_insert = 'INSERT INTO entry (platform, entry_id, created_at) VALUES (?, ?, ?);'
+
+        # Cheap checks first, so already synced and opted out entries never
+        # reach the HTML cleaning and media scanning below.
+        for item in entries_not_opted_out(entries_unseen(s, self.name, items), '#nofb'):
             text = item['description']
 
             # Print out item's id.
             tprint('* item.id = {}'.format(item.id))
 
-            # Craft "text".
-            #
-            # First to remove all tags except "a" and root's "div".
-            text = cl.clean_html(text)
-
-            # Skip if there is "#nofb" tag.
-            if '#nofb' in text:
-                continue
-
-            # Remove root's "div".
-            text = text.replace('<div>', '').replace('</div>', '')
-
-            # <p> and </p>
-            text = text.replace('<p>', '\n').replace('</p>', '\n')
-
-            # trim
-            text = text.strip()
-
-            # unescape
-            text = html.unescape(text)
+            # Render "text" as plain text.
+            text = html_to_text(text or '')
 
             # Generate parameters.
             id_str = item['id']
@@ -150,35 +692,52 @@ class Feed2Facebook(object):
 
             c = s.cursor()
 
-            c.execute(sql_select, (id_str, ))
-            if 0 == c.fetchone()[0]:
-                content = '{}\n\n{}'.format(text, url)
-                tprint('* content = {}'.format(content))
+            content = '{}\n\n{}'.format(text, url)
+            tprint('* content = {}'.format(content))
 
-                if sync_only:
-                    tprint('* sync_only: skipping post to Facebook')
-                    c.execute(sql_insert, (id_str, int(time.time())))
-                    s.commit()
-                    continue
+            if sync_only:
+                tprint('* sync_only: skipping post to Facebook')
+                c.execute(sql_insert, (self.name, entry_key(self.config, id_str), int(time.time())))
+                s.commit()
+                continue
 
-                tprint(content)
-                self.post(content)
+            # Queue the post along with the entry, it is sent (and retried)
+            # from the outbox below.
+            self.outbox.add(s, id_str, 'post', {'content': content})
+            c.execute(sql_insert, (self.name, entry_key(self.config, id_str), int(time.time())))
+            s.commit()
 
-                c.execute(sql_insert, (id_str, int(time.time())))
-                s.commit()
+        if state is not None:
+            save_feed_state(s, self.name, feed_url, state)
+
+        if not sync_only:
+            self.outbox.drain(s, [('post', self.send_post)])
+
+        # The whole feed is only at hand when fetched here, the runner takes
+        # care of it by itself.
+        if state is not None and items and maintenance_due(s, self.config, self.name):
+            maintain(s, self.config, {self.name: [item['id'] for item in items]})
+
+        # A long-running caller keeps the browser (and its login) for the next
+        # run, and quits it by itself.
+        if not self.keep_browser:
+            self.quit_browser()
 
-        self.quit_browser()
+        return True
 
     def quit_browser(self):
         if self.b is None:
             return
 
         self.b.quit()
+        self.b = None
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Sync feed to Facebook')
+    parser.add_argument('--account',
+                        help='Post with the account in the [facebook:<account>] section of config.ini instead of [default]')
     parser.add_argument('--sync-only', action='store_true',
                         help='Only sync feed to database without posting to Facebook')
     args = parser.parse_args()
 
-    Feed2Facebook().main(sync_only=args.sync_only)
+    Feed2Facebook(account=args.account).main(sync_only=args.sync_only)
@@ -0,0 +1,626 @@
+#!/usr/bin/env python3
+
+import argparse
+import concurrent.futures
+import configparser
+import datetime
+import hashlib
+import httpx
+import importlib
+import json
+import os
+import random
+import re
+import signal
+import sqlite3
+import threading
+import time
+import types
+
+PLATFORMS = {
+    'bluesky': ('feed2bluesky', 'Feed2Bluesky'),
+    'facebook': ('feed2facebook', 'Feed2Facebook'),
+    'plurk': ('feed2plurk', 'Feed2Plurk'),
+    'threads': ('feed2threads', 'Feed2Threads'),
+    'twitter': ('feed2twitter', 'Feed2Twitter'),
+}
+
+def tprint(*args, **kwargs):
+    timestamp = datetime.datetime.now(datetime.timezone.utc).strftime('[%Y-%m-%dT%H:%M:%SZ]')
+
+    # Platforms run concurrently by feed2social.py, tell their lines apart.
+    name = threading.current_thread().name
+    if name != 'MainThread':
+        timestamp += ' [{}]'.format(name)
+
+    # One write per line, so lines of other threads do not end up inside.
+    sep = kwargs.pop('sep', ' ')
+    end = kwargs.pop('end', '\n')
+    print(sep.join(str(arg) for arg in (timestamp, ) + args) + end, end='', **kwargs)
+
+# Schema migrations of the sqlite3 state, applied in order by open_db().  The
+# current version is kept in "PRAGMA user_version".
+MIGRATIONS = [
+    # 1: entry table with unique entry_id, replacing the hand-created table
+    # without any index (duplicated rows are dropped first).
+    [
+        'CREATE TABLE IF NOT EXISTS entry (entry_id VARCHAR, created_at INT);',
+        'DELETE FROM entry WHERE rowid NOT IN (SELECT MIN(rowid) FROM entry GROUP BY entry_id);',
+        'CREATE UNIQUE INDEX IF NOT EXISTS entry_entry_id ON entry (entry_id);',
+    ],
+    # 2: feed validators for conditional GET.
+    [
+        'CREATE TABLE IF NOT EXISTS feed (feed_url VARCHAR PRIMARY KEY, etag VARCHAR, modified VARCHAR, digest VARCHAR, updated_at INT);',
+    ],
+    # 3: key everything by platform, so one database can be shared by all
+    # platforms.  Existing rows belong to the platform opening the file.
+    [
+        'CREATE TABLE entry_new (platform VARCHAR NOT NULL, entry_id VARCHAR NOT NULL, created_at INT, PRIMARY KEY (platform, entry_id));',
+        'INSERT OR IGNORE INTO entry_new (platform, entry_id, created_at) SELECT :platform, entry_id, created_at FROM entry;',
+        'DROP TABLE entry;',
+        'ALTER TABLE entry_new RENAME TO entry;',
+        'CREATE TABLE feed_new (platform VARCHAR NOT NULL, feed_url VARCHAR NOT NULL, etag VARCHAR, modified VARCHAR, digest VARCHAR, updated_at INT, PRIMARY KEY (platform, feed_url));',
+        'INSERT INTO feed_new (platform, feed_url, etag, modified, digest, updated_at) SELECT :platform, feed_url, etag, modified, digest, updated_at FROM feed;',
+        'DROP TABLE feed;',
+        'ALTER TABLE feed_new RENAME TO feed;',
+    ],
+    # 4: rate limit windows reported by the platforms.
+    [
+        'CREATE TABLE rate_limit (platform VARCHAR NOT NULL, endpoint VARCHAR NOT NULL, rate_limit INT, remaining INT, reset_at INT, updated_at INT, PRIMARY KEY (platform, endpoint));',
+    ],
+    # 5: token buckets pacing the posts of the platforms.
+    [
+        'CREATE TABLE token_bucket (platform VARCHAR PRIMARY KEY, tokens REAL, updated_at REAL, blocked_until REAL);',
+    ],
+    # 6: Open Graph metadata of links, by normalized URL.
+    [
+        'CREATE TABLE og (url VARCHAR PRIMARY KEY, title VARCHAR, description VARCHAR, image_url VARCHAR, thumb VARCHAR, thumb_owner VARCHAR, etag VARCHAR, modified VARCHAR, ok INT, fetched_at INT, expires_at INT);',
+    ],
+    # 7: outbox of the posts and their "Sync from" replies.
+    [
+        'CREATE TABLE outbox (id INTEGER PRIMARY KEY AUTOINCREMENT, platform VARCHAR NOT NULL, entry_id VARCHAR NOT NULL, kind VARCHAR NOT NULL, payload VARCHAR, state VARCHAR NOT NULL, attempts INT, next_at REAL, error VARCHAR, created_at INT, updated_at INT, UNIQUE (platform, entry_id, kind));',
+        'CREATE INDEX outbox_due ON outbox (platform, kind, state, next_at);',
+    ],
+    # 8: last maintenance of the platforms.
+    [
+        'CREATE TABLE maintenance (platform VARCHAR PRIMARY KEY, done_at INT);',
+    ],
+]
+
+def hash_entry_id(entry_id):
+    """Fixed-width (16 bytes) key of entry_id, stored in the entry table
+    instead of the id itself with "hash_entry_ids = true".
+    """
+    return hashlib.sha256(entry_id.encode('utf-8')).digest()[:16]
+
+def open_db(f_db, platform):
+    s = sqlite3.connect(f_db, timeout=30.0)
+    s.create_function('hash_entry_id', 1, hash_entry_id, deterministic=True)
+
+    # WAL lets platforms running at the same time read and write without
+    # blocking each other.
+    s.execute('PRAGMA journal_mode = WAL;')
+    s.execute('PRAGMA synchronous = NORMAL;')
+
+    version = s.execute('PRAGMA user_version;').fetchone()[0]
+    if version < len(MIGRATIONS):
+        s.execute('BEGIN IMMEDIATE;')
+
+        # Another process may have migrated it in the meantime.
+        version = s.execute('PRAGMA user_version;').fetchone()[0]
+        for i in range(version, len(MIGRATIONS)):
+            tprint('* Migrating {} to version {}'.format(f_db, i + 1))
+            for sql in MIGRATIONS[i]:
+                s.execute(sql, {'platform': platform})
+            s.execute('PRAGMA user_version = {};'.format(i + 1))
+
+        s.commit()
+
+    return s
+
+def open_state(config, platform, f_db):
+    """Open the state of platform, which is f_db, or the database shared by all
+    platforms if "state_db" is set in config.ini.  When switching to the shared
+    database, the entries, feed validators, outbox and rate budgets in f_db
+    are imported.
+
+    The entries of files from before accounts belong to the platform itself
+    ("bluesky" for "bluesky:acme"), so they are migrated and imported under
+    that key, and a new account starts without any synced entries.
+    """
+    owner = platform.partition(':')[0]
+
+    f_shared = config['default'].get('state_db')
+    if not f_shared:
+        return open_db(f_db, owner)
+
+    f_shared = os.path.expanduser(f_shared)
+    s = open_db(f_shared, owner)
+
+    if os.path.exists(f_db) and not os.path.samefile(f_db, f_shared) and s.execute('SELECT 1 FROM entry WHERE platform = ? LIMIT 1;', (owner, )).fetchone() is None:
+        tprint('* Importing {} into {}'.format(f_db, f_shared))
+
+        # Bring the old file to the current schema first.
+        open_db(f_db, owner).close()
+
+        s.execute('ATTACH DATABASE ? AS old;', (f_db, ))
+        s.execute('INSERT OR IGNORE INTO entry (platform, entry_id, created_at) SELECT platform, entry_id, created_at FROM old.entry;')
+        s.execute('INSERT OR IGNORE INTO feed (platform, feed_url, etag, modified, digest, updated_at) SELECT platform, feed_url, etag, modified, digest, updated_at FROM old.feed;')
+        s.execute('INSERT OR IGNORE INTO rate_limit (platform, endpoint, rate_limit, remaining, reset_at, updated_at) SELECT platform, endpoint, rate_limit, remaining, reset_at, updated_at FROM old.rate_limit;')
+        s.execute('INSERT OR IGNORE INTO token_bucket (platform, tokens, updated_at, blocked_until) SELECT platform, tokens, updated_at, blocked_until FROM old.token_bucket;')
+        # The ids are given anew, the jobs are told apart by (platform,
+        # entry_id, kind).
+        s.execute('INSERT OR IGNORE INTO outbox (platform, entry_id, kind, payload, state, attempts, next_at, error, created_at, updated_at) SELECT platform, entry_id, kind, payload, state, attempts, next_at, error, created_at, updated_at FROM old.outbox;')
+        s.commit()
+        s.execute('DETACH DATABASE old;')
+
+    return s
+
+def entries_not_opted_out(items, tag):
+    """Skip the entries with the opt-out tag (e.g. "#nobluesky") by scanning the
+    raw description.  Mastodon marks up hashtags as "#<span>tag</span>", so
+    tags between "#" and the name are allowed.
+    """
+    pattern = re.compile('#(?:<[^>]*>)*' + re.escape(tag.lstrip('#')))
+
+    for item in items:
+        if pattern.search(item.get('description', '')):
+            tprint('* Skipping {}: {}'.format(item['id'], tag))
+            continue
+        yield item
+
+def select_pending(s, platforms, entry_ids):
+    """Return (platform, entry_id) of the entries not in the entry table yet,
+    for all platforms in one query.
+    """
+    c = s.cursor()
+    c.execute('SELECT p.value, f.value FROM json_each(?) p, json_each(?) f LEFT JOIN entry e ON e.platform = p.value AND e.entry_id IN (f.value, hash_entry_id(f.value)) WHERE e.entry_id IS NULL ORDER BY p.key, f.key;', (json.dumps(platforms), json.dumps(entry_ids)))
+    return c.fetchall()
+
+def select_outbox(s, platforms):
+    """Return (platform, kind, entry_id, state, attempts, error) of the jobs in
+    the outbox not done yet.
+    """
+    c = s.cursor()
+    c.execute("SELECT platform, kind, entry_id, state, attempts, error FROM outbox WHERE state != 'done' AND platform IN (SELECT value FROM json_each(?)) ORDER BY id;", (json.dumps(platforms), ))
+    return c.fetchall()
+
+def maintenance_due(s, config, platform):
+    """Whether maintain() has not run for platform in "maintenance_interval"
+    hours (24 by default, 0 to only run it by hand).
+    """
+    interval = config['default'].getfloat('maintenance_interval', 24.0)
+    if interval <= 0:
+        return False
+
+    row = s.execute('SELECT done_at FROM maintenance WHERE platform = ?;', (platform, )).fetchone()
+    return row is None or row[0] + interval * 3600 <= time.time()
+
+def maintain(s, config, windows):
+    """Keep the state small for long-lived installs.  windows maps platforms
+    to the entry ids in their feeds (None if unknown).  Entries older than
+    "retention_days" (365 by default, 0 to keep them forever) and not in the
+    feeds any more are pruned, along with the outbox jobs finished a week ago
+    and the Open Graph metadata older than the horizon.  With
+    "hash_entry_ids = true", the stored entry ids are replaced by their
+    hashes.  The freed pages are then given back to the file system.
+    """
+    c = config['default']
+    now = int(time.time())
+    retention = c.getfloat('retention_days', 365.0)
+    horizon = now - retention * 86400
+
+    for platform, entry_ids in windows.items():
+        # Without the feed, an old entry still in it would be posted again.
+        if retention > 0 and entry_ids:
+            res = s.execute('DELETE FROM entry WHERE platform = :platform AND created_at < :horizon AND entry_id NOT IN (SELECT value FROM json_each(:ids) UNION ALL SELECT hash_entry_id(value) FROM json_each(:ids));', {'platform': platform, 'horizon': horizon, 'ids': json.dumps(entry_ids)})
+            tprint('* Maintenance of {}: {} entries pruned'.format(platform, res.rowcount))
+
+        s.execute("DELETE FROM outbox WHERE platform = ? AND state IN ('done', 'failed') AND updated_at < ?;", (platform, now - 7 * 86400))
+
+        if c.getboolean('hash_entry_ids', False):
+            s.execute("UPDATE OR IGNORE entry SET entry_id = hash_entry_id(entry_id) WHERE platform = ? AND typeof(entry_id) = 'text';", (platform, ))
+            # Left are the ids stored in both forms.
+            s.execute("DELETE FROM entry WHERE platform = ? AND typeof(entry_id) = 'text';", (platform, ))
+
+        s.execute('INSERT OR REPLACE INTO maintenance (platform, done_at) VALUES (?, ?);', (platform, now))
+
+    if retention > 0:
+        s.execute('DELETE FROM og WHERE fetched_at < ?;', (horizon, ))
+    s.commit()
+
+    # Incremental vacuum needs one full VACUUM to be turned on.  It needs the
+    # file to itself, so with another run in the middle of a write it is left
+    # to the next maintenance, the pruning above is kept anyway.
+    try:
+        if s.execute('PRAGMA auto_vacuum;').fetchone()[0] != 2:
+            tprint('* Maintenance: turning on incremental vacuum')
+            s.execute('PRAGMA auto_vacuum = INCREMENTAL;')
+            s.execute('VACUUM;')
+        s.execute('PRAGMA incremental_vacuum;').fetchall()
+        s.execute('ANALYZE;')
+        s.execute('PRAGMA optimize;')
+        s.execute('PRAGMA wal_checkpoint(TRUNCATE);').fetchall()
+    except sqlite3.OperationalError as e:
+        tprint('* Maintenance: skipping VACUUM until the next time: {}'.format(e))
+
+def new_http_client(config):
+    """Create the long-lived httpx.Client of a platform, shared by the feed,
+    media, upload, post and reply requests so connections are kept alive.
+    HTTP/2 is enabled by "http2 = true" in config.ini.
+    """
+    return httpx.Client(
+        http2=config['default'].getboolean('http2', False),
+        timeout=httpx.Timeout(30.0, connect=10.0, pool=10.0),
+        limits=httpx.Limits(max_connections=10, max_keepalive_connections=5, keepalive_expiry=60.0),
+    )
+
+def fetch_feed(http, s, platform, feed_url):
+    """Fetch and parse the feed with conditional GET.
+    Returns (feed, state), feed is None if the feed has not been changed since
+    the state saved by save_feed_state().
+    """
+    c = s.cursor()
+    c.execute('SELECT etag, modified, digest FROM feed WHERE platform = ? AND feed_url = ?;', (platform, feed_url))
+    row = c.fetchone()
+    etag, modified, digest = row if row else (None, None, None)
+
+    headers = {}
+    if etag:
+        headers['If-None-Match'] = etag
+    if modified:
+        headers['If-Modified-Since'] = modified
+
+    # httpx asks for gzip (and brotli when available) by itself.
+    res = http.get(feed_url, headers=headers, timeout=30.0, follow_redirects=True)
+    tprint('* Fetch feed: res = {}'.format(res))
+    if res.status_code == 304:
+        return None, None
+    res.raise_for_status()
+
+    state = (res.headers.get('ETag'), res.headers.get('Last-Modified'), hashlib.sha256(res.content).hexdigest())
+    if state[2] == digest:
+        # Same content, only keep the latest validators.
+        save_feed_state(s, platform, feed_url, state)
+        return None, state
+
+    # feedparser is only needed (and imported) when the feed has changed.
+    import feedparser
+    return feedparser.parse(res.content, response_headers=dict(res.headers)), state
+
+def get_feed(http, feed_url):
+    """Fetch and parse the whole feed, without conditional GET, for the
+    commands that need all of its entries.  Returns None if it cannot be
+    fetched.
+    """
+    try:
+        res = http.get(feed_url, timeout=30.0, follow_redirects=True)
+        res.raise_for_status()
+    except httpx.HTTPError as e:
+        tprint('* Exception fetching {}: {!r}'.format(feed_url, e))
+        return None
+
+    import feedparser
+    return feedparser.parse(res.content, response_headers=dict(res.headers))
+
+def save_feed_state(s, platform, feed_url, state):
+    etag, modified, digest = state
+    s.execute('INSERT OR REPLACE INTO feed (platform, feed_url, etag, modified, digest, updated_at) VALUES (?, ?, ?, ?, ?, ?);', (platform, feed_url, etag, modified, digest, int(time.time())))
+    s.commit()
+
+class Feed2Social(object):
+    _config = None
+    _http = None
+    keep_alive = False
+
+    def __init__(self):
+        # Platform objects, kept across the runs of the daemon so their
+        # clients, logins and connections stay warm.
+        self.instances = {}
+
+    @property
+    def http(self):
+        if self._http is None:
+            self._http = new_http_client(self.config)
+        return self._http
+
+    @property
+    def config(self):
+        if self._config is None:
+            home = os.environ['HOME']
+            f_conf = '{}/.config/feed2social/config.ini'.format(home)
+
+            self._config = configparser.ConfigParser()
+            self._config.read(f_conf)
+        return self._config
+
+    def get_platforms(self, platforms=None):
+        """Return the names of platforms (comma separated), each either a
+        platform or "<platform>:<account>" for the account in the section of
+        the same name.  "<platform>:*" stands for all accounts of platform.
+        """
+        if platforms is None:
+            platforms = self.config['default'].get('platforms', ','.join(PLATFORMS))
+
+        names = []
+        for name in [p.strip() for p in platforms.split(',') if p.strip()]:
+            platform, _, account = name.partition(':')
+            if platform not in PLATFORMS:
+                raise ValueError('Unknown platform: {}'.format(name))
+            if account == '*':
+                names.extend(section for section in self.config.sections() if section.startswith(platform + ':'))
+                continue
+            if account and not self.config.has_section(name):
+                raise ValueError('Unknown account: {}'.format(name))
+            names.append(name)
+        return names
+
+    def get_instance(self, platform):
+        # Every account has its own object, and so its own client, login and
+        # rate budget.
+        t = self.instances.get(platform)
+        if t is None:
+            module_name, class_name = PLATFORMS[platform.partition(':')[0]]
+            module = importlib.import_module(module_name)
+            t = getattr(module, class_name)(account=platform.partition(':')[2] or None)
+            if hasattr(t, 'keep_browser'):
+                t.keep_browser = self.keep_alive
+            self.instances[platform] = t
+        return t
+
+    def close_instance(self, platform):
+        t = self.instances.pop(platform, None)
+        if t is not None and hasattr(t, 'quit_browser'):
+            try:
+                t.quit_browser()
+            except Exception as e:
+                tprint('* Exception closing {}: {!r}'.format(platform, e))
+
+    def run_platform(self, platform, sync_only, feed):
+        """Hand feed to platform, returns False if entries are left to retry."""
+        threading.current_thread().name = platform
+
+        tprint('* Dispatching to {}'.format(platform))
+        try:
+            t = self.get_instance(platform)
+            return bool(t.main(sync_only=sync_only, feed=feed))
+        except (Exception, SystemExit) as e:
+            # One platform failing should not stop the others.  Its client
+            # may be broken, so start over with a new one next time.
+            tprint('* Exception from {}: {!r}'.format(platform, e))
+            self.close_instance(platform)
+            return False
+
+    def get_feeds(self, platforms=None):
+        """Return (name, feed_url, platforms, opt-out tags) of every
+        [feed:<name>] section, or of "feed_url" in [default] without any.
+        platforms overrides the platforms of every feed.
+        """
+        feeds = []
+        for section in self.config.sections():
+            if not section.startswith('feed:'):
+                continue
+            c = self.config[section]
+            tags = [tag.strip() for tag in c.get('opt_out', '').split(',') if tag.strip()]
+            feeds.append((section[len('feed:'):], c['url'], self.get_platforms(platforms or c.get('platforms')), tags))
+
+        if not feeds:
+            feeds.append((None, self.config['default']['feed_url'], self.get_platforms(platforms), []))
+        return feeds
+
+    def open_feed_state(self):
+        """Open the database keeping the feed state of the runner, the shared
+        one if "state_db" is set in config.ini.  It has no entries of its own,
+        so there is nothing to import as open_state() does.
+        """
+        f_db = self.config['default'].get('state_db') or '{}/.config/feed2social/feed2social.sqlite3'.format(os.environ['HOME'])
+        return open_db(os.path.expanduser(f_db), 'feed2social')
+
+    def state_key(self, name, platforms):
+        # The feed state depends on the platforms the feed is dispatched to,
+        # and is kept apart for every [feed:<name>] section.
+        key = ','.join(platforms)
+        if name is not None:
+            key = 'feed:{}:{}'.format(name, key)
+        return key
+
+    def fetch(self, name, feed_url, platforms):
+        """Fetch one feed with its own sqlite3 connection, as feeds are fetched
+        by many threads.  Returns (feed, state) as fetch_feed() does.
+        """
+        threading.current_thread().name = name or 'default'
+
+        key = self.state_key(name, platforms)
+        s = self.open_feed_state()
+        try:
+            return fetch_feed(self.http, s, key, feed_url)
+        finally:
+            s.close()
+
+    def dispatch(self, feed, platforms, sync_only, jobs):
+        """Hand feed to platforms, returns False if entries are left to retry."""
+        # Every platform posts in its own thread (with its own sqlite3
+        # connection), so an entry is out once the slowest platform is done,
+        # instead of after all of them in turn.  With many accounts, at most
+        # 16 of them by default, a slow account only holding up its thread.
+        if jobs is None:
+            jobs = self.config['default'].getint('jobs', min(len(platforms), 16))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+            futures = [executor.submit(self.run_platform, platform, sync_only, feed) for platform in platforms]
+        return all([f.result() for f in futures])
+
+    def main(self, platforms=None, sync_only=False, jobs=None):
+        tprint('* Started.')
+
+        feeds = self.get_feeds(platforms)
+
+        # Fetch and parse every feed only once, then hand the same result to
+        # every platform.  Feeds are fetched at the same time (at most
+        # "feed_jobs" of them), but posted one after another, as the
+        # platforms are shared by all feeds.
+        feed_jobs = self.config['default'].getint('feed_jobs', 4)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(feed_jobs, 1)) as executor:
+            futures = [executor.submit(self.fetch, name, feed_url, names) for name, feed_url, names, _ in feeds]
+
+        for (name, feed_url, names, tags), future in zip(feeds, futures):
+            tprint('* platforms of {} = {}'.format(feed_url, ','.join(names)))
+            try:
+                feed, state = future.result()
+            except Exception as e:
+                tprint('* Exception fetching {}: {!r}'.format(feed_url, e))
+                continue
+            if feed is None:
+                # Nothing new, but jobs in the outboxes of the platforms may
+                # be due.
+                tprint('* Feed not changed.')
+                feed = types.SimpleNamespace(entries=[])
+            else:
+                tprint('* {} entries in {}'.format(len(feed.entries), feed_url))
+
+            if tags and feed.entries:
+                # Opted out on every platform of this feed.
+                entries = list(feed.entries)
+                for tag in tags:
+                    entries = list(entries_not_opted_out(entries, tag))
+                import feedparser
+                feed = feedparser.FeedParserDict(feed, entries=entries)
+
+            # The platforms queue the entries in their outboxes (and retry them
+            # from there), so the feed is done once every platform has them.
+            if self.dispatch(feed, names, sync_only, jobs) and state is not None:
+                key = self.state_key(name, names)
+                s = self.open_feed_state()
+                save_feed_state(s, key, feed_url, state)
+                s.close()
+
+        try:
+            self.maintenance(platforms)
+        except Exception as e:
+            tprint('* Exception in maintenance: {!r}'.format(e))
+
+    def daemon(self, interval, platforms=None, sync_only=False, jobs=None):
+        """Run main() every interval seconds (with 10% jitter, so several
+        daemons do not poll in step) until SIGTERM or SIGINT, which let the
+        current run finish first.
+        """
+        self.keep_alive = True
+        stop = threading.Event()
+
+        def handle_signal(signum, frame):
+            tprint('* Got signal {}, stopping.'.format(signum))
+            stop.set()
+
+        signal.signal(signal.SIGTERM, handle_signal)
+        signal.signal(signal.SIGINT, handle_signal)
+
+        try:
+            while not stop.is_set():
+                try:
+                    self.main(platforms=platforms, sync_only=sync_only, jobs=jobs)
+                except Exception as e:
+                    # e.g. the feed being unreachable, try again next time.
+                    tprint('* Exception: {!r}'.format(e))
+
+                stop.wait(interval * random.uniform(0.9, 1.1))
+        finally:
+            for platform in list(self.instances):
+                self.close_instance(platform)
+
+        tprint('* Stopped.')
+
+    def pending(self, platforms=None):
+        home = os.environ['HOME']
+        f_shared = self.config['default'].get('state_db')
+
+        for name, feed_url, names, _ in self.get_feeds(platforms):
+            tprint('* {}:'.format(feed_url))
+
+            # The outbox is still listed when the feed cannot be fetched.
+            feed = get_feed(self.http, feed_url)
+            entry_ids = [item['id'] for item in reversed(feed.entries)] if feed is not None else []
+
+            f_dbs = {platform: '{}/.config/feed2social/feed2{}.sqlite3'.format(home, platform.partition(':')[0]) for platform in names}
+            if f_shared:
+                # Make sure the entries of every platform have been imported.
+                for platform in names:
+                    open_state(self.config, platform, f_dbs[platform]).close()
+                groups = [(os.path.expanduser(f_shared), names)]
+            else:
+                groups = [(f_dbs[platform], [platform]) for platform in names]
+
+            for f_db, group in groups:
+                s = open_db(f_db, group[0].partition(':')[0])
+                for platform, entry_id in select_pending(s, group, entry_ids):
+                    tprint('* {}: {}'.format(platform, entry_id))
+                for platform, kind, entry_id, state, attempts, error in select_outbox(s, group):
+                    tprint('* {}: {} of {} in outbox, {} after {} attempts ({})'.format(platform, kind, entry_id, state, attempts, error))
+                s.close()
+
+    def maintenance(self, platforms=None, force=False):
+        """Run maintain() on the state of platforms where due (or all of them
+        with force).  An entry in any feed of a platform is kept, so the feeds
+        are fetched again then.
+        """
+        home = os.environ['HOME']
+        f_shared = self.config['default'].get('state_db')
+
+        feeds = self.get_feeds(platforms)
+
+        groups = {}
+        for name, feed_url, names, _ in feeds:
+            for platform in names:
+                f_db = '{}/.config/feed2social/feed2{}.sqlite3'.format(home, platform.partition(':')[0])
+                if f_shared:
+                    # Make sure the entries of every platform have been imported.
+                    open_state(self.config, platform, f_db).close()
+                    f_db = os.path.expanduser(f_shared)
+                if platform not in groups.setdefault(f_db, []):
+                    groups[f_db].append(platform)
+
+        windows = None
+        for f_db, group in groups.items():
+            s = open_db(f_db, group[0].partition(':')[0])
+            due = [platform for platform in group if force or maintenance_due(s, self.config, platform)]
+            if due and windows is None:
+                windows = {}
+                for name, feed_url, names, _ in feeds:
+                    feed = get_feed(self.http, feed_url)
+                    entry_ids = [item['id'] for item in feed.entries] if feed is not None else []
+                    for platform in names:
+                        # Unknown if any of the feeds of platform is not
+                        # available.
+                        window = windows.get(platform, [])
+                        windows[platform] = window + entry_ids if entry_ids and window is not None else None
+
+            if due:
+                tprint('* Maintenance of {}: {}'.format(f_db, ','.join(due)))
+                maintain(s, self.config, {platform: windows[platform] for platform in due})
+            s.close()
+
+if '__main__' == __name__:
+    parser = argparse.ArgumentParser(description='Sync feed to multiple social networks')
+    parser.add_argument('--platforms',
+                        help='Comma separated platforms (or <platform>:<account>) to sync to (default: "platforms" in config, or all of {})'.format(','.join(PLATFORMS)))
+    parser.add_argument('--daemon', action='store_true',
+                        help='Keep running and poll the feed every --interval seconds, until SIGTERM')
+    parser.add_argument('--interval', type=float, default=60.0,
+                        help='Seconds between polls in --daemon mode (default: 60)')
+    parser.add_argument('--jobs', type=int,
+                        help='Platforms posting at the same time (default: "jobs" in config, or all of them up to 16)')
+    parser.add_argument('--maintenance', action='store_true',
+                        help='Prune and compact the state of the platforms now, then exit')
+    parser.add_argument('--pending', action='store_true',
+                        help='List entries in the feed not synced to each platform yet, then exit')
+    parser.add_argument('--sync-only', action='store_true',
+                        help='Only sync feed to database without posting')
+    args = parser.parse_args()
+
+    t = Feed2Social()
+    if args.maintenance:
+        t.maintenance(platforms=args.platforms, force=True)
+    elif args.pending:
+        t.pending(platforms=args.platforms)
+    elif args.daemon:
+        t.daemon(args.interval, platforms=args.platforms, sync_only=args.sync_only, jobs=args.jobs)
+    else:
+        t.main(platforms=args.platforms, sync_only=args.sync_only, jobs=args.jobs)
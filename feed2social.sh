@@ -0,0 +1,17 @@
+#!/bin/bash
+
+#
+# Support mise & pyenv & native environment:
+if command -v mise > /dev/null; then
+    eval "$(mise activate bash --shims)"
+elif [[ -d "${HOME}/.pyenv" ]]; then
+    export PATH="${HOME}/.pyenv/shims:${HOME}/.pyenv/bin:${PATH}"
+    eval "$(pyenv init -)"
+fi
+
+cd "$(dirname $0)"
+LANG=en_US.UTF-8 ./feed2social.py || true
+
+# Facebook is driven by Firefox, see feed2facebook.sh for details.
+pkill -P 1 geckodriver || true
+pkill -P 1 firefox-esr || true
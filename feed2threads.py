@@ -3,27 +3,625 @@
 import argparse
 import configparser
 import datetime
-import feedparser
-import html
+import hashlib
+import html.parser
 import json
 import os
 import re
 import httpx
 import sqlite3
+import threading
 import time
 import urllib
 
-from lxml.html.clean import Cleaner
 
 def tprint(*args, **kwargs):
     timestamp = datetime.datetime.now(datetime.timezone.utc).strftime('[%Y-%m-%dT%H:%M:%SZ]')
-    print(timestamp, *args, **kwargs)
+
+    # Platforms run concurrently by feed2social.py, tell their lines apart.
+    name = threading.current_thread().name
+    if name != 'MainThread':
+        timestamp += ' [{}]'.format(name)
+
+    # One write per line, so lines of other threads do not end up inside.
+    sep = kwargs.pop('sep', ' ')
+    end = kwargs.pop('end', '\n')
+    print(sep.join(str(arg) for arg in (timestamp, ) + args) + end, end='', **kwargs)
+
+# Schema migrations of the sqlite3 state, applied in order by open_db().  The
+# current version is kept in "PRAGMA user_version".
+MIGRATIONS = [
+    # 1: entry table with unique entry_id, replacing the hand-created table
+    # without any index (duplicated rows are dropped first).
+    [
+        'CREATE TABLE IF NOT EXISTS entry (entry_id VARCHAR, created_at INT);',
+        'DELETE FROM entry WHERE rowid NOT IN (SELECT MIN(rowid) FROM entry GROUP BY entry_id);',
+        'CREATE UNIQUE INDEX IF NOT EXISTS entry_entry_id ON entry (entry_id);',
+    ],
+    # 2: feed validators for conditional GET.
+    [
+        'CREATE TABLE IF NOT EXISTS feed (feed_url VARCHAR PRIMARY KEY, etag VARCHAR, modified VARCHAR, digest VARCHAR, updated_at INT);',
+    ],
+    # 3: key everything by platform, so one database can be shared by all
+    # platforms.  Existing rows belong to the platform opening the file.
+    [
+        'CREATE TABLE entry_new (platform VARCHAR NOT NULL, entry_id VARCHAR NOT NULL, created_at INT, PRIMARY KEY (platform, entry_id));',
+        'INSERT OR IGNORE INTO entry_new (platform, entry_id, created_at) SELECT :platform, entry_id, created_at FROM entry;',
+        'DROP TABLE entry;',
+        'ALTER TABLE entry_new RENAME TO entry;',
+        'CREATE TABLE feed_new (platform VARCHAR NOT NULL, feed_url VARCHAR NOT NULL, etag VARCHAR, modified VARCHAR, digest VARCHAR, updated_at INT, PRIMARY KEY (platform, feed_url));',
+        'INSERT INTO feed_new (platform, feed_url, etag, modified, digest, updated_at) SELECT :platform, feed_url, etag, modified, digest, updated_at FROM feed;',
+        'DROP TABLE feed;',
+        'ALTER TABLE feed_new RENAME TO feed;',
+    ],
+    # 4: rate limit windows reported by the platforms.
+    [
+        'CREATE TABLE rate_limit (platform VARCHAR NOT NULL, endpoint VARCHAR NOT NULL, rate_limit INT, remaining INT, reset_at INT, updated_at INT, PRIMARY KEY (platform, endpoint));',
+    ],
+    # 5: token buckets pacing the posts of the platforms.
+    [
+        'CREATE TABLE token_bucket (platform VARCHAR PRIMARY KEY, tokens REAL, updated_at REAL, blocked_until REAL);',
+    ],
+    # 6: Open Graph metadata of links, by normalized URL.
+    [
+        'CREATE TABLE og (url VARCHAR PRIMARY KEY, title VARCHAR, description VARCHAR, image_url VARCHAR, thumb VARCHAR, thumb_owner VARCHAR, etag VARCHAR, modified VARCHAR, ok INT, fetched_at INT, expires_at INT);',
+    ],
+    # 7: outbox of the posts and their "Sync from" replies.
+    [
+        'CREATE TABLE outbox (id INTEGER PRIMARY KEY AUTOINCREMENT, platform VARCHAR NOT NULL, entry_id VARCHAR NOT NULL, kind VARCHAR NOT NULL, payload VARCHAR, state VARCHAR NOT NULL, attempts INT, next_at REAL, error VARCHAR, created_at INT, updated_at INT, UNIQUE (platform, entry_id, kind));',
+        'CREATE INDEX outbox_due ON outbox (platform, kind, state, next_at);',
+    ],
+    # 8: last maintenance of the platforms.
+    [
+        'CREATE TABLE maintenance (platform VARCHAR PRIMARY KEY, done_at INT);',
+    ],
+]
+
+def hash_entry_id(entry_id):
+    """Fixed-width (16 bytes) key of entry_id, stored in the entry table
+    instead of the id itself with "hash_entry_ids = true".
+    """
+    return hashlib.sha256(entry_id.encode('utf-8')).digest()[:16]
+
+def entry_key(config, entry_id):
+    """Key of entry_id to store in the entry table.  Lookups match both
+    forms, so the setting can be changed at any time.
+    """
+    if config['default'].getboolean('hash_entry_ids', False):
+        return hash_entry_id(entry_id)
+    return entry_id
+
+def open_db(f_db, platform):
+    s = sqlite3.connect(f_db, timeout=30.0)
+    s.create_function('hash_entry_id', 1, hash_entry_id, deterministic=True)
+
+    # WAL lets platforms running at the same time read and write without
+    # blocking each other.
+    s.execute('PRAGMA journal_mode = WAL;')
+    s.execute('PRAGMA synchronous = NORMAL;')
+
+    version = s.execute('PRAGMA user_version;').fetchone()[0]
+    if version < len(MIGRATIONS):
+        s.execute('BEGIN IMMEDIATE;')
+
+        # Another process may have migrated it in the meantime.
+        version = s.execute('PRAGMA user_version;').fetchone()[0]
+        for i in range(version, len(MIGRATIONS)):
+            tprint('* Migrating {} to version {}'.format(f_db, i + 1))
+            for sql in MIGRATIONS[i]:
+                s.execute(sql, {'platform': platform})
+            s.execute('PRAGMA user_version = {};'.format(i + 1))
+
+        s.commit()
+
+    return s
+
+def open_state(config, platform, f_db):
+    """Open the state of platform, which is f_db, or the database shared by all
+    platforms if "state_db" is set in config.ini.  When switching to the shared
+    database, the entries, feed validators, outbox and rate budgets in f_db
+    are imported.
+
+    The entries of files from before accounts belong to the platform itself
+    ("bluesky" for "bluesky:acme"), so they are migrated and imported under
+    that key, and a new account starts without any synced entries.
+    """
+    owner = platform.partition(':')[0]
+
+    f_shared = config['default'].get('state_db')
+    if not f_shared:
+        return open_db(f_db, owner)
+
+    f_shared = os.path.expanduser(f_shared)
+    s = open_db(f_shared, owner)
+
+    if os.path.exists(f_db) and not os.path.samefile(f_db, f_shared) and s.execute('SELECT 1 FROM entry WHERE platform = ? LIMIT 1;', (owner, )).fetchone() is None:
+        tprint('* Importing {} into {}'.format(f_db, f_shared))
+
+        # Bring the old file to the current schema first.
+        open_db(f_db, owner).close()
+
+        s.execute('ATTACH DATABASE ? AS old;', (f_db, ))
+        s.execute('INSERT OR IGNORE INTO entry (platform, entry_id, created_at) SELECT platform, entry_id, created_at FROM old.entry;')
+        s.execute('INSERT OR IGNORE INTO feed (platform, feed_url, etag, modified, digest, updated_at) SELECT platform, feed_url, etag, modified, digest, updated_at FROM old.feed;')
+        s.execute('INSERT OR IGNORE INTO rate_limit (platform, endpoint, rate_limit, remaining, reset_at, updated_at) SELECT platform, endpoint, rate_limit, remaining, reset_at, updated_at FROM old.rate_limit;')
+        s.execute('INSERT OR IGNORE INTO token_bucket (platform, tokens, updated_at, blocked_until) SELECT platform, tokens, updated_at, blocked_until FROM old.token_bucket;')
+        # The ids are given anew, the jobs are told apart by (platform,
+        # entry_id, kind).
+        s.execute('INSERT OR IGNORE INTO outbox (platform, entry_id, kind, payload, state, attempts, next_at, error, created_at, updated_at) SELECT platform, entry_id, kind, payload, state, attempts, next_at, error, created_at, updated_at FROM old.outbox;')
+        s.commit()
+        s.execute('DETACH DATABASE old;')
+
+    return s
+
+def select_seen(s, platform, entry_ids):
+    """Return the set of entry_ids already in the entry table of platform,
+    stored as they are or hashed.
+    """
+    keys = {}
+    for entry_id in entry_ids:
+        keys[entry_id] = entry_id
+        keys[hash_entry_id(entry_id)] = entry_id
+    keys_list = list(keys)
+    seen = set()
+
+    c = s.cursor()
+
+    # Keep under SQLite's limit of host parameters per statement.
+    for i in range(0, len(keys_list), 500):
+        chunk = keys_list[i:i + 500]
+        c.execute('SELECT entry_id FROM entry WHERE platform = ? AND entry_id IN ({});'.format(','.join('?' * len(chunk))), [platform] + chunk)
+        seen.update(keys[row[0]] for row in c.fetchall())
+
+    return seen
+
+def entries_unseen(s, platform, items):
+    """Yield the entries not in the entry table of platform yet, oldest first."""
+    items = list(reversed(items))
+    seen = select_seen(s, platform, [item['id'] for item in items])
+
+    for item in items:
+        if item['id'] in seen:
+            continue
+        seen.add(item['id'])
+        yield item
+
+def maintenance_due(s, config, platform):
+    """Whether maintain() has not run for platform in "maintenance_interval"
+    hours (24 by default, 0 to only run it by hand).
+    """
+    interval = config['default'].getfloat('maintenance_interval', 24.0)
+    if interval <= 0:
+        return False
+
+    row = s.execute('SELECT done_at FROM maintenance WHERE platform = ?;', (platform, )).fetchone()
+    return row is None or row[0] + interval * 3600 <= time.time()
+
+def maintain(s, config, windows):
+    """Keep the state small for long-lived installs.  windows maps platforms
+    to the entry ids in their feeds (None if unknown).  Entries older than
+    "retention_days" (365 by default, 0 to keep them forever) and not in the
+    feeds any more are pruned, along with the outbox jobs finished a week ago
+    and the Open Graph metadata older than the horizon.  With
+    "hash_entry_ids = true", the stored entry ids are replaced by their
+    hashes.  The freed pages are then given back to the file system.
+    """
+    c = config['default']
+    now = int(time.time())
+    retention = c.getfloat('retention_days', 365.0)
+    horizon = now - retention * 86400
+
+    for platform, entry_ids in windows.items():
+        # Without the feed, an old entry still in it would be posted again.
+        if retention > 0 and entry_ids:
+            res = s.execute('DELETE FROM entry WHERE platform = :platform AND created_at < :horizon AND entry_id NOT IN (SELECT value FROM json_each(:ids) UNION ALL SELECT hash_entry_id(value) FROM json_each(:ids));', {'platform': platform, 'horizon': horizon, 'ids': json.dumps(entry_ids)})
+            tprint('* Maintenance of {}: {} entries pruned'.format(platform, res.rowcount))
+
+        s.execute("DELETE FROM outbox WHERE platform = ? AND state IN ('done', 'failed') AND updated_at < ?;", (platform, now - 7 * 86400))
+
+        if c.getboolean('hash_entry_ids', False):
+            s.execute("UPDATE OR IGNORE entry SET entry_id = hash_entry_id(entry_id) WHERE platform = ? AND typeof(entry_id) = 'text';", (platform, ))
+            # Left are the ids stored in both forms.
+            s.execute("DELETE FROM entry WHERE platform = ? AND typeof(entry_id) = 'text';", (platform, ))
+
+        s.execute('INSERT OR REPLACE INTO maintenance (platform, done_at) VALUES (?, ?);', (platform, now))
+
+    if retention > 0:
+        s.execute('DELETE FROM og WHERE fetched_at < ?;', (horizon, ))
+    s.commit()
+
+    # Incremental vacuum needs one full VACUUM to be turned on.  It needs the
+    # file to itself, so with another run in the middle of a write it is left
+    # to the next maintenance, the pruning above is kept anyway.
+    try:
+        if s.execute('PRAGMA auto_vacuum;').fetchone()[0] != 2:
+            tprint('* Maintenance: turning on incremental vacuum')
+            s.execute('PRAGMA auto_vacuum = INCREMENTAL;')
+            s.execute('VACUUM;')
+        s.execute('PRAGMA incremental_vacuum;').fetchall()
+        s.execute('ANALYZE;')
+        s.execute('PRAGMA optimize;')
+        s.execute('PRAGMA wal_checkpoint(TRUNCATE);').fetchall()
+    except sqlite3.OperationalError as e:
+        tprint('* Maintenance: skipping VACUUM until the next time: {}'.format(e))
+
+def entries_not_opted_out(items, tag):
+    """Skip the entries with the opt-out tag (e.g. "#nobluesky") by scanning the
+    raw description.  Mastodon marks up hashtags as "#<span>tag</span>", so
+    tags between "#" and the name are allowed.
+    """
+    pattern = re.compile('#(?:<[^>]*>)*' + re.escape(tag.lstrip('#')))
+
+    for item in items:
+        if pattern.search(item.get('description', '')):
+            tprint('* Skipping {}: {}'.format(item['id'], tag))
+            continue
+        yield item
+
+class TextRenderer(html.parser.HTMLParser):
+    """Render HTML into plain text in a single pass.  Paragraphs are separated
+    by an empty line, <br> and list items start a new line, and all other tags
+    are dropped with their text kept.  Rendering stops as soon as limit chars
+    have been emitted.
+    """
+    PARAGRAPH_TAGS = {'blockquote', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'ol', 'p', 'pre', 'ul'}
+    LINE_TAGS = {'div', 'li', 'tr'}
+    SKIP_TAGS = {'script', 'style', 'template'}
+
+    class Full(Exception):
+        pass
+
+    def __init__(self, limit=None):
+        super().__init__(convert_charrefs=True)
+        self.limit = limit
+        self.parts = []
+        self.length = 0
+        self.newlines = 0
+        self.skip = 0
+
+    def break_line(self, n):
+        self.newlines = max(self.newlines, n)
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.SKIP_TAGS:
+            self.skip += 1
+        elif tag == 'br':
+            self.newlines += 1
+        elif tag in self.PARAGRAPH_TAGS:
+            self.break_line(2)
+        elif tag in self.LINE_TAGS:
+            self.break_line(1)
+
+    def handle_endtag(self, tag):
+        if tag in self.SKIP_TAGS:
+            self.skip = max(self.skip - 1, 0)
+        elif tag in self.PARAGRAPH_TAGS:
+            self.break_line(2)
+        elif tag in self.LINE_TAGS:
+            self.break_line(1)
+
+    def handle_data(self, data):
+        if self.skip:
+            return
+
+        if self.length == 0 or self.newlines:
+            # Nothing emitted yet or at the start of a block, so the
+            # whitespace indenting the markup is trimmed, and runs of breaks
+            # are kept to one empty line.
+            data = data.lstrip()
+            if not data:
+                return
+            if self.length:
+                last = self.parts[-1].rstrip()
+                self.length -= len(self.parts[-1]) - len(last)
+                self.parts[-1] = last
+                data = '\n' * min(self.newlines, 2) + data
+        self.newlines = 0
+
+        self.parts.append(data)
+        self.length += len(data)
+        if self.limit is not None and self.length >= self.limit:
+            raise self.Full()
+
+    def text(self):
+        return ''.join(self.parts)[:self.limit].rstrip()
+
+def html_to_text(body, limit=None):
+    """Render HTML body into plain text of at most limit chars."""
+    r = TextRenderer(limit)
+    try:
+        r.feed(body)
+        r.close()
+    except TextRenderer.Full:
+        pass
+    return r.text()
+
+def new_http_client(config):
+    """Create the long-lived httpx.Client of a platform, shared by the feed,
+    media, upload, post and reply requests so connections are kept alive.
+    HTTP/2 is enabled by "http2 = true" in config.ini.
+    """
+    return httpx.Client(
+        http2=config['default'].getboolean('http2', False),
+        timeout=httpx.Timeout(30.0, connect=10.0, pool=10.0),
+        limits=httpx.Limits(max_connections=10, max_keepalive_connections=5, keepalive_expiry=60.0),
+    )
+
+def fetch_feed(http, s, platform, feed_url):
+    """Fetch and parse the feed with conditional GET.
+    Returns (feed, state), feed is None if the feed has not been changed since
+    the state saved by save_feed_state().
+    """
+    c = s.cursor()
+    c.execute('SELECT etag, modified, digest FROM feed WHERE platform = ? AND feed_url = ?;', (platform, feed_url))
+    row = c.fetchone()
+    etag, modified, digest = row if row else (None, None, None)
+
+    headers = {}
+    if etag:
+        headers['If-None-Match'] = etag
+    if modified:
+        headers['If-Modified-Since'] = modified
+
+    # httpx asks for gzip (and brotli when available) by itself.
+    res = http.get(feed_url, headers=headers, timeout=30.0, follow_redirects=True)
+    tprint('* Fetch feed: res = {}'.format(res))
+    if res.status_code == 304:
+        return None, None
+    res.raise_for_status()
+
+    state = (res.headers.get('ETag'), res.headers.get('Last-Modified'), hashlib.sha256(res.content).hexdigest())
+    if state[2] == digest:
+        # Same content, only keep the latest validators.
+        save_feed_state(s, platform, feed_url, state)
+        return None, state
+
+    # feedparser is only needed (and imported) when the feed has changed.
+    import feedparser
+    return feedparser.parse(res.content, response_headers=dict(res.headers)), state
+
+def save_feed_state(s, platform, feed_url, state):
+    etag, modified, digest = state
+    s.execute('INSERT OR REPLACE INTO feed (platform, feed_url, etag, modified, digest, updated_at) VALUES (?, ?, ?, ?, ?, ?);', (platform, feed_url, etag, modified, digest, int(time.time())))
+    s.commit()
+
+class RateLimited(Exception):
+    """Raised by the senders of Outbox.drain() to stop posting for this run,
+    leaving the job for a later run without counting it as a failure.
+    """
+
+class Outbox(object):
+    """Durable queue of the posts of a platform, kept in the outbox table.
+    Jobs are "pending" until done, retried with exponential backoff when they
+    fail, and "failed" after max_attempts.  A claimed job is "running" for
+    lease seconds, after which it is picked up again, so a crash in the
+    middle of a post does not lose it (but may post it twice).
+    """
+
+    def __init__(self, platform, max_attempts=8, backoff=60.0, max_backoff=6 * 3600.0, lease=600.0):
+        self.platform = platform
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.lease = lease
+
+    @classmethod
+    def from_config(cls, config, platform):
+        c = config['default']
+        return cls(
+            platform,
+            max_attempts=c.getint('outbox_max_attempts', 8),
+            backoff=c.getfloat('outbox_backoff', 60.0),
+            max_backoff=c.getfloat('outbox_max_backoff', 6 * 3600.0),
+        )
+
+    def add(self, s, entry_id, kind, payload):
+        """Queue a job, in the transaction of the caller (committed along with
+        the entry, so an entry is either queued or not seen at all).
+        """
+        now = time.time()
+        s.execute('INSERT OR IGNORE INTO outbox (platform, entry_id, kind, payload, state, attempts, next_at, created_at, updated_at) VALUES (?, ?, ?, ?, ?, 0, ?, ?, ?);', (self.platform, entry_id, kind, json.dumps(payload), 'pending', now, int(now), int(now)))
+
+    def claim(self, s, kind):
+        """Take the oldest due job of kind, or None.  Returns the payload with
+        "id", "entry_id" and "attempts" of the job added.
+        """
+        s.execute('BEGIN IMMEDIATE;')
+        now = time.time()
+        row = s.execute("SELECT id, entry_id, payload, attempts FROM outbox WHERE platform = ? AND kind = ? AND state IN ('pending', 'running') AND next_at <= ? ORDER BY id LIMIT 1;", (self.platform, kind, now)).fetchone()
+        if row is None:
+            s.commit()
+            return None
+
+        s.execute("UPDATE outbox SET state = 'running', next_at = ?, updated_at = ? WHERE id = ?;", (now + self.lease, int(now), row[0]))
+        s.commit()
+
+        job = json.loads(row[2])
+        job.update({'id': row[0], 'entry_id': row[1], 'attempts': row[3]})
+        return job
+
+    def done(self, s, job, reply=None):
+        """Mark job done, and queue reply (the payload of its "Sync from"
+        reply) in the same transaction.
+        """
+        s.execute("UPDATE outbox SET state = 'done', error = NULL, updated_at = ? WHERE id = ?;", (int(time.time()), job['id']))
+        if reply is not None:
+            self.add(s, job['entry_id'], 'reply', reply)
+        s.commit()
+
+    def retry(self, s, job, error):
+        """Count a failed attempt of job, and retry it later or give up."""
+        attempts = job['attempts'] + 1
+        now = time.time()
+        if attempts >= self.max_attempts:
+            tprint('* Giving up {} of {} after {} attempts: {}'.format(job['id'], job['entry_id'], attempts, error))
+            s.execute("UPDATE outbox SET state = 'failed', attempts = ?, error = ?, updated_at = ? WHERE id = ?;", (attempts, error, int(now), job['id']))
+        else:
+            delay = min(self.backoff * 2 ** (attempts - 1), self.max_backoff)
+            tprint('* Retrying {} of {} in {:.0f} seconds: {}'.format(job['id'], job['entry_id'], delay, error))
+            s.execute("UPDATE outbox SET state = 'pending', attempts = ?, next_at = ?, error = ?, updated_at = ? WHERE id = ?;", (attempts, now + delay, error, int(now), job['id']))
+        s.commit()
+
+    def release(self, s, job):
+        """Put job back as it was, e.g. when rate limited."""
+        now = time.time()
+        s.execute("UPDATE outbox SET state = 'pending', next_at = ?, updated_at = ? WHERE id = ?;", (now, int(now), job['id']))
+        s.commit()
+
+    def drain(self, s, senders):
+        """Run the due jobs with senders, a list of (kind, send) in priority
+        order, so every main post goes out before the replies.  send(s, job)
+        returns the payload of the reply to queue (a dict) or True when done,
+        None when failed.  Returns False if stopped by RateLimited.
+        """
+        for kind, send in senders:
+            while True:
+                job = self.claim(s, kind)
+                if job is None:
+                    break
+
+                tprint('* Outbox: {} of {} (attempt {})'.format(kind, job['entry_id'], job['attempts'] + 1))
+                try:
+                    res = send(s, job)
+                except RateLimited:
+                    self.release(s, job)
+                    return False
+                except Exception as e:
+                    s.rollback()
+                    self.retry(s, job, repr(e))
+                    continue
+
+                if res is None:
+                    self.retry(s, job, 'failed')
+                else:
+                    self.done(s, job, res if isinstance(res, dict) else None)
+        return True
+
+class TokenBucket(object):
+    """Token bucket pacing the posts of a platform: up to burst posts at once,
+    refilled at rate posts per minute.  The bucket is kept in the token_bucket
+    table, so the pace carries over from one run to the next, and a server
+    asking to back off (Retry-After) holds every run until then.
+    """
+
+    def __init__(self, platform, rate, burst, max_wait=60.0):
+        self.platform = platform
+        self.rate = rate
+        self.burst = burst
+        self.max_wait = max_wait
+
+    @classmethod
+    def from_config(cls, config, platform, rate, burst, name=None):
+        # Accounts share the settings of the platform (overridden in their own
+        # section), but each one has its own bucket, kept under name.
+        c = config['default']
+        return cls(
+            name or platform,
+            c.getfloat('{}_rate'.format(platform), rate),
+            c.getfloat('{}_burst'.format(platform), burst),
+            max_wait=c.getfloat('{}_max_wait'.format(platform), 60.0),
+        )
+
+    def acquire(self, s):
+        """Take a token, sleeping for it if it comes within max_wait seconds.
+        Returns False if it does not, so the post is left for a later run.
+        """
+        while True:
+            s.execute('BEGIN IMMEDIATE;')
+            now = time.time()
+            row = s.execute('SELECT tokens, updated_at, blocked_until FROM token_bucket WHERE platform = ?;', (self.platform, )).fetchone()
+            if row is None:
+                tokens, blocked_until = self.burst, 0.0
+            else:
+                tokens = min(self.burst, row[0] + max(now - row[1], 0.0) * self.rate / 60.0)
+                blocked_until = row[2] or 0.0
+
+            if blocked_until > now:
+                wait = blocked_until - now
+            elif tokens >= 1:
+                s.execute('INSERT OR REPLACE INTO token_bucket (platform, tokens, updated_at, blocked_until) VALUES (?, ?, ?, ?);', (self.platform, tokens - 1, now, blocked_until))
+                s.commit()
+                return True
+            else:
+                wait = (1 - tokens) * 60.0 / self.rate
+            s.rollback()
+
+            if wait > self.max_wait:
+                tprint('* Rate limit of {}: next post at {} (local time)'.format(self.platform, datetime.datetime.fromtimestamp(now + wait)))
+                return False
+
+            tprint('* Rate limit of {}: waiting {:.1f} seconds'.format(self.platform, wait))
+            time.sleep(wait)
+
+    def defer(self, s, seconds):
+        """Hold all posts for seconds, and restart with an empty bucket."""
+        tprint('* Rate limited by {}, holding posts for {:.0f} seconds'.format(self.platform, seconds))
+        now = time.time()
+        s.execute('INSERT OR REPLACE INTO token_bucket (platform, tokens, updated_at, blocked_until) VALUES (?, 0, ?, ?);', (self.platform, now, now + seconds))
+        s.commit()
+
+def retry_after(headers, default=300.0):
+    """Seconds to back off from the Retry-After (seconds or HTTP date) or
+    RateLimit-Reset (epoch seconds) header, or default without them.
+    """
+    headers = {k.lower(): v for k, v in (headers or {}).items()}
+
+    value = headers.get('retry-after')
+    if value:
+        try:
+            return max(float(value), 0.0)
+        except ValueError:
+            import email.utils
+            try:
+                return max(email.utils.parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+            except (TypeError, ValueError):
+                pass
+
+    value = headers.get('ratelimit-reset')
+    if value:
+        try:
+            return max(float(value) - time.time(), 0.0)
+        except ValueError:
+            pass
+
+    return default
 
 class Feed2Threads(object):
+    _bucket = None
     _config = None
+    _http = None
+    _outbox = None
+    account = None
+    platform = 'threads'
 
-    def __init__(self):
-        pass
+    def __init__(self, account=None):
+        self.account = account
+
+    @property
+    def bucket(self):
+        if self._bucket is None:
+            self._bucket = TokenBucket.from_config(self.config, self.platform, 0.3, 10, name=self.name)
+        return self._bucket
+
+    @property
+    def outbox(self):
+        if self._outbox is None:
+            self._outbox = Outbox.from_config(self.config, self.name)
+        return self._outbox
+
+    @property
+    def http(self):
+        if self._http is None:
+            self._http = new_http_client(self.config)
+        return self._http
+
+    @property
+    def name(self):
+        # State key of the account: the entries, feed state and rate budget of
+        # every account are kept apart.
+        if self.account is None:
+            return self.platform
+        return '{}:{}'.format(self.platform, self.account)
 
     @property
     def config(self):
@@ -33,34 +631,320 @@ class Feed2Threads(object):
 
             self._config = configparser.ConfigParser()
             self._config.read(f_conf)
-        return self._config
 
-    def main(self, sync_only=False):
-        tprint('* Started.')
-
-        if sync_only:
-            tprint('* sync_only mode: will not post to Threads')
+            # Settings in the section of the account ([<platform>:<account>])
+            # override the ones in [default].
+            if self.account is not None:
+                for key, value in self._config.items(self.name, raw=True):
+                    self._config.set('default', key, value)
+        return self._config
 
-        home = os.environ['HOME']
-        f_db = '{}/.config/feed2social/feed2threads.sqlite3'.format(home)
+    def create_container(self, content, image_url=None):
+        """Step 1: create the media container of a post."""
+        c = self.config
+        threads_access_token = c['default']['threads_access_token']
+        threads_user_id = c['default']['threads_user_id']
 
+        if image_url:
+            # Post with image
+            res = self.http.post('https://graph.threads.net/{}/threads'.format(threads_user_id), data={
+                'media_type': 'IMAGE',
+                'image_url': image_url,
+                'text': content,
+                'access_token': threads_access_token,
+            }, timeout=60)
+        else:
+            # Post text only
+            res = self.http.post('https://graph.threads.net/{}/threads?text={}&access_token={}&media_type=TEXT'.format(threads_user_id, urllib.parse.quote_plus(content), urllib.parse.quote_plus(threads_access_token)), timeout=60)
+
+        tprint('* Step 1 - Create container: res = {}'.format(res))
+        tprint('* Step 1 - res.text = {}'.format(res.text))
+        return res
+
+    def create_reply_container(self, post_id, url):
+        """Step 1 of the reply: create the container of "Sync from: url"."""
+        res = self.http.post('https://graph.threads.net/v1.0/me/threads', data={
+            'media_type': 'TEXT',
+            'text': f'Sync from: {url}',
+            'reply_to_id': post_id,
+            'access_token': self.config['default']['threads_access_token'],
+        }, timeout=60)
+        tprint('* Reply Step 1 - Create container: res = {}'.format(res))
+        tprint('* Reply Step 1 - res.text = {}'.format(res.text))
+        return res
+
+    def publish_container(self, creation_id):
+        """Step 2: publish a container.  Returns the id of the post, or None."""
         c = self.config
-        feed_url = c['default']['feed_url']
         threads_access_token = c['default']['threads_access_token']
         threads_user_id = c['default']['threads_user_id']
 
-        feed = feedparser.parse(feed_url)
-        items = feed.entries
+        res = self.http.post('https://graph.threads.net/{}/threads_publish?creation_id={}&access_token={}'.format(threads_user_id, urllib.parse.quote_plus(creation_id), urllib.parse.quote_plus(threads_access_token)), timeout=60)
+        tprint('* Step 2 - Publish: res = {}'.format(res))
+        tprint('* Step 2 - res.text = {}'.format(res.text))
+
+        if res.status_code == 200:
+            return self.res_json(res).get('id')
+        return None
+
+    def fetch_status(self, creation_ids):
+        """Look up the status of many containers with one request per 50 ids
+        (the limit of the "ids" parameter of the Graph API).
+        """
+        threads_access_token = self.config['default']['threads_access_token']
+
+        status = {}
+        for i in range(0, len(creation_ids), 50):
+            res = self.http.get('https://graph.threads.net/v1.0/', params={
+                'ids': ','.join(creation_ids[i:i + 50]),
+                'fields': 'status',
+                'access_token': threads_access_token,
+            }, timeout=60)
+            tprint('* Status: res = {}'.format(res))
+            tprint('* Status: res.text = {}'.format(res.text))
+
+            if res.status_code == 200:
+                for creation_id, v in self.res_json(res).items():
+                    status[creation_id] = v.get('status', 'UNKNOWN') if isinstance(v, dict) else 'UNKNOWN'
+        return status
+
+    def publish_pipelined(self, jobs, timeout=300):
+        """Publish the containers of jobs in order, each one as soon as it and
+        every job before it are done processing.  All pending containers are
+        polled together, and the poll interval grows while nothing changes.
+        Sets "post_id" of the published jobs.
+        """
+        done = ('FINISHED', 'ERROR', 'EXPIRED')
+        queue = list(jobs)
+        status = {}
+        interval = 1.0
+        deadline = time.time() + timeout
+
+        while queue and time.time() < deadline:
+            time.sleep(interval)
+
+            pending = [job['creation_id'] for job in queue if status.get(job['creation_id']) not in done]
+            new_status = self.fetch_status(pending)
+            changed = any(new_status.get(i) != status.get(i) for i in pending)
+            status.update(new_status)
+
+            while queue and status.get(queue[0]['creation_id']) in done:
+                job = queue.pop(0)
+                if status[job['creation_id']] == 'FINISHED':
+                    job['post_id'] = self.publish_container(job['creation_id'])
+                else:
+                    tprint('* Container {} of {}: {}'.format(job['creation_id'], job['entry_id'], status[job['creation_id']]))
+
+            interval = 1.0 if changed else min(interval * 2, 15.0)
+
+        for job in queue:
+            tprint('* Container {} of {} not ready after {} seconds'.format(job['creation_id'], job['entry_id'], timeout))
+
+    def res_json(self, res):
+        # The body as a dict, or an empty one when it is not JSON (such as the
+        # error pages of 5xx responses).
+        try:
+            data = res.json()
+        except ValueError:
+            return {}
+        return data if isinstance(data, dict) else {}
+
+    def is_invalid_link(self, res):
+        # Invalid link attachment error (OAuthException, code=-1, error_subcode=4279047)
+        error = self.res_json(res).get('error') or {}
+        return (error.get('type') == 'OAuthException' and
+                error.get('code') == -1 and
+                error.get('error_subcode') == 4279047)
+
+    def is_rate_limited(self, s, res):
+        # HTTP 429, or one of the rate limit error codes of the Graph API.
+        # Holds the following posts until the server is willing again.
+        error = self.res_json(res).get('error') or {}
+        if res.status_code == 429 or error.get('code') in (4, 17, 32, 613):
+            self.bucket.defer(s, retry_after(res.headers))
+            return True
+        return False
+
+    def insert_entry(self, s, id_str):
+        s.execute('INSERT INTO entry (platform, entry_id, created_at) VALUES (?, ?, ?);', (self.name, entry_key(self.config, id_str), int(time.time())))
+        s.commit()
+
+    def send_post(self, s, job):
+        """Post the entry of job, waiting for its container.  Returns the
+        payload of its reply.
+        """
+        content = job['content']
+        image_url = job['image_url']
+
+        if not self.bucket.acquire(s):
+            raise RateLimited()
+
+        # Post to Threads.
+        #
+        # Step 1: Create media container
+        res = self.create_container(content, image_url)
+        if res.status_code != 200:
+            if self.is_rate_limited(s, res):
+                raise RateLimited()
+            if self.is_invalid_link(res):
+                tprint('* Invalid link attachment error, marking as processed and skipping')
+                return True
+            tprint('* Error creating container, skipping')
+            return None
+
+        creation_id = self.res_json(res).get('id')
+        if creation_id is None:
+            tprint('* No container id in the response, skipping')
+            return None
+
+        tprint('* Waiting 10 seconds for Threads API processing...')
+        time.sleep(10)
+
+        # Step 1.5: Poll status for image containers
+        if image_url:
+            tprint('* Polling container status for image...')
+            max_attempts = 10
+            poll_interval = 3  # seconds
+            status = 'IN_PROGRESS'
+
+            for attempt in range(max_attempts):
+                time.sleep(poll_interval)
+                status_res = self.http.get('https://graph.threads.net/v1.0/{}?fields=status&access_token={}'.format(
+                    creation_id, urllib.parse.quote_plus(self.config['default']['threads_access_token'])
+                ), timeout=60)
+                tprint('* Attempt {}/{}: status_res = {}'.format(attempt + 1, max_attempts, status_res))
+                tprint('* status_res.text = {}'.format(status_res.text))
+
+                if status_res.status_code == 200:
+                    status = self.res_json(status_res).get('status', 'UNKNOWN')
+                    tprint('* Container status: {}'.format(status))
+                    if status == 'FINISHED':
+                        break
+                    elif status == 'ERROR':
+                        tprint('* Container processing failed')
+                        break
+
+            if status != 'FINISHED':
+                tprint('* Container not ready after {} attempts, skipping'.format(max_attempts))
+                return None
+
+        # Step 2: Publish container
+        post_id = self.publish_container(creation_id)
+        if post_id is None:
+            tprint('* Error publishing container')
+            return None
+
+        return {'url': job['url'], 'post_id': post_id}
+
+    def send_reply(self, s, job):
+        """Append the feed entry url of job into the replies."""
+        if not self.bucket.acquire(s):
+            raise RateLimited()
+
+        res = self.create_reply_container(job['post_id'], job['url'])
+        if res.status_code == 200 and 'id' in self.res_json(res):
+            return True if self.publish_container(self.res_json(res)['id']) else None
+        if self.is_rate_limited(s, res):
+            raise RateLimited()
+        tprint('* Error creating reply container')
+        return None
+
+    def drain_pipelined(self, s):
+        """Like Outbox.drain(), but create the containers of all due posts up
+        front, then publish them as they finish processing, and afterwards
+        the same for the replies.  Returns False if rate limited.
+        """
+        for kind in ('post', 'reply'):
+            created = []
+            limited = False
+            while True:
+                job = self.outbox.claim(s, kind)
+                if job is None:
+                    break
+
+                if not self.bucket.acquire(s):
+                    self.outbox.release(s, job)
+                    limited = True
+                    break
+
+                tprint('* Creating {} container of {}'.format(kind, job['entry_id']))
+                try:
+                    if kind == 'post':
+                        res = self.create_container(job['content'], job['image_url'])
+                    else:
+                        res = self.create_reply_container(job['post_id'], job['url'])
+                    creation_id = self.res_json(res).get('id') if res.status_code == 200 else None
+                except Exception as e:
+                    tprint('* Exception creating container: {!r}'.format(e))
+                    s.rollback()
+                    self.outbox.retry(s, job, repr(e))
+                    continue
 
-        s = sqlite3.connect(f_db)
+                if creation_id is not None:
+                    job['creation_id'] = creation_id
+                    created.append(job)
+                elif self.is_rate_limited(s, res):
+                    self.outbox.release(s, job)
+                    limited = True
+                    break
+                elif kind == 'post' and self.is_invalid_link(res):
+                    tprint('* Invalid link attachment error, marking as processed and skipping')
+                    self.outbox.done(s, job)
+                else:
+                    tprint('* Error creating container, skipping')
+                    self.outbox.retry(s, job, 'HTTP {}'.format(res.status_code))
+
+            # The jobs published before anything goes wrong are marked done
+            # whatever happens, or they would be posted again once their
+            # lease runs out.
+            try:
+                self.publish_pipelined(created)
+            except Exception as e:
+                tprint('* Exception publishing containers: {!r}'.format(e))
+            finally:
+                for job in created:
+                    if not job.get('post_id'):
+                        self.outbox.retry(s, job, 'not published')
+                    elif kind == 'post':
+                        self.outbox.done(s, job, {'url': job['url'], 'post_id': job['post_id']})
+                    else:
+                        self.outbox.done(s, job)
 
-        sql_insert = 'INSERT INTO entry (entry_id, created_at) VALUES (?, ?);'
-        sql_select = 'SELECT COUNT(*) FROM entry WHERE entry_id = ?;'
+            if limited:
+                return False
+        return True
 
-        # Workaround: cannot use allow_tags=[]:
-        cl = Cleaner(allow_tags=['p'])
+    def main(self, sync_only=False, feed=None, pipeline=None):
+        tprint('* Started.')
 
-        for item in reversed(items):
+        if sync_only:
+            tprint('* sync_only mode: will not post to Threads')
+
+        if pipeline is None:
+            pipeline = self.config['default'].getboolean('threads_pipeline', False)
+
+        home = os.environ['HOME']
+        f_db = '{}/.config/feed2social/feed2threads.sqlite3'.format(home)
+
+        s = open_state(self.config, self.name, f_db)
+
+        state = None
+        if feed is None:
+            feed_url = self.config['default']['feed_url']
+            try:
+                feed, state = fetch_feed(self.http, s, self.name, feed_url)
+                if feed is None:
+                    # Nothing new, but jobs in the outbox may be due.
+                    tprint('* Feed not changed.')
+            except Exception as e:
+                # The jobs in the outbox are still drained below, so retries
+                # do not wait for the feed to be back.
+                tprint('* Exception fetching {}: {!r}'.format(feed_url, e))
+        items = feed.entries if feed is not None else []
+
+        # Cheap checks first, so already synced and opted out entries never
+        # reach the HTML cleaning and media scanning below.
+        for item in entries_not_opted_out(entries_unseen(s, self.name, items), '#nothreads'):
             body = item['description']
 
             # Print out item's id.
@@ -79,157 +963,51 @@ class Feed2Threads(object):
                 tprint('* Skipping: empty body and no image')
                 continue
 
-            # Craft "body".
-            #
-            # First to remove all tags except "a" and root's "div".
-            if body and body.strip():
-                body = cl.clean_html(body)
+            # Render "body" as plain text, limited to 400 chars.
+            body = html_to_text(body or '', 400)
 
-                # Skip if there is '#nothreads' tag.
-                if '#nothreads' in body:
-                    continue
+            # Generate parameters.
+            id_str = item['id']
+            url = item['link']
 
-                # Remove root's "div".
-                body = body.replace('<div>', '').replace('</div>', '')
+            content = body
+            tprint('* content = {}'.format(content))
 
-                # <p> and </p>
-                body = body.replace('<p>', '\n').replace('</p>', '\n')
+            if sync_only:
+                tprint('* sync_only: skipping post to Threads')
+                self.insert_entry(s, id_str)
+                continue
 
-                # trim
-                body = body.strip()
+            # Queue the post along with the entry, it is sent (and retried)
+            # from the outbox below.
+            self.outbox.add(s, id_str, 'post', {'content': content, 'image_url': image_url, 'url': url})
+            self.insert_entry(s, id_str)
 
-                # unescape
-                body = html.unescape(body)
+        if state is not None:
+            save_feed_state(s, self.name, feed_url, state)
 
-                # Limit to 400 chars.
-                body = body[0:400]
+        if not sync_only:
+            if pipeline:
+                self.drain_pipelined(s)
             else:
-                body = ''
-
-            # Generate parameters.
-            id_str = item['id']
-            url = item['link']
+                self.outbox.drain(s, [('post', self.send_post), ('reply', self.send_reply)])
 
-            c = s.cursor()
+        # The whole feed is only at hand when fetched here, the runner takes
+        # care of it by itself.
+        if state is not None and items and maintenance_due(s, self.config, self.name):
+            maintain(s, self.config, {self.name: [item['id'] for item in items]})
 
-            c.execute(sql_select, (id_str, ))
-            if 0 == c.fetchone()[0]:
-                content = body
-                tprint('* content = {}'.format(content))
-
-                if sync_only:
-                    tprint('* sync_only: skipping post to Threads')
-                    c.execute(sql_insert, (id_str, int(time.time())))
-                    s.commit()
-                    continue
-
-                try:
-                    # Post to Threads.
-                    #
-                    # Step 1: Create media container
-                    if image_url:
-                        # Post with image
-                        res = httpx.post('https://graph.threads.net/{}/threads'.format(threads_user_id), data={
-                            'media_type': 'IMAGE',
-                            'image_url': image_url,
-                            'text': content,
-                            'access_token': threads_access_token,
-                        }, timeout=60)
-                    else:
-                        # Post text only
-                        res = httpx.post('https://graph.threads.net/{}/threads?text={}&access_token={}&media_type=TEXT'.format(threads_user_id, urllib.parse.quote_plus(content), urllib.parse.quote_plus(threads_access_token)), timeout=60)
-
-                    tprint('* Step 1 - Create container: res = {}'.format(res))
-                    tprint('* Step 1 - res.text = {}'.format(json.dumps(res.json(), ensure_ascii=False)))
-                    if res.status_code != 200:
-                        # Check for invalid link attachment error (OAuthException, code=-1, error_subcode=4279047)
-                        res_json = res.json()
-                        error = res_json.get('error', {})
-                        if (error.get('type') == 'OAuthException' and
-                            error.get('code') == -1 and
-                            error.get('error_subcode') == 4279047):
-                            tprint('* Invalid link attachment error, marking as processed and skipping')
-                            c.execute(sql_insert, (id_str, int(time.time())))
-                            s.commit()
-                            continue
-                        tprint('* Error creating container, skipping')
-                        continue
-
-                    creation_id = res.json()['id']
-
-                    tprint('* Waiting 10 seconds for Threads API processing...')
-                    time.sleep(10)
-
-                    # Step 1.5: Poll status for image containers
-                    if image_url:
-                        tprint('* Polling container status for image...')
-                        max_attempts = 10
-                        poll_interval = 3  # seconds
-                        status = 'IN_PROGRESS'
-
-                        for attempt in range(max_attempts):
-                            time.sleep(poll_interval)
-                            status_res = httpx.get('https://graph.threads.net/v1.0/{}?fields=status&access_token={}'.format(
-                                creation_id, urllib.parse.quote_plus(threads_access_token)
-                            ), timeout=60)
-                            tprint('* Attempt {}/{}: status_res = {}'.format(attempt + 1, max_attempts, status_res))
-                            tprint('* status_res.text = {}'.format(json.dumps(status_res.json(), ensure_ascii=False)))
-
-                            if status_res.status_code == 200:
-                                status = status_res.json().get('status', 'UNKNOWN')
-                                tprint('* Container status: {}'.format(status))
-                                if status == 'FINISHED':
-                                    break
-                                elif status == 'ERROR':
-                                    tprint('* Container processing failed')
-                                    break
-
-                        if status != 'FINISHED':
-                            tprint('* Container not ready after {} attempts, skipping'.format(max_attempts))
-                            continue
-
-                    # Step 2: Publish container
-                    res = httpx.post('https://graph.threads.net/{}/threads_publish?creation_id={}&access_token={}'.format(threads_user_id, urllib.parse.quote_plus(creation_id), urllib.parse.quote_plus(threads_access_token)), timeout=60)
-                    tprint('* Step 2 - Publish: res = {}'.format(res))
-                    tprint('* Step 2 - res.text = {}'.format(json.dumps(res.json(), ensure_ascii=False)))
-
-                    if res.status_code == 200 and 'id' in res.json():
-                        post_id = res.json()['id']
-                        c.execute(sql_insert, (id_str, int(time.time())))
-                        s.commit()
-
-                        # Append feed entry url into replies.
-                        #
-                        # Step 1: Create reply container
-                        res = httpx.post('https://graph.threads.net/v1.0/me/threads', data={
-                            'media_type': 'TEXT',
-                            'text': f'Sync from: {url}',
-                            'reply_to_id': post_id,
-                            'access_token': threads_access_token,
-                        }, timeout=60)
-                        tprint('* Reply Step 1 - Create container: res = {}'.format(res))
-                        tprint('* Reply Step 1 - res.text = {}'.format(json.dumps(res.json(), ensure_ascii=False)))
-
-                        if res.status_code == 200 and 'id' in res.json():
-                            # Step 2: Publish reply
-                            creation_id = res.json()['id']
-                            res = httpx.post('https://graph.threads.net/{}/threads_publish?creation_id={}&access_token={}'.format(threads_user_id, urllib.parse.quote_plus(creation_id), urllib.parse.quote_plus(threads_access_token)), timeout=60)
-                            tprint('* Reply Step 2 - Publish: res = {}'.format(res))
-                            tprint('* Reply Step 2 - res.text = {}'.format(json.dumps(res.json(), ensure_ascii=False)))
-                        else:
-                            tprint('* Error creating reply container')
-                    else:
-                        tprint('* Error publishing container')
-                        s.rollback()
-                except (httpx.TimeoutException, httpx.ConnectError) as e:
-                    tprint('* Network error ({}), skipping this item'.format(type(e).__name__))
-                    continue
+        return True
 
 if '__main__' == __name__:
     parser = argparse.ArgumentParser(description='Sync feed to Threads')
+    parser.add_argument('--account',
+                        help='Post with the account in the [threads:<account>] section of config.ini instead of [default]')
+    parser.add_argument('--pipeline', action='store_true', default=None,
+                        help='Create the containers of all new entries first, then publish them as they finish processing')
     parser.add_argument('--sync-only', action='store_true',
                         help='Only sync feed to database without posting to Threads')
     args = parser.parse_args()
 
-    t = Feed2Threads()
-    t.main(sync_only=args.sync_only)
+    t = Feed2Threads(account=args.account)
+    t.main(sync_only=args.sync_only, pipeline=args.pipeline)
@@ -3,28 +3,825 @@
 import argparse
 import configparser
 import datetime
-import feedparser
-import html
+import hashlib
+import html.parser
 import httpx
 import io
 import json
 import os
 import re
 import sqlite3
+import tempfile
+import threading
 import time
 
-from authlib.integrations.httpx_client import OAuth1Auth
-from lxml.html.clean import Cleaner
-
 def tprint(*args, **kwargs):
     timestamp = datetime.datetime.now(datetime.timezone.utc).strftime('[%Y-%m-%dT%H:%M:%SZ]')
-    print(timestamp, *args, **kwargs)
+
+    # Platforms run concurrently by feed2social.py, tell their lines apart.
+    name = threading.current_thread().name
+    if name != 'MainThread':
+        timestamp += ' [{}]'.format(name)
+
+    # One write per line, so lines of other threads do not end up inside.
+    sep = kwargs.pop('sep', ' ')
+    end = kwargs.pop('end', '\n')
+    print(sep.join(str(arg) for arg in (timestamp, ) + args) + end, end='', **kwargs)
+
+# Schema migrations of the sqlite3 state, applied in order by open_db().  The
+# current version is kept in "PRAGMA user_version".
+MIGRATIONS = [
+    # 1: entry table with unique entry_id, replacing the hand-created table
+    # without any index (duplicated rows are dropped first).
+    [
+        'CREATE TABLE IF NOT EXISTS entry (entry_id VARCHAR, created_at INT);',
+        'DELETE FROM entry WHERE rowid NOT IN (SELECT MIN(rowid) FROM entry GROUP BY entry_id);',
+        'CREATE UNIQUE INDEX IF NOT EXISTS entry_entry_id ON entry (entry_id);',
+    ],
+    # 2: feed validators for conditional GET.
+    [
+        'CREATE TABLE IF NOT EXISTS feed (feed_url VARCHAR PRIMARY KEY, etag VARCHAR, modified VARCHAR, digest VARCHAR, updated_at INT);',
+    ],
+    # 3: key everything by platform, so one database can be shared by all
+    # platforms.  Existing rows belong to the platform opening the file.
+    [
+        'CREATE TABLE entry_new (platform VARCHAR NOT NULL, entry_id VARCHAR NOT NULL, created_at INT, PRIMARY KEY (platform, entry_id));',
+        'INSERT OR IGNORE INTO entry_new (platform, entry_id, created_at) SELECT :platform, entry_id, created_at FROM entry;',
+        'DROP TABLE entry;',
+        'ALTER TABLE entry_new RENAME TO entry;',
+        'CREATE TABLE feed_new (platform VARCHAR NOT NULL, feed_url VARCHAR NOT NULL, etag VARCHAR, modified VARCHAR, digest VARCHAR, updated_at INT, PRIMARY KEY (platform, feed_url));',
+        'INSERT INTO feed_new (platform, feed_url, etag, modified, digest, updated_at) SELECT :platform, feed_url, etag, modified, digest, updated_at FROM feed;',
+        'DROP TABLE feed;',
+        'ALTER TABLE feed_new RENAME TO feed;',
+    ],
+    # 4: rate limit windows reported by the platforms.
+    [
+        'CREATE TABLE rate_limit (platform VARCHAR NOT NULL, endpoint VARCHAR NOT NULL, rate_limit INT, remaining INT, reset_at INT, updated_at INT, PRIMARY KEY (platform, endpoint));',
+    ],
+    # 5: token buckets pacing the posts of the platforms.
+    [
+        'CREATE TABLE token_bucket (platform VARCHAR PRIMARY KEY, tokens REAL, updated_at REAL, blocked_until REAL);',
+    ],
+    # 6: Open Graph metadata of links, by normalized URL.
+    [
+        'CREATE TABLE og (url VARCHAR PRIMARY KEY, title VARCHAR, description VARCHAR, image_url VARCHAR, thumb VARCHAR, thumb_owner VARCHAR, etag VARCHAR, modified VARCHAR, ok INT, fetched_at INT, expires_at INT);',
+    ],
+    # 7: outbox of the posts and their "Sync from" replies.
+    [
+        'CREATE TABLE outbox (id INTEGER PRIMARY KEY AUTOINCREMENT, platform VARCHAR NOT NULL, entry_id VARCHAR NOT NULL, kind VARCHAR NOT NULL, payload VARCHAR, state VARCHAR NOT NULL, attempts INT, next_at REAL, error VARCHAR, created_at INT, updated_at INT, UNIQUE (platform, entry_id, kind));',
+        'CREATE INDEX outbox_due ON outbox (platform, kind, state, next_at);',
+    ],
+    # 8: last maintenance of the platforms.
+    [
+        'CREATE TABLE maintenance (platform VARCHAR PRIMARY KEY, done_at INT);',
+    ],
+]
+
+def hash_entry_id(entry_id):
+    """Fixed-width (16 bytes) key of entry_id, stored in the entry table
+    instead of the id itself with "hash_entry_ids = true".
+    """
+    return hashlib.sha256(entry_id.encode('utf-8')).digest()[:16]
+
+def entry_key(config, entry_id):
+    """Key of entry_id to store in the entry table.  Lookups match both
+    forms, so the setting can be changed at any time.
+    """
+    if config['default'].getboolean('hash_entry_ids', False):
+        return hash_entry_id(entry_id)
+    return entry_id
+
+def open_db(f_db, platform):
+    s = sqlite3.connect(f_db, timeout=30.0)
+    s.create_function('hash_entry_id', 1, hash_entry_id, deterministic=True)
+
+    # WAL lets platforms running at the same time read and write without
+    # blocking each other.
+    s.execute('PRAGMA journal_mode = WAL;')
+    s.execute('PRAGMA synchronous = NORMAL;')
+
+    version = s.execute('PRAGMA user_version;').fetchone()[0]
+    if version < len(MIGRATIONS):
+        s.execute('BEGIN IMMEDIATE;')
+
+        # Another process may have migrated it in the meantime.
+        version = s.execute('PRAGMA user_version;').fetchone()[0]
+        for i in range(version, len(MIGRATIONS)):
+            tprint('* Migrating {} to version {}'.format(f_db, i + 1))
+            for sql in MIGRATIONS[i]:
+                s.execute(sql, {'platform': platform})
+            s.execute('PRAGMA user_version = {};'.format(i + 1))
+
+        s.commit()
+
+    return s
+
+def open_state(config, platform, f_db):
+    """Open the state of platform, which is f_db, or the database shared by all
+    platforms if "state_db" is set in config.ini.  When switching to the shared
+    database, the entries, feed validators, outbox and rate budgets in f_db
+    are imported.
+
+    The entries of files from before accounts belong to the platform itself
+    ("bluesky" for "bluesky:acme"), so they are migrated and imported under
+    that key, and a new account starts without any synced entries.
+    """
+    owner = platform.partition(':')[0]
+
+    f_shared = config['default'].get('state_db')
+    if not f_shared:
+        return open_db(f_db, owner)
+
+    f_shared = os.path.expanduser(f_shared)
+    s = open_db(f_shared, owner)
+
+    if os.path.exists(f_db) and not os.path.samefile(f_db, f_shared) and s.execute('SELECT 1 FROM entry WHERE platform = ? LIMIT 1;', (owner, )).fetchone() is None:
+        tprint('* Importing {} into {}'.format(f_db, f_shared))
+
+        # Bring the old file to the current schema first.
+        open_db(f_db, owner).close()
+
+        s.execute('ATTACH DATABASE ? AS old;', (f_db, ))
+        s.execute('INSERT OR IGNORE INTO entry (platform, entry_id, created_at) SELECT platform, entry_id, created_at FROM old.entry;')
+        s.execute('INSERT OR IGNORE INTO feed (platform, feed_url, etag, modified, digest, updated_at) SELECT platform, feed_url, etag, modified, digest, updated_at FROM old.feed;')
+        s.execute('INSERT OR IGNORE INTO rate_limit (platform, endpoint, rate_limit, remaining, reset_at, updated_at) SELECT platform, endpoint, rate_limit, remaining, reset_at, updated_at FROM old.rate_limit;')
+        s.execute('INSERT OR IGNORE INTO token_bucket (platform, tokens, updated_at, blocked_until) SELECT platform, tokens, updated_at, blocked_until FROM old.token_bucket;')
+        # The ids are given anew, the jobs are told apart by (platform,
+        # entry_id, kind).
+        s.execute('INSERT OR IGNORE INTO outbox (platform, entry_id, kind, payload, state, attempts, next_at, error, created_at, updated_at) SELECT platform, entry_id, kind, payload, state, attempts, next_at, error, created_at, updated_at FROM old.outbox;')
+        s.commit()
+        s.execute('DETACH DATABASE old;')
+
+    return s
+
+def select_seen(s, platform, entry_ids):
+    """Return the set of entry_ids already in the entry table of platform,
+    stored as they are or hashed.
+    """
+    keys = {}
+    for entry_id in entry_ids:
+        keys[entry_id] = entry_id
+        keys[hash_entry_id(entry_id)] = entry_id
+    keys_list = list(keys)
+    seen = set()
+
+    c = s.cursor()
+
+    # Keep under SQLite's limit of host parameters per statement.
+    for i in range(0, len(keys_list), 500):
+        chunk = keys_list[i:i + 500]
+        c.execute('SELECT entry_id FROM entry WHERE platform = ? AND entry_id IN ({});'.format(','.join('?' * len(chunk))), [platform] + chunk)
+        seen.update(keys[row[0]] for row in c.fetchall())
+
+    return seen
+
+def entries_unseen(s, platform, items):
+    """Yield the entries not in the entry table of platform yet, oldest first."""
+    items = list(reversed(items))
+    seen = select_seen(s, platform, [item['id'] for item in items])
+
+    for item in items:
+        if item['id'] in seen:
+            continue
+        seen.add(item['id'])
+        yield item
+
+def maintenance_due(s, config, platform):
+    """Whether maintain() has not run for platform in "maintenance_interval"
+    hours (24 by default, 0 to only run it by hand).
+    """
+    interval = config['default'].getfloat('maintenance_interval', 24.0)
+    if interval <= 0:
+        return False
+
+    row = s.execute('SELECT done_at FROM maintenance WHERE platform = ?;', (platform, )).fetchone()
+    return row is None or row[0] + interval * 3600 <= time.time()
+
+def maintain(s, config, windows):
+    """Keep the state small for long-lived installs.  windows maps platforms
+    to the entry ids in their feeds (None if unknown).  Entries older than
+    "retention_days" (365 by default, 0 to keep them forever) and not in the
+    feeds any more are pruned, along with the outbox jobs finished a week ago
+    and the Open Graph metadata older than the horizon.  With
+    "hash_entry_ids = true", the stored entry ids are replaced by their
+    hashes.  The freed pages are then given back to the file system.
+    """
+    c = config['default']
+    now = int(time.time())
+    retention = c.getfloat('retention_days', 365.0)
+    horizon = now - retention * 86400
+
+    for platform, entry_ids in windows.items():
+        # Without the feed, an old entry still in it would be posted again.
+        if retention > 0 and entry_ids:
+            res = s.execute('DELETE FROM entry WHERE platform = :platform AND created_at < :horizon AND entry_id NOT IN (SELECT value FROM json_each(:ids) UNION ALL SELECT hash_entry_id(value) FROM json_each(:ids));', {'platform': platform, 'horizon': horizon, 'ids': json.dumps(entry_ids)})
+            tprint('* Maintenance of {}: {} entries pruned'.format(platform, res.rowcount))
+
+        s.execute("DELETE FROM outbox WHERE platform = ? AND state IN ('done', 'failed') AND updated_at < ?;", (platform, now - 7 * 86400))
+
+        if c.getboolean('hash_entry_ids', False):
+            s.execute("UPDATE OR IGNORE entry SET entry_id = hash_entry_id(entry_id) WHERE platform = ? AND typeof(entry_id) = 'text';", (platform, ))
+            # Left are the ids stored in both forms.
+            s.execute("DELETE FROM entry WHERE platform = ? AND typeof(entry_id) = 'text';", (platform, ))
+
+        s.execute('INSERT OR REPLACE INTO maintenance (platform, done_at) VALUES (?, ?);', (platform, now))
+
+    if retention > 0:
+        s.execute('DELETE FROM og WHERE fetched_at < ?;', (horizon, ))
+    s.commit()
+
+    # Incremental vacuum needs one full VACUUM to be turned on.  It needs the
+    # file to itself, so with another run in the middle of a write it is left
+    # to the next maintenance, the pruning above is kept anyway.
+    try:
+        if s.execute('PRAGMA auto_vacuum;').fetchone()[0] != 2:
+            tprint('* Maintenance: turning on incremental vacuum')
+            s.execute('PRAGMA auto_vacuum = INCREMENTAL;')
+            s.execute('VACUUM;')
+        s.execute('PRAGMA incremental_vacuum;').fetchall()
+        s.execute('ANALYZE;')
+        s.execute('PRAGMA optimize;')
+        s.execute('PRAGMA wal_checkpoint(TRUNCATE);').fetchall()
+    except sqlite3.OperationalError as e:
+        tprint('* Maintenance: skipping VACUUM until the next time: {}'.format(e))
+
+def entries_not_opted_out(items, tag):
+    """Skip the entries with the opt-out tag (e.g. "#nobluesky") by scanning the
+    raw description.  Mastodon marks up hashtags as "#<span>tag</span>", so
+    tags between "#" and the name are allowed.
+    """
+    pattern = re.compile('#(?:<[^>]*>)*' + re.escape(tag.lstrip('#')))
+
+    for item in items:
+        if pattern.search(item.get('description', '')):
+            tprint('* Skipping {}: {}'.format(item['id'], tag))
+            continue
+        yield item
+
+class TextRenderer(html.parser.HTMLParser):
+    """Render HTML into plain text in a single pass.  Paragraphs are separated
+    by an empty line, <br> and list items start a new line, and all other tags
+    are dropped with their text kept.  Rendering stops as soon as limit chars
+    have been emitted.
+    """
+    PARAGRAPH_TAGS = {'blockquote', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'ol', 'p', 'pre', 'ul'}
+    LINE_TAGS = {'div', 'li', 'tr'}
+    SKIP_TAGS = {'script', 'style', 'template'}
+
+    class Full(Exception):
+        pass
+
+    def __init__(self, limit=None):
+        super().__init__(convert_charrefs=True)
+        self.limit = limit
+        self.parts = []
+        self.length = 0
+        self.newlines = 0
+        self.skip = 0
+
+    def break_line(self, n):
+        self.newlines = max(self.newlines, n)
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.SKIP_TAGS:
+            self.skip += 1
+        elif tag == 'br':
+            self.newlines += 1
+        elif tag in self.PARAGRAPH_TAGS:
+            self.break_line(2)
+        elif tag in self.LINE_TAGS:
+            self.break_line(1)
+
+    def handle_endtag(self, tag):
+        if tag in self.SKIP_TAGS:
+            self.skip = max(self.skip - 1, 0)
+        elif tag in self.PARAGRAPH_TAGS:
+            self.break_line(2)
+        elif tag in self.LINE_TAGS:
+            self.break_line(1)
+
+    def handle_data(self, data):
+        if self.skip:
+            return
+
+        if self.length == 0 or self.newlines:
+            # Nothing emitted yet or at the start of a block, so the
+            # whitespace indenting the markup is trimmed, and runs of breaks
+            # are kept to one empty line.
+            data = data.lstrip()
+            if not data:
+                return
+            if self.length:
+                last = self.parts[-1].rstrip()
+                self.length -= len(self.parts[-1]) - len(last)
+                self.parts[-1] = last
+                data = '\n' * min(self.newlines, 2) + data
+        self.newlines = 0
+
+        self.parts.append(data)
+        self.length += len(data)
+        if self.limit is not None and self.length >= self.limit:
+            raise self.Full()
+
+    def text(self):
+        return ''.join(self.parts)[:self.limit].rstrip()
+
+def html_to_text(body, limit=None):
+    """Render HTML body into plain text of at most limit chars."""
+    r = TextRenderer(limit)
+    try:
+        r.feed(body)
+        r.close()
+    except TextRenderer.Full:
+        pass
+    return r.text()
+
+IMAGE_SIGNATURES = [
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'GIF87a', 'image/gif'),
+    (b'GIF89a', 'image/gif'),
+]
+
+def detect_image_type(data):
+    """Return the content type of image data from its magic bytes, as servers
+    often send the wrong one, or None if unknown."""
+    for signature, content_type in IMAGE_SIGNATURES:
+        if data.startswith(signature):
+            return content_type
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'image/webp'
+    return None
+
+def encode_image(img, fmt, **kwargs):
+    out = io.BytesIO()
+    img.save(out, fmt, **kwargs)
+    return out.getvalue()
+
+def transform_image(data, max_dimension, max_bytes):
+    """Downscale image data to fit in max_dimension x max_dimension pixels and
+    re-encode it under max_bytes, with the highest JPEG quality that fits and
+    without metadata (EXIF, XMP).  Images within the limits and without
+    metadata, animations, and anything Pillow (if installed at all) cannot
+    open are returned as they are.  Returns (data, content_type).
+    """
+    content_type = detect_image_type(data)
+    try:
+        from PIL import Image, ImageOps
+    except ImportError:
+        return data, content_type
+
+    try:
+        img = Image.open(io.BytesIO(data))
+        if getattr(img, 'is_animated', False):
+            return data, content_type
+
+        has_metadata = bool(img.getexif()) or 'xmp' in img.info or 'XML:com.adobe.xmp' in img.info
+        if max(img.size) <= max_dimension and len(data) <= max_bytes and not has_metadata:
+            return data, content_type
+
+        # Apply the EXIF orientation before it is dropped.
+        img = ImageOps.exif_transpose(img)
+        icc_profile = img.info.get('icc_profile')
+        img.thumbnail((max_dimension, max_dimension), Image.LANCZOS)
+
+        if img.mode in ('RGBA', 'LA', 'P') and content_type == 'image/png':
+            # Keep transparency if it fits.
+            out = encode_image(img, 'PNG', optimize=True, icc_profile=icc_profile)
+            if len(out) <= max_bytes:
+                return out, 'image/png'
+
+        if img.mode != 'RGB':
+            background = Image.new('RGB', img.size, (255, 255, 255))
+            img = img.convert('RGBA')
+            background.paste(img, mask=img.getchannel('A'))
+            img = background
+
+        while True:
+            # Binary search for the highest quality under max_bytes.
+            best = None
+            lo, hi = 40, 90
+            while lo <= hi:
+                quality = (lo + hi) // 2
+                out = encode_image(img, 'JPEG', quality=quality, optimize=True, progressive=True, icc_profile=icc_profile)
+                if len(out) <= max_bytes:
+                    best = out
+                    lo = quality + 1
+                else:
+                    hi = quality - 1
+
+            if best is not None:
+                tprint('* Image transformed: {} -> {} bytes, {}x{}'.format(len(data), len(best), img.width, img.height))
+                return best, 'image/jpeg'
+
+            # Still too large at the lowest quality.
+            img = img.resize((max(img.width * 3 // 4, 1), max(img.height * 3 // 4, 1)), Image.LANCZOS)
+    except Exception as e:
+        tprint('* Exception transforming image: {}'.format(e))
+        return data, content_type
+
+class MediaCache(object):
+    """Content-addressed cache of downloaded media, shared by all platforms
+    (and by concurrent runs).  For every URL, "<sha256 of url>.json" keeps the
+    validators and the sha256 of the content, which is stored in
+    "<sha256 of content>.blob".  Files are written to a temporary file and
+    renamed into place, and the least recently used ones are evicted when the
+    cache grows over max_size bytes or gets older than max_age seconds.
+    Downloads larger than max_download bytes are refused.
+    """
+
+    def __init__(self, http, path, max_size=256 * 1024 * 1024, max_age=7 * 86400, max_download=64 * 1024 * 1024):
+        self.http = http
+        self.path = path
+        self.max_size = max_size
+        self.max_age = max_age
+        self.max_download = max_download
+        os.makedirs(path, exist_ok=True)
+
+    @classmethod
+    def from_config(cls, config, http):
+        cache_home = os.environ.get('XDG_CACHE_HOME') or '{}/.cache'.format(os.environ['HOME'])
+        c = config['default']
+        return cls(
+            http,
+            os.path.expanduser(c.get('media_cache_dir', '{}/feed2social/media'.format(cache_home))),
+            max_size=int(c.get('media_cache_max_size', 256)) * 1024 * 1024,
+            max_age=int(c.get('media_cache_max_age', 7)) * 86400,
+            max_download=int(c.get('media_max_download', 64)) * 1024 * 1024,
+        )
+
+    def write(self, f, data):
+        fd, tmp_path = tempfile.mkstemp(dir=self.path, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as tmp_file:
+                tmp_file.write(data)
+            os.replace(tmp_path, f)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def read(self, f):
+        with open(f, 'rb') as fh:
+            data = fh.read()
+        # Keep mtime as the last access time for LRU eviction.
+        os.utime(f)
+        return data
+
+    def get(self, url, timeout=30.0):
+        """Return (content, content_type) of url, downloading it if needed."""
+        f_blob, content_type = self.get_file(url, timeout=timeout)
+        return self.read(f_blob), content_type
+
+    def get_file(self, url, timeout=30.0):
+        """Return (path, content_type) of the cached content of url,
+        downloading it if needed.  The download is streamed to disk, and
+        aborted once it gets larger than max_download bytes.
+        """
+        f_meta = os.path.join(self.path, hashlib.sha256(url.encode()).hexdigest() + '.json')
+
+        meta = None
+        try:
+            with open(f_meta) as fh:
+                meta = json.load(fh)
+        except (OSError, ValueError):
+            pass
+
+        headers = {}
+        if meta:
+            f_blob = os.path.join(self.path, meta['digest'] + '.blob')
+            if not os.path.exists(f_blob):
+                # Evicted by another run.
+                meta = None
+            elif time.time() - meta['fetched_at'] < self.max_age:
+                tprint('* Media cache hit: {}'.format(url))
+                os.utime(f_blob)
+                return f_blob, meta['content_type']
+            else:
+                if meta.get('etag'):
+                    headers['If-None-Match'] = meta['etag']
+                if meta.get('modified'):
+                    headers['If-Modified-Since'] = meta['modified']
+
+        with self.http.stream('GET', url, headers=headers, timeout=timeout, follow_redirects=True) as res:
+            if meta and res.status_code == 304:
+                meta['fetched_at'] = int(time.time())
+                self.write(f_meta, json.dumps(meta).encode())
+                tprint('* Media cache revalidated: {}'.format(url))
+                os.utime(f_blob)
+                return f_blob, meta['content_type']
+            res.raise_for_status()
+
+            if int(res.headers.get('Content-Length') or 0) > self.max_download:
+                raise ValueError('{} is larger than {} bytes'.format(url, self.max_download))
+
+            h = hashlib.sha256()
+            size = 0
+            fd, tmp_path = tempfile.mkstemp(dir=self.path, prefix='.tmp-')
+            try:
+                with os.fdopen(fd, 'wb') as tmp_file:
+                    for chunk in res.iter_bytes():
+                        size += len(chunk)
+                        if size > self.max_download:
+                            raise ValueError('{} is larger than {} bytes'.format(url, self.max_download))
+                        h.update(chunk)
+                        tmp_file.write(chunk)
+
+                f_blob = os.path.join(self.path, h.hexdigest() + '.blob')
+                os.replace(tmp_path, f_blob)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+
+        meta = {
+            'url': url,
+            'etag': res.headers.get('ETag'),
+            'modified': res.headers.get('Last-Modified'),
+            'content_type': res.headers.get('Content-Type', '').split(';')[0].strip(),
+            'digest': h.hexdigest(),
+            'fetched_at': int(time.time()),
+        }
+        self.write(f_meta, json.dumps(meta).encode())
+
+        self.evict(keep=f_blob)
+        return f_blob, meta['content_type']
+
+    def get_image(self, url, max_dimension, max_bytes, timeout=30.0):
+        """Return (content, content_type) of the image at url, transformed by
+        transform_image() to the given limits.  Variants are cached next to
+        the original, so every platform transforms an image only once.
+        """
+        data, content_type = self.get(url, timeout=timeout)
+
+        f_variant = os.path.join(self.path, '{}-{}-{}.variant'.format(hashlib.sha256(data).hexdigest(), max_dimension, max_bytes))
+        try:
+            variant = self.read(f_variant)
+            tprint('* Media cache hit: {} ({}px, {} bytes)'.format(url, max_dimension, max_bytes))
+            return variant, detect_image_type(variant)
+        except FileNotFoundError:
+            pass
+
+        variant, variant_type = transform_image(data, max_dimension, max_bytes)
+        if variant is data:
+            return data, variant_type or content_type
+
+        self.write(f_variant, variant)
+        return variant, variant_type
+
+    def evict(self, keep=None):
+        """Evict the least recently used files, but never keep (the file just
+        downloaded) or the downloads of other runs in progress.  Temporary
+        files left by crashed runs are removed after an hour.
+        """
+        now = time.time()
+        files = []
+        for entry in os.scandir(self.path):
+            if entry.name.startswith('.tmp-'):
+                # Downloads in progress are written to at least every read
+                # timeout (30 seconds), so an hour old one is abandoned.
+                try:
+                    if now - entry.stat().st_mtime > 3600:
+                        os.unlink(entry.path)
+                except FileNotFoundError:
+                    pass
+                continue
+            try:
+                st = entry.stat()
+            except FileNotFoundError:
+                continue
+            files.append((st.st_mtime, st.st_size, entry.path))
+
+        # Oldest first, drop until both limits are met.
+        files.sort()
+        total = sum(size for _, size, _ in files)
+        for mtime, size, f in files:
+            if total <= self.max_size and now - mtime <= self.max_age:
+                break
+            if f == keep:
+                continue
+            try:
+                os.unlink(f)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+def new_http_client(config):
+    """Create the long-lived httpx.Client of a platform, shared by the feed,
+    media, upload, post and reply requests so connections are kept alive.
+    HTTP/2 is enabled by "http2 = true" in config.ini.
+    """
+    return httpx.Client(
+        http2=config['default'].getboolean('http2', False),
+        timeout=httpx.Timeout(30.0, connect=10.0, pool=10.0),
+        limits=httpx.Limits(max_connections=10, max_keepalive_connections=5, keepalive_expiry=60.0),
+    )
+
+def fetch_feed(http, s, platform, feed_url):
+    """Fetch and parse the feed with conditional GET.
+    Returns (feed, state), feed is None if the feed has not been changed since
+    the state saved by save_feed_state().
+    """
+    c = s.cursor()
+    c.execute('SELECT etag, modified, digest FROM feed WHERE platform = ? AND feed_url = ?;', (platform, feed_url))
+    row = c.fetchone()
+    etag, modified, digest = row if row else (None, None, None)
+
+    headers = {}
+    if etag:
+        headers['If-None-Match'] = etag
+    if modified:
+        headers['If-Modified-Since'] = modified
+
+    # httpx asks for gzip (and brotli when available) by itself.
+    res = http.get(feed_url, headers=headers, timeout=30.0, follow_redirects=True)
+    tprint('* Fetch feed: res = {}'.format(res))
+    if res.status_code == 304:
+        return None, None
+    res.raise_for_status()
+
+    state = (res.headers.get('ETag'), res.headers.get('Last-Modified'), hashlib.sha256(res.content).hexdigest())
+    if state[2] == digest:
+        # Same content, only keep the latest validators.
+        save_feed_state(s, platform, feed_url, state)
+        return None, state
+
+    # feedparser is only needed (and imported) when the feed has changed.
+    import feedparser
+    return feedparser.parse(res.content, response_headers=dict(res.headers)), state
+
+def save_feed_state(s, platform, feed_url, state):
+    etag, modified, digest = state
+    s.execute('INSERT OR REPLACE INTO feed (platform, feed_url, etag, modified, digest, updated_at) VALUES (?, ?, ?, ?, ?, ?);', (platform, feed_url, etag, modified, digest, int(time.time())))
+    s.commit()
+
+class RateLimited(Exception):
+    """Raised by the senders of Outbox.drain() to stop posting for this run,
+    leaving the job for a later run without counting it as a failure.
+    """
+
+class Outbox(object):
+    """Durable queue of the posts of a platform, kept in the outbox table.
+    Jobs are "pending" until done, retried with exponential backoff when they
+    fail, and "failed" after max_attempts.  A claimed job is "running" for
+    lease seconds, after which it is picked up again, so a crash in the
+    middle of a post does not lose it (but may post it twice).
+    """
+
+    def __init__(self, platform, max_attempts=8, backoff=60.0, max_backoff=6 * 3600.0, lease=600.0):
+        self.platform = platform
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.lease = lease
+
+    @classmethod
+    def from_config(cls, config, platform):
+        c = config['default']
+        return cls(
+            platform,
+            max_attempts=c.getint('outbox_max_attempts', 8),
+            backoff=c.getfloat('outbox_backoff', 60.0),
+            max_backoff=c.getfloat('outbox_max_backoff', 6 * 3600.0),
+        )
+
+    def add(self, s, entry_id, kind, payload):
+        """Queue a job, in the transaction of the caller (committed along with
+        the entry, so an entry is either queued or not seen at all).
+        """
+        now = time.time()
+        s.execute('INSERT OR IGNORE INTO outbox (platform, entry_id, kind, payload, state, attempts, next_at, created_at, updated_at) VALUES (?, ?, ?, ?, ?, 0, ?, ?, ?);', (self.platform, entry_id, kind, json.dumps(payload), 'pending', now, int(now), int(now)))
+
+    def claim(self, s, kind):
+        """Take the oldest due job of kind, or None.  Returns the payload with
+        "id", "entry_id" and "attempts" of the job added.
+        """
+        s.execute('BEGIN IMMEDIATE;')
+        now = time.time()
+        row = s.execute("SELECT id, entry_id, payload, attempts FROM outbox WHERE platform = ? AND kind = ? AND state IN ('pending', 'running') AND next_at <= ? ORDER BY id LIMIT 1;", (self.platform, kind, now)).fetchone()
+        if row is None:
+            s.commit()
+            return None
+
+        s.execute("UPDATE outbox SET state = 'running', next_at = ?, updated_at = ? WHERE id = ?;", (now + self.lease, int(now), row[0]))
+        s.commit()
+
+        job = json.loads(row[2])
+        job.update({'id': row[0], 'entry_id': row[1], 'attempts': row[3]})
+        return job
+
+    def done(self, s, job, reply=None):
+        """Mark job done, and queue reply (the payload of its "Sync from"
+        reply) in the same transaction.
+        """
+        s.execute("UPDATE outbox SET state = 'done', error = NULL, updated_at = ? WHERE id = ?;", (int(time.time()), job['id']))
+        if reply is not None:
+            self.add(s, job['entry_id'], 'reply', reply)
+        s.commit()
+
+    def retry(self, s, job, error):
+        """Count a failed attempt of job, and retry it later or give up."""
+        attempts = job['attempts'] + 1
+        now = time.time()
+        if attempts >= self.max_attempts:
+            tprint('* Giving up {} of {} after {} attempts: {}'.format(job['id'], job['entry_id'], attempts, error))
+            s.execute("UPDATE outbox SET state = 'failed', attempts = ?, error = ?, updated_at = ? WHERE id = ?;", (attempts, error, int(now), job['id']))
+        else:
+            delay = min(self.backoff * 2 ** (attempts - 1), self.max_backoff)
+            tprint('* Retrying {} of {} in {:.0f} seconds: {}'.format(job['id'], job['entry_id'], delay, error))
+            s.execute("UPDATE outbox SET state = 'pending', attempts = ?, next_at = ?, error = ?, updated_at = ? WHERE id = ?;", (attempts, now + delay, error, int(now), job['id']))
+        s.commit()
+
+    def release(self, s, job):
+        """Put job back as it was, e.g. when rate limited."""
+        now = time.time()
+        s.execute("UPDATE outbox SET state = 'pending', next_at = ?, updated_at = ? WHERE id = ?;", (now, int(now), job['id']))
+        s.commit()
+
+    def drain(self, s, senders):
+        """Run the due jobs with senders, a list of (kind, send) in priority
+        order, so every main post goes out before the replies.  send(s, job)
+        returns the payload of the reply to queue (a dict) or True when done,
+        None when failed.  Returns False if stopped by RateLimited.
+        """
+        for kind, send in senders:
+            while True:
+                job = self.claim(s, kind)
+                if job is None:
+                    break
+
+                tprint('* Outbox: {} of {} (attempt {})'.format(kind, job['entry_id'], job['attempts'] + 1))
+                try:
+                    res = send(s, job)
+                except RateLimited:
+                    self.release(s, job)
+                    return False
+                except Exception as e:
+                    s.rollback()
+                    self.retry(s, job, repr(e))
+                    continue
+
+                if res is None:
+                    self.retry(s, job, 'failed')
+                else:
+                    self.done(s, job, res if isinstance(res, dict) else None)
+        return True
 
 class Feed2Twitter(object):
+    _auth = None
     _config = None
+    _http = None
+    _media_cache = None
+    _outbox = None
+    account = None
+    platform = 'twitter'
 
-    def __init__(self):
-        pass
+    # Largest dimension (in pixels) and size of uploaded images.
+    IMAGE_LIMITS = (4096, 5 * 1024 * 1024)
+
+    def __init__(self, account=None):
+        self.account = account
+
+    @property
+    def auth(self):
+        # Kept with the client of the account, as the runner keeps every
+        # account between runs.
+        if self._auth is None:
+            from authlib.integrations.httpx_client import OAuth1Auth
+
+            c = self.config
+            self._auth = OAuth1Auth(
+                client_id=c['default']['twitter_api_key'],
+                client_secret=c['default']['twitter_api_key_secret'],
+                token=c['default']['twitter_access_token'],
+                token_secret=c['default']['twitter_access_token_secret'],
+                force_include_body=True,  # keep JSON payload so Twitter sees the text
+            )
+        return self._auth
+
+    @property
+    def media_cache(self):
+        if self._media_cache is None:
+            self._media_cache = MediaCache.from_config(self.config, self.http)
+        return self._media_cache
+
+    @property
+    def outbox(self):
+        if self._outbox is None:
+            self._outbox = Outbox.from_config(self.config, self.name)
+        return self._outbox
+
+    @property
+    def http(self):
+        if self._http is None:
+            self._http = new_http_client(self.config)
+        return self._http
+
+    @property
+    def name(self):
+        # State key of the account: the entries, feed state and rate budget of
+        # every account are kept apart.
+        if self.account is None:
+            return self.platform
+        return '{}:{}'.format(self.platform, self.account)
 
     @property
     def config(self):
@@ -34,37 +831,104 @@ class Feed2Twitter(object):
 
             self._config = configparser.ConfigParser()
             self._config.read(f_conf)
+
+            # Settings in the section of the account ([<platform>:<account>])
+            # override the ones in [default].
+            if self.account is not None:
+                for key, value in self._config.items(self.name, raw=True):
+                    self._config.set('default', key, value)
         return self._config
 
-    def get_auth(self):
-        c = self.config
-        return OAuth1Auth(
-            client_id=c['default']['twitter_api_key'],
-            client_secret=c['default']['twitter_api_key_secret'],
-            token=c['default']['twitter_access_token'],
-            token_secret=c['default']['twitter_access_token_secret'],
-            force_include_body=True,  # keep JSON payload so Twitter sees the text
-        )
+    # Rate limit headers of the v2 API, the first one is the 15 minutes window
+    # of the endpoint, the second one is the 24 hours budget of the user.
+    RATE_LIMIT_HEADERS = [
+        ('', 'x-rate-limit'),
+        (':24h', 'x-user-limit-24hour'),
+    ]
+
+    def update_rate_limit(self, s, endpoint, res):
+        """Remember the rate limit windows reported in the headers of res."""
+        for suffix, prefix in self.RATE_LIMIT_HEADERS:
+            remaining = res.headers.get(prefix + '-remaining')
+            reset_at = res.headers.get(prefix + '-reset')
+            if remaining is None or reset_at is None:
+                continue
+
+            remaining = int(remaining)
+            if res.status_code == 429 and suffix == '':
+                remaining = 0
 
-    def upload_media(self, image_url, auth):
+            s.execute('INSERT OR REPLACE INTO rate_limit (platform, endpoint, rate_limit, remaining, reset_at, updated_at) VALUES (?, ?, ?, ?, ?, ?);', (self.name, endpoint + suffix, int(res.headers.get(prefix + '-limit', 0)), remaining, int(reset_at), int(time.time())))
+        s.commit()
+
+    def rate_limit_delay(self, s, endpoint, need=1):
+        """Return seconds to wait before calling endpoint, or None if need
+        requests will not be available within twitter_max_delay seconds.  No
+        wait while there is plenty of budget left in the current window.
+        """
+        max_delay = self.config['default'].getfloat('twitter_max_delay', 30.0)
+        now = time.time()
+
+        delay = 0.0
+        c = s.cursor()
+        c.execute('SELECT endpoint, remaining, reset_at FROM rate_limit WHERE platform = ? AND endpoint IN (?, ?);', (self.name, endpoint, endpoint + ':24h'))
+        for name, remaining, reset_at in c.fetchall():
+            if reset_at <= now:
+                # The window has been reset.
+                continue
+
+            if remaining < need:
+                if reset_at - now > max_delay:
+                    tprint('* Rate limit of {}: {} remaining until {} (local time)'.format(name, remaining, datetime.datetime.fromtimestamp(reset_at)))
+                    return None
+                delay = max(delay, reset_at - now)
+            elif remaining < need + 5:
+                # Running low, spread the rest over the window.
+                delay = max(delay, min((reset_at - now) / remaining, max_delay))
+
+        return delay
+
+    def wait_rate_limit(self, s, endpoint, need=1):
+        """Sleep as rate_limit_delay() says.  Returns False if rate limited."""
+        delay = self.rate_limit_delay(s, endpoint, need)
+        if delay is None:
+            return False
+        if delay > 0:
+            tprint('* Waiting {:.1f} seconds for {} rate limit...'.format(delay, endpoint))
+            time.sleep(delay)
+        return True
+
+    def print_rate_limit(self, res):
+        tprint('* Rate limit exceeded (429). Response headers:')
+        for _, prefix in self.RATE_LIMIT_HEADERS:
+            for k in ('limit', 'remaining', 'reset'):
+                tprint('*   {}-{}: {}'.format(prefix, k, res.headers.get('{}-{}'.format(prefix, k), 'N/A')))
+        rate_limit_reset = res.headers.get('x-rate-limit-reset')
+        if rate_limit_reset:
+            reset_time = int(rate_limit_reset)
+            reset_datetime = datetime.datetime.fromtimestamp(reset_time)
+            tprint('*   Reset time: {} (local time)'.format(reset_datetime))
+
+    def upload_media(self, s, image_url, auth, media_type=None):
         """Download image from URL and upload to Twitter v1.1 API"""
+        if media_type and (media_type.startswith('video/') or media_type == 'image/gif'):
+            return self.upload_media_chunked(s, image_url, auth)
+
         try:
             # Download image
             tprint('* Downloading image: {}'.format(image_url))
-            img_res = httpx.get(image_url, timeout=30.0)
-            if img_res.status_code != 200:
-                tprint('* Failed to download image: {}'.format(img_res.status_code))
-                return None
+            image_data, _ = self.media_cache.get_image(image_url, *self.IMAGE_LIMITS)
 
             # Upload to Twitter v1.1 API
             tprint('* Uploading image to Twitter v1.1 API')
-            upload_res = httpx.post(
+            upload_res = self.http.post(
                 'https://upload.twitter.com/1.1/media/upload.json',
                 auth=auth,
-                files={'media': io.BytesIO(img_res.content)},
+                files={'media': io.BytesIO(image_data)},
             )
             tprint('* upload_res = {}'.format(upload_res))
-            tprint('* upload_res.text = {}'.format(json.dumps(upload_res.json(), ensure_ascii=False)))
+            self.update_rate_limit(s, 'media', upload_res)
+            tprint('* upload_res.text = {}'.format(upload_res.text))
 
             if upload_res.status_code == 200:
                 media_id = upload_res.json()['media_id_string']
@@ -77,7 +941,171 @@ class Feed2Twitter(object):
             tprint('* Exception during media upload: {}'.format(e))
             return None
 
-    def main(self, sync_only=False):
+    def upload_media_chunked(self, s, media_url, auth, chunk_size=4 * 1024 * 1024, timeout=300):
+        """Upload a GIF or video with the chunked INIT/APPEND/FINALIZE commands,
+        read from the media cache chunk_size bytes at a time so memory stays
+        flat whatever its size, then wait for its processing (STATUS).  Gives
+        up after timeout seconds in all, well within the lease of the job.
+        """
+        upload_url = 'https://upload.twitter.com/1.1/media/upload.json'
+        deadline = time.time() + timeout
+
+        try:
+            tprint('* Downloading media: {}'.format(media_url))
+            f_media, content_type = self.media_cache.get_file(media_url)
+            total_bytes = os.path.getsize(f_media)
+            with open(f_media, 'rb') as fh:
+                content_type = detect_image_type(fh.read(16)) or content_type
+            category = 'tweet_gif' if content_type == 'image/gif' else 'tweet_video'
+
+            tprint('* Uploading {} bytes of {} to Twitter v1.1 API'.format(total_bytes, content_type))
+            res = self.http.post(upload_url, auth=auth, data={
+                'command': 'INIT',
+                'total_bytes': str(total_bytes),
+                'media_type': content_type,
+                'media_category': category,
+            })
+            tprint('* INIT: res = {}'.format(res))
+            self.update_rate_limit(s, 'media', res)
+            if res.status_code not in (200, 201, 202):
+                tprint('* INIT: res.text = {}'.format(res.text))
+                return None
+            media_id = res.json()['media_id_string']
+
+            with open(f_media, 'rb') as fh:
+                segment_index = 0
+                while True:
+                    chunk = fh.read(chunk_size)
+                    if not chunk:
+                        break
+
+                    res = self.http.post(upload_url, auth=auth, data={
+                        'command': 'APPEND',
+                        'media_id': media_id,
+                        'segment_index': str(segment_index),
+                    }, files={'media': chunk}, timeout=120.0)
+                    tprint('* APPEND {}: res = {}'.format(segment_index, res))
+                    if res.status_code not in (200, 204):
+                        tprint('* APPEND: res.text = {}'.format(res.text))
+                        return None
+                    segment_index += 1
+
+            res = self.http.post(upload_url, auth=auth, data={
+                'command': 'FINALIZE',
+                'media_id': media_id,
+            })
+            tprint('* FINALIZE: res = {}'.format(res))
+            tprint('* FINALIZE: res.text = {}'.format(res.text))
+            if res.status_code not in (200, 201):
+                return None
+
+            # GIFs and videos are processed asynchronously.
+            info = res.json().get('processing_info')
+            while info and info.get('state') in ('pending', 'in_progress'):
+                if time.time() + info.get('check_after_secs', 5) > deadline:
+                    tprint('* Timed out processing media: {}'.format(info))
+                    return None
+                time.sleep(info.get('check_after_secs', 5))
+                res = self.http.get(upload_url, auth=auth, params={
+                    'command': 'STATUS',
+                    'media_id': media_id,
+                })
+                tprint('* STATUS: res.text = {}'.format(res.text))
+                info = res.json().get('processing_info')
+
+            if info and info.get('state') != 'succeeded':
+                tprint('* Failed to process media: {}'.format(info))
+                return None
+
+            tprint('* media_id = {}'.format(media_id))
+            return media_id
+        except Exception as e:
+            tprint('* Exception during chunked media upload: {}'.format(e))
+            return None
+
+    def send_post(self, s, job):
+        """Tweet the entry of job, returns the payload of its reply."""
+        # Skip posting until the rate limit windows allow both the tweet and
+        # its reply, instead of hitting 429 again.
+        if not self.wait_rate_limit(s, 'tweets', need=2):
+            tprint('* Stopping due to rate limit.')
+            raise RateLimited()
+
+        # Upload media if present
+        media_id = None
+        if job['image_url']:
+            if not self.wait_rate_limit(s, 'media'):
+                tprint('* Stopping due to media upload rate limit.')
+                raise RateLimited()
+            media_id = self.upload_media(s, job['image_url'], self.auth, job['media_type'])
+
+        # Post to Twitter.
+        tweet_data = {'text': job['content']}
+        if media_id:
+            tweet_data['media'] = {'media_ids': [media_id]}
+
+        res = self.http.post(
+            'https://api.x.com/2/tweets',
+            auth=self.auth,
+            json=tweet_data,
+        )
+        # Keep the rate limit before anything else, the body may not even be
+        # JSON (e.g. from a proxy).
+        self.update_rate_limit(s, 'tweets', res)
+        tprint('* res = {}'.format(res))
+        tprint('* res.text = {}'.format(res.text))
+
+        if res.status_code == 429:
+            # Rate limit hit, the reset time is kept for the next runs.
+            self.print_rate_limit(res)
+            tprint('* Stopping due to rate limit.')
+            raise RateLimited()
+
+        if res.status_code != 201:
+            tprint('* Error posting tweet: {}'.format(res.status_code))
+            return None
+
+        try:
+            tweet_id = res.json()['data']['id']
+        except (ValueError, KeyError, TypeError) as e:
+            # Posted, but without its id there is no reply.
+            tprint('* Unexpected response posting tweet: {!r}'.format(e))
+            return True
+
+        return {'url': job['url'], 'tweet_id': tweet_id}
+
+    def send_reply(self, s, job):
+        """Append the feed entry url of job into the replies."""
+        if not self.wait_rate_limit(s, 'tweets'):
+            tprint('* Stopping due to rate limit, reply not posted.')
+            raise RateLimited()
+
+        reply_data = {
+            'text': 'Sync from: {}'.format(job['url']),
+            'reply': {'in_reply_to_tweet_id': job['tweet_id']},
+        }
+
+        res = self.http.post(
+            'https://api.x.com/2/tweets',
+            auth=self.auth,
+            json=reply_data,
+        )
+        self.update_rate_limit(s, 'tweets', res)
+        tprint('* Reply res = {}'.format(res))
+        tprint('* Reply res.text = {}'.format(res.text))
+
+        if res.status_code == 429:
+            # Rate limit hit, the reset time is kept for the next runs.
+            self.print_rate_limit(res)
+            tprint('* Stopping due to rate limit.')
+            raise RateLimited()
+
+        if res.status_code != 201:
+            tprint('* Error posting reply: {}'.format(res.status_code))
+            return None
+        return True
+
+    def main(self, sync_only=False, feed=None):
         tprint('* Started.')
 
         if sync_only:
@@ -87,33 +1115,41 @@ class Feed2Twitter(object):
         f_db = '{}/.config/feed2social/feed2twitter.sqlite3'.format(home)
 
         c = self.config
-        feed_url = c['default']['feed_url']
-
-        feed = feedparser.parse(feed_url)
-        items = feed.entries
 
-        s = sqlite3.connect(f_db)
+        s = open_state(self.config, self.name, f_db)
 
-        sql_insert = 'INSERT INTO entry (entry_id, created_at) VALUES (?, ?);'
-        sql_select = 'SELECT COUNT(*) FROM entry WHERE entry_id = ?;'
+        state = None
+        if feed is None:
+            feed_url = c['default']['feed_url']
+            try:
+                feed, state = fetch_feed(self.http, s, self.name, feed_url)
+                if feed is None:
+                    # Nothing new, but jobs in the outbox may be due.
+                    tprint('* Feed not changed.')
+            except Exception as e:
+                # The jobs in the outbox are still drained below, so retries
+                # do not wait for the feed to be back.
+                tprint('* Exception fetching {}: {!r}'.format(feed_url, e))
+        items = feed.entries if feed is not None else []
 
-        # Workaround: cannot use allow_tags=[]:
-        cl = Cleaner(allow_tags=['p'])
+        sql_insert = 'INSERT INTO entry (platform, entry_id, created_at) VALUES (?, ?, ?);'
 
-        auth = self.get_auth()
-
-        for item in reversed(items):
+        # Cheap checks first, so already synced and opted out entries never
+        # reach the HTML cleaning and media scanning below.
+        for item in entries_not_opted_out(entries_unseen(s, self.name, items), '#notwitter'):
             body = item['description']
 
             # Print out item's id.
             tprint('* item.id = {}'.format(item.id))
 
-            # Check if entry has media content (images)
+            # Check if entry has media content (images, GIFs and videos)
             image_url = None
+            media_type = None
             if hasattr(item, 'media_content'):
                 for media in item.media_content:
-                    if media.get('type', '').startswith('image/'):
+                    if media.get('type', '').startswith(('image/', 'video/')):
                         image_url = media.get('url')
+                        media_type = media.get('type')
                         break
 
             # Skip if body is empty and no image.
@@ -121,32 +1157,8 @@ class Feed2Twitter(object):
                 tprint('* Skipping: empty body and no image')
                 continue
 
-            # Craft "body".
-            #
-            # First to remove all tags except "a" and root's "div".
-            if body and body.strip():
-                body = cl.clean_html(body)
-
-                # Skip if there is '#notwitter' tag.
-                if '#notwitter' in body:
-                    continue
-
-                # Remove root's "div".
-                body = body.replace('<div>', '').replace('</div>', '')
-
-                # <p> and </p>
-                body = body.replace('<p>', '\n').replace('</p>', '\n')
-
-                # trim
-                body = body.strip()
-
-                # unescape
-                body = html.unescape(body)
-
-                # Limit to 280 chars.
-                body = body[0:280]
-            else:
-                body = ''
+            # Render "body" as plain text, limited to 280 chars.
+            body = html_to_text(body or '', 280)
 
             # Generate parameters.
             id_str = item['id']
@@ -154,108 +1166,41 @@ class Feed2Twitter(object):
 
             cur = s.cursor()
 
-            cur.execute(sql_select, (id_str, ))
-            if 0 == cur.fetchone()[0]:
-                content = body
-                tprint('* content = {}'.format(content))
+            content = body
+            tprint('* content = {}'.format(content))
 
-                if sync_only:
-                    tprint('* sync_only: skipping post to Twitter')
-                    cur.execute(sql_insert, (id_str, int(time.time())))
-                    s.commit()
-                    continue
+            if sync_only:
+                tprint('* sync_only: skipping post to Twitter')
+                cur.execute(sql_insert, (self.name, entry_key(self.config, id_str), int(time.time())))
+                s.commit()
+                continue
 
-                # Upload media if present
-                media_id = None
-                if image_url:
-                    media_id = self.upload_media(image_url, auth)
-                    if media_id:
-                        # Wait after media upload to avoid rate limit
-                        tprint('* Waiting 2 seconds after media upload...')
-                        time.sleep(2)
-
-                # Post to Twitter.
-                tweet_data = {'text': content}
-                if media_id:
-                    tweet_data['media'] = {'media_ids': [media_id]}
-
-                res = httpx.post(
-                    'https://api.x.com/2/tweets',
-                    auth=auth,
-                    json=tweet_data,
-                )
-                tprint('* res = {}'.format(res))
-                tprint('* res.text = {}'.format(json.dumps(res.json(), ensure_ascii=False)))
-
-                if res.status_code == 429:
-                    # Rate limit hit, display headers and exit
-                    tprint('* Rate limit exceeded (429). Response headers:')
-                    tprint('*   x-rate-limit-limit: {}'.format(res.headers.get('x-rate-limit-limit', 'N/A')))
-                    tprint('*   x-rate-limit-remaining: {}'.format(res.headers.get('x-rate-limit-remaining', 'N/A')))
-                    tprint('*   x-rate-limit-reset: {}'.format(res.headers.get('x-rate-limit-reset', 'N/A')))
-                    rate_limit_reset = res.headers.get('x-rate-limit-reset')
-                    if rate_limit_reset:
-                        reset_time = int(rate_limit_reset)
-                        reset_datetime = datetime.datetime.fromtimestamp(reset_time)
-                        tprint('*   Reset time: {} (local time)'.format(reset_datetime))
-                    tprint('* Exiting due to rate limit.')
-                    s.close()
-                    exit(1)
-
-                if res.status_code != 201:
-                    tprint('* Error posting tweet: {}'.format(res.status_code))
-                    continue
+            # Queue the tweet along with the entry, it is sent (and retried)
+            # from the outbox below.
+            self.outbox.add(s, id_str, 'post', {'content': content, 'image_url': image_url, 'media_type': media_type, 'url': url})
+            cur.execute(sql_insert, (self.name, entry_key(self.config, id_str), int(time.time())))
+            s.commit()
 
-                tweet_id = res.json()['data']['id']
+        if state is not None:
+            save_feed_state(s, self.name, feed_url, state)
 
-                cur.execute(sql_insert, (id_str, int(time.time())))
-                s.commit()
+        if not sync_only:
+            self.outbox.drain(s, [('post', self.send_post), ('reply', self.send_reply)])
+
+        # The whole feed is only at hand when fetched here, the runner takes
+        # care of it by itself.
+        if state is not None and items and maintenance_due(s, self.config, self.name):
+            maintain(s, self.config, {self.name: [item['id'] for item in items]})
 
-                # Wait before posting reply to avoid rate limit
-                tprint('* Waiting 2 seconds before posting reply...')
-                time.sleep(2)
-
-                # Append feed entry url into replies.
-                reply_data = {
-                    'text': f'Sync from: {url}',
-                    'reply': {'in_reply_to_tweet_id': tweet_id},
-                }
-
-                res = httpx.post(
-                    'https://api.x.com/2/tweets',
-                    auth=auth,
-                    json=reply_data,
-                )
-                tprint('* Reply res = {}'.format(res))
-                tprint('* Reply res.text = {}'.format(json.dumps(res.json(), ensure_ascii=False)))
-
-                if res.status_code == 429:
-                    # Rate limit hit, display headers and exit
-                    tprint('* Reply rate limit exceeded (429). Response headers:')
-                    tprint('*   x-rate-limit-limit: {}'.format(res.headers.get('x-rate-limit-limit', 'N/A')))
-                    tprint('*   x-rate-limit-remaining: {}'.format(res.headers.get('x-rate-limit-remaining', 'N/A')))
-                    tprint('*   x-rate-limit-reset: {}'.format(res.headers.get('x-rate-limit-reset', 'N/A')))
-                    rate_limit_reset = res.headers.get('x-rate-limit-reset')
-                    if rate_limit_reset:
-                        reset_time = int(rate_limit_reset)
-                        reset_datetime = datetime.datetime.fromtimestamp(reset_time)
-                        tprint('*   Reset time: {} (local time)'.format(reset_datetime))
-                    tprint('* Exiting due to rate limit.')
-                    s.close()
-                    exit(1)
-
-                if res.status_code != 201:
-                    tprint('* Error posting reply: {}'.format(res.status_code))
-
-                # Wait between processing feed items to avoid rate limit
-                tprint('* Waiting 3 seconds before next item...')
-                time.sleep(3)
+        return True
 
 if '__main__' == __name__:
     parser = argparse.ArgumentParser(description='Sync feed to Twitter')
+    parser.add_argument('--account',
+                        help='Post with the account in the [twitter:<account>] section of config.ini instead of [default]')
     parser.add_argument('--sync-only', action='store_true',
                         help='Only sync feed to database without posting to Twitter')
     args = parser.parse_args()
 
-    t = Feed2Twitter()
+    t = Feed2Twitter(account=args.account)
     t.main(sync_only=args.sync_only)